@@ -0,0 +1,164 @@
+import math
+import logging
+from collections import OrderedDict, deque
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Count, Min, Q
+from django.utils import timezone
+
+from .models import BuildRecord, ACTIVE_STATUSES
+
+logger = logging.getLogger("jenkins_worker")
+
+DEFAULT_ADMISSION = {
+    "enabled": True,
+    "max_active": 200,                  # admitted builds not finished yet, all controllers
+    "max_active_per_job": 2,
+    "max_active_per_controller": 100,
+    "eta_sample_size": 100,             # finished builds averaged for the start estimate
+    "default_build_seconds": 300,       # estimate used before any build finished
+}
+
+# pg_advisory_xact_lock key, admissions are decided one scheduler at a time
+ADMISSION_LOCK_ID = 0x61646d74
+
+
+def get_admission_config():
+    config = dict(DEFAULT_ADMISSION)
+    config.update(getattr(settings, "BUILD_ADMISSION", {}))
+    return config
+
+
+def waiting_builds():
+    """Builds accepted by start but not handed to Jenkins yet"""
+    return BuildRecord.objects.filter(status="PENDING", enqueued_at__isnull=False, admitted_at__isnull=True)
+
+
+def active_builds():
+    return BuildRecord.objects.filter(status__in=ACTIVE_STATUSES).exclude(
+        status="PENDING", enqueued_at__isnull=False, admitted_at__isnull=True)
+
+
+def fair_order(builds):
+    """Round robin over teams (longest waiting first), within a team over its
+    jobs, FIFO within a job. One busy team or job cannot starve the rest."""
+    teams = OrderedDict()
+    for build in sorted(builds, key=lambda b: (b.enqueued_at, b.id)):
+        teams.setdefault(build.team or "", OrderedDict()).setdefault(build.job_name, deque()).append(build)
+
+    team_queue = deque((team, deque(jobs.values())) for team, jobs in teams.items())
+    while team_queue:
+        team, job_queues = team_queue.popleft()
+        job = job_queues.popleft()
+        yield job.popleft()
+        if job:
+            job_queues.append(job)
+        if job_queues:
+            team_queue.append((team, job_queues))
+
+
+def _lock():
+    if connection.vendor == "postgresql":
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_advisory_xact_lock(%s)", [ADMISSION_LOCK_ID])
+
+
+def admit_waiting_builds():
+    """Admit waiting builds in fair order while the caps allow, returns the admitted ids.
+
+    Admitted builds get admitted_at and a trigger_build message, the rest
+    keep waiting for the next run (started by start and by every build
+    that finishes).
+    """
+    from .tasks import trigger_build  # the broker is only needed here
+
+    config = get_admission_config()
+    admitted = []
+    with transaction.atomic():
+        _lock()
+        active = active_builds()
+        total = active.count()
+        per_job = dict(active.values_list("job_name").annotate(n=Count("id")))
+        per_controller = dict(active.values_list("controller_id").annotate(n=Count("id")))
+
+        for build in fair_order(waiting_builds()):
+            if total >= config["max_active"]:
+                break
+            if per_job.get(build.job_name, 0) >= config["max_active_per_job"]:
+                continue
+            if per_controller.get(build.controller_id, 0) >= config["max_active_per_controller"]:
+                continue
+            build.admitted_at = timezone.now()
+            BuildRecord.objects.filter(id=build.id).update(admitted_at=build.admitted_at)
+            total += 1
+            per_job[build.job_name] = per_job.get(build.job_name, 0) + 1
+            per_controller[build.controller_id] = per_controller.get(build.controller_id, 0) + 1
+            admitted.append(build.id)
+
+        for build_id in admitted:
+            transaction.on_commit(lambda build_id=build_id: trigger_build.send(build_id))
+
+    if admitted:
+        logger.info(f"Admitted {len(admitted)} builds, {total} active")
+    return admitted
+
+
+def slot_freed():
+    """A build finished: admit the next ones once its status is committed"""
+    if get_admission_config()["enabled"]:
+        transaction.on_commit(admit_waiting_builds)
+
+
+def average_build_seconds(config):
+    recent = (BuildRecord.objects.filter(end_time__isnull=False, admitted_at__isnull=False)
+              .exclude(status__in=ACTIVE_STATUSES).order_by("-end_time")
+              .values_list("admitted_at", "end_time")[:config["eta_sample_size"]])
+    durations = [(end - start).total_seconds() for start, end in recent if end > start]
+    return sum(durations) / len(durations) if durations else config["default_build_seconds"]
+
+
+def _round_robin_position(counts, index, turn):
+    """Where queue index (of queues holding counts items, served round robin
+    in this order, empty ones dropping out) has its turn-th item served"""
+    return sum(min(count, turn) for count in counts) + sum(1 for count in counts[:index] if count > turn)
+
+
+def queue_position(build_record):
+    """Position of a waiting build in fair_order() from per-job counts, without
+    loading the queue: one row per waiting job plus one count."""
+    waiting = waiting_builds()
+    if not waiting.filter(id=build_record.id).exists():
+        return None
+    ahead_in_job = waiting.filter(team=build_record.team, job_name=build_record.job_name).filter(
+        Q(enqueued_at__lt=build_record.enqueued_at) | Q(enqueued_at=build_record.enqueued_at, id__lt=build_record.id)
+    ).count()
+
+    # jobs and teams take turns in the order of their longest waiting build
+    teams = {}
+    rows = waiting.values("team", "job_name").annotate(count=Count("id"), first=Min("enqueued_at"), first_id=Min("id"))
+    for row in rows:
+        teams.setdefault(row["team"], {})[row["job_name"]] = ((row["first"], row["first_id"]), row["count"])
+    team_order = sorted(teams, key=lambda name: min(first for first, _count in teams[name].values()))
+    jobs = sorted(teams[build_record.team].items(), key=lambda item: item[1][0])
+    job_index = [name for name, _ in jobs].index(build_record.job_name)
+    turn = _round_robin_position([count for _name, (_first, count) in jobs], job_index, ahead_in_job)
+    team_counts = [sum(count for _first, count in teams[name].values()) for name in team_order]
+    return _round_robin_position(team_counts, team_order.index(build_record.team), turn)
+
+
+def queue_info(build_record):
+    """Position in the fair order (0 = next) and a rough start estimate,
+    None once the build was admitted."""
+    if not (build_record.status == "PENDING" and build_record.enqueued_at and not build_record.admitted_at):
+        return None
+    config = get_admission_config()
+    position = queue_position(build_record)
+    if position is None:
+        return None
+    # free slots go right away, after that a "wave" of max_active builds per average build duration
+    free = max(0, config["max_active"] - active_builds().count())
+    waves = 0 if position < free else math.ceil((position - free + 1) / max(1, config["max_active"]))
+    estimated_start = timezone.now() + timedelta(seconds=waves * average_build_seconds(config))
+    return {"position": position, "waiting": waiting_builds().count(), "estimated_start": estimated_start}
@@ -4,3 +4,8 @@ from django.apps import AppConfig
 class BuildsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'builds'
+
+    def ready(self):
+        from . import signals  # noqa: F401  status transitions -> change feed
+        from .profiling import install_signal_handler
+        install_signal_handler()  # kill -USR2 <pid> toggles the sampling profiler
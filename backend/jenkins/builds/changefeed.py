@@ -0,0 +1,219 @@
+import select
+import logging
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+from .models import BuildStatusChange
+
+logger = logging.getLogger("jenkins_worker")
+
+NOTIFY_CHANNEL = "build_status_changes"
+# Jenkins pushed an event for a build (payload: BuildRecord id), wakes its poller
+BUILD_EVENT_CHANNEL = "build_events"
+MAX_BATCH = 500
+
+DEFAULT_CHANGE_FEED = {
+    # Ids are taken at insert, not at commit: a gap in the ids (a transaction still
+    # open, or rolled back) holds back the changes after it until they are this old
+    "settle_seconds": 2,
+    "retention_days": 7,        # older changes are deleted by manage.py sweep_logs
+}
+
+
+def get_changefeed_config():
+    config = dict(DEFAULT_CHANGE_FEED)
+    config.update(getattr(settings, "BUILD_CHANGE_FEED", {}))
+    return config
+
+
+class LocalBus:
+    """In-process wakeup for long-poll waiters, fed by publish() or the LISTEN thread"""
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.latest = 0
+        self.build_events = {}
+
+    def notify(self, change_id):
+        with self.cond:
+            if change_id > self.latest:
+                self.latest = change_id
+            self.cond.notify_all()
+
+    def wait(self, seen, timeout):
+        """Block until a change newer than seen is announced or timeout"""
+        with self.cond:
+            return self.cond.wait_for(lambda: self.latest > seen, timeout)
+
+    def _build_event(self, build_id):
+        with self.cond:
+            return self.build_events.setdefault(build_id, threading.Event())
+
+    def wake_build(self, build_id):
+        self._build_event(build_id).set()
+
+    def wait_build(self, build_id, timeout):
+        """Sleep up to timeout, returns True if an event for build_id arrived"""
+        event = self._build_event(build_id)
+        woken = event.wait(timeout)
+        event.clear()
+        return woken
+
+    def forget_build(self, build_id):
+        with self.cond:
+            self.build_events.pop(build_id, None)
+
+
+bus = LocalBus()
+_listener = None
+_listener_lock = threading.Lock()
+
+
+def uses_postgres():
+    return connection.vendor == "postgresql"
+
+
+def _listen_forever():
+    import psycopg2
+    import psycopg2.extensions
+
+    db = settings.DATABASES["default"]
+    while True:
+        try:
+            conn = psycopg2.connect(dbname=db["NAME"], user=db["USER"], password=db["PASSWORD"],
+                                    host=db["HOST"], port=db["PORT"])
+            conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            conn.cursor().execute(f"LISTEN {NOTIFY_CHANNEL}; LISTEN {BUILD_EVENT_CHANNEL};")
+            logger.info(f"Listening on {NOTIFY_CHANNEL}, {BUILD_EVENT_CHANNEL}")
+            while True:
+                if select.select([conn], [], [], 30) == ([], [], []):
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    notify = conn.notifies.pop(0)
+                    if notify.channel == BUILD_EVENT_CHANNEL:
+                        bus.wake_build(int(notify.payload))
+                    else:
+                        bus.notify(int(notify.payload))
+        except Exception as e:
+            logger.warning(f"Change feed listener lost its connection: {e}")
+            time.sleep(2)
+
+
+def ensure_listener():
+    """Start the per-process LISTEN thread (Postgres only)"""
+    global _listener
+    if not uses_postgres() or _listener is not None:
+        return
+    with _listener_lock:
+        if _listener is None:
+            _listener = threading.Thread(target=_listen_forever, name="changefeed-listener", daemon=True)
+            _listener.start()
+
+
+def publish(build_record, old_status):
+    """Record a status transition and wake up everyone waiting on the feed"""
+    change = BuildStatusChange.objects.create(
+        build=build_record,
+        job_name=build_record.job_name,
+        build_number=build_record.build_number,
+        old_status=old_status,
+        new_status=build_record.status,
+    )
+    if uses_postgres():
+        # delivered on commit to every process LISTENing, this one included
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_notify(%s, %s)", [NOTIFY_CHANNEL, str(change.id)])
+    else:
+        transaction.on_commit(lambda: bus.notify(change.id))
+    return change
+
+
+def publish_build_event(build_id):
+    """Wake the poller that owns build_id, wherever it runs"""
+    if uses_postgres():
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_notify(%s, %s)", [BUILD_EVENT_CHANNEL, str(build_id)])
+    else:
+        transaction.on_commit(lambda: bus.wake_build(build_id))
+
+
+def wait_for_build_event(build_id, timeout):
+    """Poller sleep that ends early when Jenkins pushes an event for the build"""
+    ensure_listener()
+    return bus.wait_build(build_id, timeout)
+
+
+def forget_build_events(build_id):
+    bus.forget_build(build_id)
+
+
+def settled_changes(config=None):
+    """Changes safe to serve, so the cursor never passes a lower id that may still commit.
+
+    Changes in an unbroken run of ids are served at once. After a gap they
+    wait until they are settle_seconds old.
+    """
+    config = config or get_changefeed_config()
+    cutoff = timezone.now() - timedelta(seconds=config["settle_seconds"])
+    settled = BuildStatusChange.objects.filter(created_at__lte=cutoff)
+    first_recent = (BuildStatusChange.objects.filter(created_at__gt=cutoff)
+                    .order_by("id").values_list("id", flat=True).first())
+    if first_recent is None:
+        return settled
+    last = settled.filter(id__lt=first_recent).order_by("-id").values_list("id", flat=True).first() or 0
+    following = (BuildStatusChange.objects.filter(id__gte=first_recent)
+                 .order_by("id").values_list("id", "created_at")[:MAX_BATCH])
+    for change_id, created_at in following:
+        if change_id != last + 1 and created_at > cutoff:
+            break
+        last = change_id
+    return BuildStatusChange.objects.filter(id__lte=last)
+
+
+def current_cursor():
+    last = settled_changes().order_by("-id").values_list("id", flat=True).first()
+    return last or 0
+
+
+def changes_since(cursor, limit=MAX_BATCH):
+    return list(
+        settled_changes().filter(id__gt=cursor).order_by("id")
+        .values("id", "build_id", "job_name", "build_number", "old_status", "new_status", "created_at")[:limit]
+    )
+
+
+def wait_for_changes(cursor, timeout):
+    """Changes after cursor, blocking up to timeout seconds while there are none.
+
+    No queries run while nothing changed: the LocalBus is woken by publish()
+    or by the Postgres LISTEN thread once the change committed. Changes
+    held back by a gap are picked up once they settled.
+    """
+    ensure_listener()
+    settle = get_changefeed_config()["settle_seconds"]
+    deadline = time.monotonic() + timeout
+    while True:
+        seen = bus.latest
+        changes = changes_since(cursor)
+        remaining = deadline - time.monotonic()
+        if changes or remaining <= 0:
+            return changes
+        if seen > cursor:
+            time.sleep(min(remaining, max(settle / 4, 0.05)))  # announced, behind a gap
+        else:
+            bus.wait(seen, remaining)
+
+
+def prune_changes(config=None):
+    """Delete changes past retention_days, returns how many. Cursors older than
+    that resume at the oldest change kept."""
+    config = config or get_changefeed_config()
+    cutoff = timezone.now() - timedelta(days=config["retention_days"])
+    deleted, _ = BuildStatusChange.objects.filter(created_at__lt=cutoff).delete()
+    return deleted
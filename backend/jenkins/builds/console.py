@@ -0,0 +1,164 @@
+import os
+import re
+import json
+import mmap
+import struct
+from bisect import bisect_right
+
+# Jenkins ConsoleNote (ESC[8mha:////<base64>ESC[0m), ANSI CSI (colours, cursor) and OSC sequences
+ESCAPE_RE = re.compile(
+    rb"\x1b\[8mha:.*?\x1b\[0m"
+    rb"|\x1b\[[0-9;?]*[ -/]*[@-~]"
+    rb"|\x1b\][^\x07\x1b]*(?:\x07|\x1b\\)",
+    re.S,
+)
+NOTE_START = b"\x1b[8mha:"
+PARTIAL_ESCAPE_RE = re.compile(rb"\x1b(?:\[[0-9;?]*[ -/]*|\][^\x07\x1b]*\x1b?)?\Z")
+
+# An unterminated sequence longer than this is passed through as text
+MAX_HOLD = 64 * 1024
+# Longest CSI/OSC tail we look back for at the end of a chunk (OSC 8 hyperlinks carry a whole URL)
+MAX_ESCAPE = 8 * 1024
+
+# plain.map records: (raw offset, plain offset), each starts a run of 1:1 bytes
+MAP_RECORD = struct.Struct("<QQ")
+
+
+def _hold_start(buf):
+    """Index where a possibly incomplete escape sequence starts, len(buf) if none"""
+    note = buf.rfind(NOTE_START)
+    if note != -1 and buf.find(b"\x1b[0m", note + len(NOTE_START)) == -1:
+        return note if len(buf) - note <= MAX_HOLD else len(buf)
+
+    lookback = max(0, len(buf) - MAX_ESCAPE)
+    esc = buf.rfind(b"\x1b", lookback)
+    if esc != -1:
+        if esc == len(buf) - 1:
+            # a lone ESC may be the first byte of the ST ending an OSC opened before it
+            opened = buf.rfind(b"\x1b", lookback, esc)
+            if opened != -1 and buf[opened + 1:opened + 2] == b"]" and PARTIAL_ESCAPE_RE.match(buf, opened):
+                return opened
+        tail = buf[esc:]
+        if NOTE_START.startswith(tail) or PARTIAL_ESCAPE_RE.match(tail):
+            return esc
+    return len(buf)
+
+
+def strip_escapes(buf, raw_offset, plain_offset):
+    """Strip escapes from buf which starts at raw_offset / plain_offset.
+
+    Returns (plain bytes, map records) where a record is added wherever
+    removed bytes shift the raw and plain offsets apart.
+    """
+    out = []
+    records = []
+    pos = 0
+    plain_pos = plain_offset
+    for match in ESCAPE_RE.finditer(buf):
+        if match.start() > pos:
+            out.append(buf[pos:match.start()])
+            plain_pos += match.start() - pos
+        pos = match.end()
+        if records and records[-1][1] == plain_pos:
+            records[-1] = (raw_offset + pos, plain_pos)  # back to back escapes
+        else:
+            records.append((raw_offset + pos, plain_pos))
+    out.append(buf[pos:])
+    return b"".join(out), records
+
+
+def load_state(state_path):
+    try:
+        with open(state_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        # raw_offset: raw bytes consumed (held bytes are not), plain_offset: size of plain.log
+        return {"raw_offset": 0, "plain_offset": 0}
+
+
+def normalize_chunk(state_path, read_range, plain_path, map_path, start_offset, data):
+    """Append the plain-text version of a freshly written raw chunk.
+
+    Bytes of an escape sequence cut by the previous chunk were held back;
+    they are re-read with read_range(start, end) and normalized together
+    with data. Returns (plain.log offset, plain bytes appended there).
+    With plain_path None nothing is stored, only the offsets advance.
+    """
+    state = load_state(state_path)
+    if start_offset + len(data) <= state["raw_offset"]:
+        return state["plain_offset"], b""  # already normalized
+
+    buf, buf_offset = data, start_offset
+    if state["raw_offset"] < start_offset:
+        held = read_range(state["raw_offset"], start_offset)
+        buf, buf_offset = held + data, state["raw_offset"]
+    elif state["raw_offset"] > start_offset:
+        buf = data[state["raw_offset"] - start_offset:]
+        buf_offset = state["raw_offset"]
+
+    hold = _hold_start(buf)
+    plain, records = strip_escapes(buf[:hold], buf_offset, state["plain_offset"])
+
+    if plain_path is not None:
+        with open(plain_path, "ab") as f:
+            f.write(plain)
+    if records and map_path is not None:
+        with open(map_path, "ab") as f:
+            f.write(b"".join(MAP_RECORD.pack(*record) for record in records))
+
+    plain_start = state["plain_offset"]
+    state = {"raw_offset": buf_offset + hold, "plain_offset": plain_start + len(plain)}
+    tmp_path = state_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(state, f)
+    os.replace(tmp_path, state_path)
+    return plain_start, plain
+
+
+class _MapColumn:
+    """One column of plain.map as a sequence for bisect, records are unpacked
+    only when probed. Index 0 is the implicit (0, 0) record."""
+
+    def __init__(self, data, count, field):
+        self.data = data
+        self.count = count
+        self.field = field
+
+    def __len__(self):
+        return self.count + 1
+
+    def __getitem__(self, i):
+        if not 0 <= i <= self.count:
+            raise IndexError(i)
+        return MAP_RECORD.unpack_from(self.data, (i - 1) * MAP_RECORD.size)[self.field] if i else 0
+
+
+class OffsetMap:
+    """Translate offsets between the raw log and its plain-text variant.
+
+    plain.map is memory-mapped and bisected in place: a lookup reads a few
+    records, not the whole map.
+    """
+
+    def __init__(self, map_path):
+        data = b""
+        try:
+            with open(map_path, "rb") as f:
+                if os.fstat(f.fileno()).st_size >= MAP_RECORD.size:
+                    data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except FileNotFoundError:
+            pass
+        count = len(data) // MAP_RECORD.size  # a record being appended is ignored
+        self.raw = _MapColumn(data, count, 0)
+        self.plain = _MapColumn(data, count, 1)
+
+    def raw_to_plain(self, offset):
+        i = bisect_right(self.raw, offset) - 1
+        next_plain = self.plain[i + 1] if i + 1 < len(self.plain) else None
+        plain = self.plain[i] + (offset - self.raw[i])
+        # offsets inside a stripped sequence map to where it was removed
+        return min(plain, next_plain) if next_plain is not None else plain
+
+    def plain_to_raw(self, offset):
+        i = bisect_right(self.plain, offset) - 1
+        return self.raw[i] + (offset - self.plain[i])
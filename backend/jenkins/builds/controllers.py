@@ -0,0 +1,163 @@
+import time
+import fnmatch
+import logging
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from django.conf import settings
+from django.db.models import Count, Q
+
+from .models import BuildRecord, JenkinsController, ACTIVE_STATUSES
+
+logger = logging.getLogger("jenkins_worker")
+
+# Used for builds without a controller and when no JenkinsController rows exist
+DEFAULT_JENKINS_CONTROLLER = {
+    "url": "http://localhost:8080",
+    "username": "admin",
+    "token": "",
+    "max_connections": 20,
+    "requests_per_second": 20.0,
+}
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_default_controller_config():
+    config = dict(DEFAULT_JENKINS_CONTROLLER)
+    config.update(getattr(settings, "JENKINS_CONTROLLER", {}))
+    return config
+
+
+class TokenBucket:
+    """Blocking rate limiter, bursts up to one second worth of requests"""
+
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.capacity = max(1.0, self.rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if self.rate <= 0:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class JenkinsClient:
+    """HTTP access to one controller: pooled session, rate limit and a cap on
+    concurrent requests from this process."""
+
+    def __init__(self, name, url, username, token, max_connections=20, requests_per_second=20.0):
+        self.name = name
+        self.url = url.rstrip("/")
+        self.session = requests.Session()
+        self.session.auth = (username, token)
+        self.session.verify = False
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_connections)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.slots = threading.BoundedSemaphore(max_connections)
+        self.bucket = TokenBucket(requests_per_second)
+
+    def request(self, method, url, **kwargs):
+        """url may be absolute (queue item Location) or a path on the controller.
+
+        A stream=True response keeps its slot until it is closed (use it as a
+        context manager): the body is still being read over the connection.
+        """
+        if not url.startswith(("http://", "https://")):
+            url = f"{self.url}/{url.lstrip('/')}"
+        self.bucket.acquire()
+        self.slots.acquire()
+        try:
+            response = self.session.request(method, url, **kwargs)
+        except BaseException:
+            self.slots.release()
+            raise
+        if not kwargs.get("stream"):
+            self.slots.release()
+            return response
+
+        close = response.close
+        held = [True]
+
+        def close_and_release():
+            try:
+                close()
+            finally:
+                if held:
+                    held.clear()
+                    self.slots.release()
+
+        response.close = close_and_release
+        return response
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+
+def get_client(controller=None):
+    """Shared client per controller, rebuilt when the controller row changes"""
+    key = controller.id if controller else None
+    version = controller.updated_at if controller else None
+    with _clients_lock:
+        cached = _clients.get(key)
+        if cached is None or cached[0] != version:
+            if controller:
+                client = JenkinsClient(controller.name, controller.url, controller.username, controller.token,
+                                       controller.max_connections, controller.requests_per_second)
+            else:
+                config = get_default_controller_config()
+                client = JenkinsClient("default", config["url"], config["username"], config["token"],
+                                       config["max_connections"], config["requests_per_second"])
+            cached = _clients[key] = (version, client)
+        return cached[1]
+
+
+def get_build_client(build_record):
+    return get_client(build_record.controller)
+
+
+def route_job(job_name):
+    """Controller to trigger a job on, None for the settings.JENKINS_CONTROLLER default.
+
+    Controllers whose job_patterns match the job are candidates (else
+    the is_default one). A job stays on the controller of its previous
+    builds, since (job_name, build_number) must stay unique; a new job
+    goes to the candidate with the most free capacity.
+    """
+    controllers = list(
+        JenkinsController.objects.filter(enabled=True)
+        .annotate(active=Count("builds", filter=Q(builds__status__in=ACTIVE_STATUSES)))
+    )
+    matching = [c for c in controllers if any(
+        fnmatch.fnmatchcase(job_name, pattern.strip())
+        for pattern in (c.job_patterns or "").split(",") if pattern.strip()
+    )]
+    if not matching:
+        matching = [c for c in controllers if c.is_default]
+    if not matching:
+        return None
+
+    previous = (BuildRecord.objects.filter(job_name=job_name, controller__in=matching)
+                .order_by("-id").values_list("controller_id", flat=True).first())
+    for controller in matching:
+        if controller.id == previous:
+            return controller
+    return min(matching, key=lambda c: (c.active / max(1, c.max_connections), c.name))
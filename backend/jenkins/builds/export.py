@@ -0,0 +1,186 @@
+import io
+import json
+import time
+import zlib
+import tarfile
+import zipfile
+import logging
+
+from .storage import get_capped_log, log_exists, read_meta
+
+logger = logging.getLogger("jenkins_worker")
+
+ARCHIVE_FORMATS = {
+    "zip": "application/zip",
+    "tar.gz": "application/gzip",
+}
+
+MAX_EXPORT_BUILDS = 500
+ARCHIVE_CHUNK_SIZE = 256 * 1024
+
+
+class _Sink(io.RawIOBase):
+    """Write-only, unseekable buffer the archive writers write into; the
+    generator drains it after every chunk so memory stays bounded."""
+
+    def __init__(self):
+        self.parts = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        data = b"".join(self.parts)
+        self.parts = []
+        return data
+
+
+def _meta(build_record):
+    """meta.json: the stored meta plus the record fields an incident review needs"""
+    meta = {
+        "id": build_record.id,
+        "job_name": build_record.job_name,
+        "build_number": build_record.build_number,
+        "status": build_record.status,
+        "start_time": build_record.start_time.isoformat() if build_record.start_time else None,
+        "end_time": build_record.end_time.isoformat() if build_record.end_time else None,
+    }
+    meta.update(read_meta(build_record.job_name, build_record.build_number) or {})
+    return json.dumps(meta, indent=2).encode("utf-8")
+
+
+def _archived_entries(build_record):
+    """Members of a retention archive (builds swept with action=archive)"""
+    tar = tarfile.open(build_record.log_path, "r:gz")
+    prefix = f"{build_record.build_number}/"
+    members = {m.name[len(prefix):]: m for m in tar.getmembers() if m.name.startswith(prefix) and m.isfile()}
+    if "full.log" not in members:
+        tar.close()
+        return None
+
+    def reader(member):
+        def read():
+            f = tar.extractfile(member)
+            while True:
+                chunk = f.read(ARCHIVE_CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+        return read
+
+    entries = [("full.log", members["full.log"].size, reader(members["full.log"]))]
+    meta = _meta(build_record)
+    entries.append(("meta.json", len(meta), lambda: iter([meta])))
+    return entries, tar
+
+
+def build_entries(build_record):
+    """[(name, size, chunks)] to export for a build and an optional handle to
+    close afterwards, None when there is no log to export. The log is read
+    through the capped log, so any log backend (and a dropped range) works."""
+    if build_record.log_path and build_record.log_path.endswith(".tar.gz"):
+        return _archived_entries(build_record)
+    if not build_record.build_number or not log_exists(build_record.job_name, build_record.build_number):
+        return None
+    capped = get_capped_log(build_record.job_name, build_record.build_number)
+    # a running build keeps growing: export what was there when the entry started
+    end, size = capped.size(), capped.stream_size()
+    meta = _meta(build_record)
+    return [
+        ("full.log", size, lambda: capped.iter_range(0, end)),
+        ("meta.json", len(meta), lambda: iter([meta])),
+    ], None
+
+
+def _fit(chunks, size):
+    """Exactly size bytes (the header is already written), zero padded if the log shrank"""
+    remaining = size
+    for chunk in chunks:
+        if remaining <= 0:
+            break
+        chunk = chunk[:remaining]
+        remaining -= len(chunk)
+        yield chunk
+    if remaining > 0:
+        yield b"\0" * remaining
+
+
+def _iter_builds(build_records):
+    """(folder, entries) per build, a skipped list for the ones without a log"""
+    skipped = []
+    for build_record in build_records:
+        try:
+            found = build_entries(build_record)
+        except Exception as e:
+            logger.exception(f"Export of {build_record.job_name} #{build_record.build_number} failed: {e}")
+            found = None
+        if not found:
+            skipped.append({"id": build_record.id, "job_name": build_record.job_name,
+                            "build_number": build_record.build_number})
+            continue
+        entries, handle = found
+        try:
+            yield f"{build_record.job_name}/{build_record.build_number}", entries
+        finally:
+            if handle:
+                handle.close()
+    if skipped:
+        data = json.dumps({"skipped": skipped}, indent=2).encode("utf-8")
+        yield "", [("skipped.json", len(data), lambda: iter([data]))]
+
+
+def _entry_name(folder, name):
+    return f"{folder}/{name}" if folder else name
+
+
+def iter_zip(build_records):
+    sink = _Sink()
+    with zipfile.ZipFile(sink, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+        for folder, entries in _iter_builds(build_records):
+            for name, size, chunks in entries:
+                info = zipfile.ZipInfo(_entry_name(folder, name), time.localtime()[:6])
+                info.compress_type = zipfile.ZIP_DEFLATED
+                info.file_size = size  # lets zipfile pick zip64 up front for large logs
+                with zf.open(info, "w") as f:
+                    for chunk in _fit(chunks(), size):
+                        f.write(chunk)
+                        yield sink.drain()
+                yield sink.drain()
+    yield sink.drain()
+
+
+def iter_tar_gz(build_records):
+    """tar headers are written by hand: tarfile.addfile would copy a whole
+    member before we could hand out any of it"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # gzip container
+    written = 0
+    for folder, entries in _iter_builds(build_records):
+        for name, size, chunks in entries:
+            info = tarfile.TarInfo(_entry_name(folder, name))
+            info.size = size
+            info.mtime = int(time.time())
+            info.mode = 0o644
+            header = info.tobuf(tarfile.PAX_FORMAT)
+            written += len(header)
+            yield compressor.compress(header)
+            for chunk in _fit(chunks(), size):
+                written += len(chunk)
+                yield compressor.compress(chunk)
+            padding = -size % tarfile.BLOCKSIZE
+            written += padding
+            yield compressor.compress(b"\0" * padding)
+    end = b"\0" * (2 * tarfile.BLOCKSIZE)
+    written += len(end)
+    end += b"\0" * (-written % tarfile.RECORDSIZE)
+    yield compressor.compress(end) + compressor.flush()
+
+
+def iter_archive(build_records, archive_format):
+    """The archive in chunks, built while it is sent"""
+    if archive_format == "zip":
+        return (chunk for chunk in iter_zip(build_records) if chunk)
+    return (chunk for chunk in iter_tar_gz(build_records) if chunk)
@@ -0,0 +1,145 @@
+import os
+import bisect
+import hashlib
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+from .models import BuildRecord, PollerNode, ACTIVE_STATUSES
+
+logger = logging.getLogger("jenkins_worker")
+
+DEFAULT_POLLER_FLEET = {
+    "enabled": False,          # assign builds to registered poller nodes
+    "node_ttl": 30,            # seconds without a heartbeat before a node counts as gone
+    "heartbeat_interval": 10,  # seconds between node heartbeats / rebalance runs
+    "virtual_nodes": 128,      # ring points per node, more points = more even spread
+}
+
+# Each node consumes the shared "pollers" queue plus its own "pollers.<node>"
+NODE_QUEUE_PREFIX = "pollers."
+# Set by run_poller_node for its worker processes
+POLLER_NODE = os.environ.get("POLLER_NODE")
+
+# pg_try_advisory_xact_lock key, one coordinator rebalances at a time
+REBALANCE_LOCK_ID = 0x6a656e6b
+
+
+def get_fleet_config():
+    config = dict(DEFAULT_POLLER_FLEET)
+    config.update(getattr(settings, "POLLER_FLEET", {}))
+    return config
+
+
+def node_queue(node_name):
+    return f"{NODE_QUEUE_PREFIX}{node_name}"
+
+
+def _hash(key):
+    return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[:8], "big")
+
+
+class HashRing:
+    """Consistent hash ring; a node joining or leaving only moves ~1/N of the keys"""
+
+    def __init__(self, nodes, virtual_nodes=128):
+        self.nodes = sorted(nodes)
+        points = sorted((_hash(f"{node}#{i}"), node) for node in self.nodes for i in range(virtual_nodes))
+        self.hashes = [h for h, _node in points]
+        self.owners = [node for _h, node in points]
+
+    def node_for(self, key):
+        if not self.owners:
+            return None
+        i = bisect.bisect(self.hashes, _hash(key)) % len(self.hashes)
+        return self.owners[i]
+
+
+def build_key(build_record):
+    # the id is known before Jenkins assigns a build number
+    return f"{build_record.job_name}/{build_record.id}"
+
+
+def register_node(node_name):
+    """Create or heartbeat a node row"""
+    PollerNode.objects.update_or_create(name=node_name, defaults={"heartbeat_at": timezone.now()})
+
+
+def remove_node(node_name):
+    PollerNode.objects.filter(name=node_name).delete()
+
+
+def live_nodes():
+    cutoff = timezone.now() - timedelta(seconds=get_fleet_config()["node_ttl"])
+    return list(PollerNode.objects.filter(heartbeat_at__gte=cutoff).order_by("name").values_list("name", flat=True))
+
+
+def current_ring():
+    return HashRing(live_nodes(), get_fleet_config()["virtual_nodes"])
+
+
+def _send(actor, build_id, queue_name, delay=None):
+    actor.broker.declare_queue(queue_name)
+    message = actor.message_with_options(args=(build_id,)).copy(queue_name=queue_name)
+    return actor.broker.enqueue(message, delay=delay)
+
+
+def enqueue_poller(actor, build_record, delay=None, ring=None):
+    """Send the poller message to the node owning the build.
+
+    Falls back to the shared queue when the fleet is disabled or no node
+    is alive, any pollers worker picks it up then.
+    """
+    if not get_fleet_config()["enabled"]:
+        return actor.send_with_options(args=(build_record.id,), delay=delay)
+
+    node = (ring or current_ring()).node_for(build_key(build_record))
+    if node != build_record.assigned_node:
+        BuildRecord.objects.filter(id=build_record.id).update(assigned_node=node)
+        build_record.assigned_node = node
+    if node is None:
+        return actor.send_with_options(args=(build_record.id,), delay=delay)
+    # after commit, so the poller never reads the previous assigned_node
+    transaction.on_commit(lambda: _send(actor, build_record.id, node_queue(node), delay))
+
+
+def is_assigned_elsewhere(build_record):
+    """True when this worker's node no longer owns the build"""
+    return bool(POLLER_NODE and build_record.assigned_node and build_record.assigned_node != POLLER_NODE)
+
+
+def _try_coordinator_lock():
+    if connection.vendor != "postgresql":
+        return True
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT pg_try_advisory_xact_lock(%s)", [REBALANCE_LOCK_ID])
+        return cursor.fetchone()[0]
+
+
+def rebalance(actor):
+    """Move active builds whose ring owner changed, returns how many moved.
+
+    Builds still waiting for trigger_build (no node yet) are left alone,
+    trigger_build assigns them. The old node's poller sees the new
+    assigned_node on its next DB refresh and hands its lease over.
+    """
+    with transaction.atomic():
+        if not _try_coordinator_lock():
+            return 0  # another node is rebalancing right now
+        ring = current_ring()
+        if not ring.nodes:
+            return 0
+
+        moved = 0
+        qs = BuildRecord.objects.filter(status__in=ACTIVE_STATUSES).exclude(assigned_node__isnull=True)
+        for build_record in qs.only("id", "job_name", "assigned_node").iterator():
+            target = ring.node_for(build_key(build_record))
+            if target == build_record.assigned_node:
+                continue
+            logger.info(f"Moving build id={build_record.id} from {build_record.assigned_node} to {target}")
+            enqueue_poller(actor, build_record, ring=ring)
+            moved += 1
+        return moved
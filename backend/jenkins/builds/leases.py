@@ -0,0 +1,94 @@
+import os
+import uuid
+import socket
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .models import BuildLease
+
+logger = logging.getLogger("jenkins_worker")
+
+DEFAULT_LEASE = {
+    "ttl": 60,                 # seconds a lease lives without a heartbeat
+    "heartbeat_interval": 15,  # seconds between heartbeats/checkpoints
+}
+
+
+def get_lease_config():
+    config = dict(DEFAULT_LEASE)
+    config.update(getattr(settings, "BUILD_LEASE", {}))
+    return config
+
+
+def make_owner_id():
+    """Unique per poller run: host, process and a random suffix"""
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+def acquire_lease(job_name, build_number, owner):
+    """Take the build if it is free or its owner stopped heartbeating.
+
+    Returns the lease (with .taken_over_from set when a dead owner was
+    replaced) or None while another live owner holds it.
+    """
+    ttl = timedelta(seconds=get_lease_config()["ttl"])
+    now = timezone.now()
+    with transaction.atomic():
+        lease, created = BuildLease.objects.select_for_update().get_or_create(
+            job_name=job_name,
+            build_number=build_number,
+            defaults={"owner": owner, "acquired_at": now, "heartbeat_at": now, "expires_at": now + ttl},
+        )
+        lease.taken_over_from = None
+        if created:
+            return lease
+        if lease.owner != owner and lease.expires_at > now:
+            return None
+
+        if lease.owner != owner:
+            lease.taken_over_from = lease.owner
+            logger.warning(f"Taking over {job_name} #{build_number} from expired owner {lease.owner}")
+        lease.owner = owner
+        lease.acquired_at = now
+        lease.heartbeat_at = now
+        lease.expires_at = now + ttl
+        lease.save()
+        return lease
+
+
+def resume_offset(lease, stored_size):
+    """Jenkins offset to continue from.
+
+    Jenkins returns the same bytes for the same offset, so anything the
+    previous owner stored after its last checkpoint is skipped rather
+    than fetched and appended twice.
+    """
+    return lease.log_offset + max(0, stored_size - lease.stored_size)
+
+
+def heartbeat(lease, log_offset, stored_size):
+    """Extend the lease and checkpoint offsets. False means we lost it."""
+    now = timezone.now()
+    ttl = timedelta(seconds=get_lease_config()["ttl"])
+    updated = BuildLease.objects.filter(id=lease.id, owner=lease.owner).update(
+        heartbeat_at=now, expires_at=now + ttl, log_offset=log_offset, stored_size=stored_size,
+    )
+    if updated:
+        lease.log_offset = log_offset
+        lease.stored_size = stored_size
+    return updated == 1
+
+
+def release_lease(lease):
+    BuildLease.objects.filter(id=lease.id, owner=lease.owner).delete()
+
+
+def hand_over_lease(lease, log_offset, stored_size):
+    """Checkpoint and expire the lease so the next owner resumes at once"""
+    BuildLease.objects.filter(id=lease.id, owner=lease.owner).update(
+        expires_at=timezone.now(), log_offset=log_offset, stored_size=stored_size,
+    )
@@ -0,0 +1,874 @@
+import os
+import json
+import mmap
+import zlib
+import struct
+import bisect
+import shutil
+import sqlite3
+import hashlib
+import logging
+import threading
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import boto3
+except ImportError:  # only needed for the "s3" object store
+    boto3 = None
+
+logger = logging.getLogger("jenkins_worker")
+
+TAIL_BLOCK_SIZE = 64 * 1024
+STREAM_CHUNK_SIZE = 256 * 1024
+
+
+def find_tail_start(read_range, size, last_lines):
+    """Offset where the last N lines start, reading backwards in blocks"""
+    newlines = 0
+    end = size
+    while end > 0:
+        start = max(0, end - TAIL_BLOCK_SIZE)
+        block = read_range(start, end)
+        pos = len(block)
+        while True:
+            pos = block.rfind(b"\n", 0, pos)
+            if pos == -1:
+                break
+            newlines += 1
+            if newlines > last_lines:
+                return start + pos + 1
+        end = start
+    return 0
+
+
+class LogBackend:
+    """Where the raw console bytes of a build live.
+
+    build_path_func maps (job_name, build_number) to the build directory,
+    the one get_build_path returns. Offsets are raw log byte offsets.
+    """
+
+    name = None
+    # fnmatch patterns of the build directory entries holding the log itself
+    log_files = ()
+
+    def __init__(self, build_path_func):
+        self.build_path_func = build_path_func
+
+    def exists(self, job_name, build_number):
+        raise NotImplementedError
+
+    def size(self, job_name, build_number):
+        raise NotImplementedError
+
+    def append(self, job_name, build_number, data):
+        """Append bytes, return the offset they were written at"""
+        raise NotImplementedError
+
+    def read_range(self, job_name, build_number, start, end):
+        raise NotImplementedError
+
+    def truncate(self, job_name, build_number, size):
+        """Cut the log to its first size bytes"""
+        raise NotImplementedError
+
+    def finalize(self, job_name, build_number):
+        """Called once the build finished and no more data will be appended"""
+
+    def delete(self, job_name, build_number):
+        """Remove anything the backend keeps outside the build directory"""
+
+    def external_size(self, job_name, build_number):
+        """Bytes the backend keeps for this build outside the build directory"""
+        return 0
+
+    def tail(self, job_name, build_number, last_lines):
+        size = self.size(job_name, build_number)
+        read = lambda start, end: self.read_range(job_name, build_number, start, end)
+        return read(find_tail_start(read, size, last_lines), size)
+
+    def iter_range(self, job_name, build_number, start=0, end=None, chunk_size=STREAM_CHUNK_SIZE):
+        """Yield the log in bounded chunks, for streaming responses"""
+        end = self.size(job_name, build_number) if end is None else end
+        pos = start
+        while pos < end:
+            chunk = self.read_range(job_name, build_number, pos, min(end, pos + chunk_size))
+            if not chunk:
+                break
+            yield chunk
+            pos += len(chunk)
+
+
+class FileLogBackend(LogBackend):
+    """One growing full.log per build (the original layout)"""
+
+    name = "file"
+    log_files = ("full.log",)
+
+    def path(self, job_name, build_number):
+        return os.path.join(self.build_path_func(job_name, build_number), "full.log")
+
+    def exists(self, job_name, build_number):
+        return os.path.exists(self.path(job_name, build_number))
+
+    def size(self, job_name, build_number):
+        try:
+            return os.path.getsize(self.path(job_name, build_number))
+        except FileNotFoundError:
+            return 0
+
+    def append(self, job_name, build_number, data):
+        with open(self.path(job_name, build_number), "ab") as f:
+            start_offset = f.tell()
+            f.write(data)
+        return start_offset
+
+    def read_range(self, job_name, build_number, start, end):
+        with open(self.path(job_name, build_number), "rb") as f:
+            f.seek(start)
+            return f.read(max(0, end - start))
+
+    def truncate(self, job_name, build_number, size):
+        with open(self.path(job_name, build_number), "r+b") as f:
+            f.truncate(size)
+
+
+class SegmentedLogBackend(LogBackend):
+    """Fixed-size segment files: segments/000000.log, 000001.log, ...
+
+    Full segments never change again, so they can be read in parallel,
+    memory-mapped and moved to another tier. segments.json records the
+    segment size (so changing the setting never breaks old builds) and
+    the total length.
+    """
+
+    name = "segmented"
+    log_files = ("segments", "segments.json")
+
+    def __init__(self, build_path_func, segment_size=8 * 1024 * 1024, read_workers=4):
+        super().__init__(build_path_func)
+        self.segment_size = segment_size
+        self.read_workers = read_workers
+
+    def segments_dir(self, job_name, build_number):
+        return os.path.join(self.build_path_func(job_name, build_number), "segments")
+
+    def segment_path(self, job_name, build_number, index):
+        return os.path.join(self.segments_dir(job_name, build_number), f"{index:06d}.log")
+
+    def manifest_path(self, job_name, build_number):
+        return os.path.join(self.build_path_func(job_name, build_number), "segments.json")
+
+    def load_manifest(self, job_name, build_number):
+        try:
+            with open(self.manifest_path(job_name, build_number), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {"segment_size": self.segment_size, "size": 0, "remote": []}
+
+    def save_manifest(self, job_name, build_number, manifest):
+        path = self.manifest_path(job_name, build_number)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, path)
+
+    def exists(self, job_name, build_number):
+        return os.path.exists(self.manifest_path(job_name, build_number))
+
+    def size(self, job_name, build_number):
+        return self.load_manifest(job_name, build_number)["size"]
+
+    def append(self, job_name, build_number, data):
+        manifest = self.load_manifest(job_name, build_number)
+        segment_size = manifest["segment_size"]
+        start_offset = manifest["size"]
+        os.makedirs(self.segments_dir(job_name, build_number), exist_ok=True)
+
+        pos = 0
+        offset = start_offset
+        while pos < len(data):
+            index, within = divmod(offset, segment_size)
+            take = min(len(data) - pos, segment_size - within)
+            with open(self.segment_path(job_name, build_number, index), "ab") as f:
+                f.write(data[pos:pos + take])
+            pos += take
+            offset += take
+
+        manifest["size"] = offset
+        self.save_manifest(job_name, build_number, manifest)
+        return start_offset
+
+    def truncate(self, job_name, build_number, size):
+        manifest = self.load_manifest(job_name, build_number)
+        segment_size = manifest["segment_size"]
+        last = -(-manifest["size"] // segment_size)
+        for index in range(-(-size // segment_size), last):
+            if index in manifest["remote"]:
+                raise ValueError(f"Cannot truncate offloaded segment {index} of {job_name} #{build_number}")
+            os.remove(self.segment_path(job_name, build_number, index))
+        if size % segment_size:
+            with open(self.segment_path(job_name, build_number, size // segment_size), "r+b") as f:
+                f.truncate(size % segment_size)
+        manifest["size"] = min(size, manifest["size"])
+        self.save_manifest(job_name, build_number, manifest)
+
+    def open_segment(self, job_name, build_number, index, manifest):
+        """Open a segment for reading (subclasses fetch remote ones)"""
+        return open(self.segment_path(job_name, build_number, index), "rb")
+
+    def _read_segment(self, job_name, build_number, index, start, end, manifest):
+        with self.open_segment(job_name, build_number, index, manifest) as f:
+            if end - start < TAIL_BLOCK_SIZE:
+                f.seek(start)
+                return f.read(end - start)
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                return mapped[start:end]
+
+    def read_range(self, job_name, build_number, start, end):
+        manifest = self.load_manifest(job_name, build_number)
+        segment_size = manifest["segment_size"]
+        end = min(end, manifest["size"])
+        if start >= end:
+            return b""
+
+        parts = []
+        for index in range(start // segment_size, (end - 1) // segment_size + 1):
+            seg_start = index * segment_size
+            parts.append((index, max(start, seg_start) - seg_start, min(end, seg_start + segment_size) - seg_start))
+
+        if len(parts) == 1 or self.read_workers <= 1:
+            return b"".join(self._read_segment(job_name, build_number, i, s, e, manifest) for i, s, e in parts)
+
+        with ThreadPoolExecutor(max_workers=min(self.read_workers, len(parts))) as pool:
+            chunks = pool.map(lambda p: self._read_segment(job_name, build_number, p[0], p[1], p[2], manifest), parts)
+            return b"".join(chunks)
+
+
+class FilesystemObjectStore:
+    """Object store stand-in backed by a local directory"""
+
+    def __init__(self, root):
+        self.root = root
+
+    def _path(self, key):
+        return os.path.join(self.root, key)
+
+    def put_file(self, key, path):
+        target = self._path(key)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        tmp_path = target + ".tmp"
+        shutil.copyfile(path, tmp_path)
+        os.replace(tmp_path, target)
+
+    def get_file(self, key, path):
+        shutil.copyfile(self._path(key), path)
+
+    def delete_prefix(self, prefix):
+        shutil.rmtree(self._path(prefix), ignore_errors=True)
+
+
+class S3ObjectStore:
+    """S3-compatible store (AWS, MinIO, ...)"""
+
+    def __init__(self, bucket, prefix="", **client_kwargs):
+        if boto3 is None:
+            raise RuntimeError("boto3 is required for the s3 object store")
+        self.bucket = bucket
+        self.prefix = prefix
+        self.client = boto3.client("s3", **client_kwargs)
+
+    def put_file(self, key, path):
+        self.client.upload_file(path, self.bucket, self.prefix + key)
+
+    def get_file(self, key, path):
+        self.client.download_file(self.bucket, self.prefix + key, path)
+
+    def delete_prefix(self, prefix):
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix + prefix):
+            keys = [{"Key": obj["Key"]} for obj in page.get("Contents", [])]
+            if keys:
+                self.client.delete_objects(Bucket=self.bucket, Delete={"Objects": keys})
+
+
+class SegmentCache:
+    """Size-bounded LRU cache of remote segments on local disk.
+
+    Entry sizes and their LRU order are kept in memory, so hits and misses
+    never walk the cache directory. Entries left by an earlier process are
+    picked up once, oldest mtime first, the first time the cache is used.
+    """
+
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = None  # key -> size, least recently used first
+        self.total = 0
+
+    def path(self, key):
+        return os.path.join(self.root, key)
+
+    def _load(self):
+        """Index what is already on disk (called with the lock held)"""
+        found = []
+        for root, _dirs, files in os.walk(self.root):
+            for name in files:
+                if name.endswith(".tmp"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                found.append((st.st_mtime, os.path.relpath(path, self.root), st.st_size))
+        found.sort()
+        self.entries = OrderedDict((key, size) for _mtime, key, size in found)
+        self.total = sum(self.entries.values())
+
+    def open(self, key):
+        """Open a cached entry, None on a miss"""
+        try:
+            f = open(self.path(key), "rb")
+        except FileNotFoundError:
+            with self.lock:
+                if self.entries is not None and key in self.entries:
+                    self.total -= self.entries.pop(key)
+            return None
+        os.utime(f.fileno())  # carries the LRU order over to the next process
+        with self.lock:
+            if self.entries is None:
+                self._load()
+            if key in self.entries:
+                self.entries.move_to_end(key)
+            else:
+                self.entries[key] = os.fstat(f.fileno()).st_size
+                self.total += self.entries[key]
+        return f
+
+    def put(self, key, fetch):
+        """Fill the entry with fetch(tmp_path), evict old entries, return it opened.
+
+        The file is opened before eviction runs, so the caller can read it
+        even if the cache is smaller than the range being read.
+        """
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        fetch(tmp_path)
+        os.replace(tmp_path, path)
+        f = open(path, "rb")
+        with self.lock:
+            if self.entries is None:
+                self._load()
+            self.total -= self.entries.pop(key, 0)
+            self.entries[key] = os.fstat(f.fileno()).st_size
+            self.total += self.entries[key]
+            self.evict()
+        return f
+
+    def evict(self):
+        """Drop least recently used entries until the cache fits (called with the lock held)"""
+        while self.total > self.max_bytes and self.entries:
+            key, size = self.entries.popitem(last=False)
+            self.total -= size
+            try:
+                os.remove(self.path(key))
+            except FileNotFoundError:
+                pass
+
+
+class TieredLogBackend(SegmentedLogBackend):
+    """Segmented logs whose cold segments live in an object store.
+
+    Full segments of finished builds are uploaded on finalize() (and by
+    offload()) and removed from the build directory; reads fetch them
+    back through the LRU SegmentCache.
+    """
+
+    name = "tiered"
+
+    def __init__(self, build_path_func, store, cache, **kwargs):
+        super().__init__(build_path_func, **kwargs)
+        self.store = store
+        self.cache = cache
+
+    def object_key(self, job_name, build_number, index):
+        return f"{job_name}/{build_number}/{index:06d}.log"
+
+    def open_segment(self, job_name, build_number, index, manifest):
+        if index not in manifest["remote"]:
+            return open(self.segment_path(job_name, build_number, index), "rb")
+        key = self.object_key(job_name, build_number, index)
+        return self.cache.open(key) or self.cache.put(key, lambda tmp: self.store.get_file(key, tmp))
+
+    def offload(self, job_name, build_number, include_last=False):
+        """Move full segments to the object store, returns how many moved"""
+        manifest = self.load_manifest(job_name, build_number)
+        segment_count = -(-manifest["size"] // manifest["segment_size"])
+        last = segment_count if include_last else manifest["size"] // manifest["segment_size"]
+        moved = 0
+        for index in range(last):
+            if index in manifest["remote"]:
+                continue
+            path = self.segment_path(job_name, build_number, index)
+            self.store.put_file(self.object_key(job_name, build_number, index), path)
+            manifest["remote"].append(index)
+            self.save_manifest(job_name, build_number, manifest)
+            os.remove(path)
+            moved += 1
+        return moved
+
+    def finalize(self, job_name, build_number):
+        try:
+            self.offload(job_name, build_number, include_last=True)
+        except Exception as e:
+            logger.exception(f"Offloading segments of {job_name} #{build_number} failed: {e}")
+
+    def delete(self, job_name, build_number):
+        self.store.delete_prefix(f"{job_name}/{build_number}/")
+
+    def external_size(self, job_name, build_number):
+        """Bytes of the offloaded segments"""
+        manifest = self.load_manifest(job_name, build_number)
+        segment_size = manifest["segment_size"]
+        return sum(min(segment_size, manifest["size"] - index * segment_size) for index in manifest["remote"])
+
+
+def chunk_boundaries(data, min_size, avg_size, max_size):
+    """Content-defined cut points (chunk ends) in data, what follows the last one is left over.
+
+    Chunks end at line ends: after a line once the chunk has min_size bytes,
+    when crc32(line) % avg_size < len(line), so about every avg_size bytes
+    whatever the line lengths. A cut depends only on the line before it, so
+    an insertion or a changed line moves the boundaries next to it and the
+    chunks after it are the same again. A chunk never exceeds max_size,
+    over-long lines are cut at max_size steps.
+    """
+    cuts = []
+    chunk_start = 0
+    pos = 0
+    size = len(data)
+    view = memoryview(data)
+    while pos < size:
+        newline = data.find(b"\n", pos)
+        end = size if newline == -1 else newline + 1
+        if end - chunk_start > max_size:
+            if pos > chunk_start:
+                cuts.append(pos)
+                chunk_start = pos
+            while end - chunk_start > max_size:
+                chunk_start += max_size
+                cuts.append(chunk_start)
+        if newline == -1:
+            break  # the line is not complete yet
+        if end - chunk_start >= min_size and zlib.crc32(view[pos:end]) % avg_size < end - pos:
+            cuts.append(end)
+            chunk_start = end
+        pos = end
+    return cuts
+
+
+class ChunkStore:
+    """Content-addressed chunks on local disk, shared by all builds.
+
+    A chunk is stored once as <root>/<digest[:2]>/<digest>, refs.sqlite3
+    counts the references of the build manifests to it; the file goes
+    away with the last reference. sqlite serializes the ref count changes
+    of concurrent pollers, a chunk file is (re)written after its reference
+    is counted, so a release running at the same time cannot remove it
+    from under a new reference.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.db_path = os.path.join(root, "refs.sqlite3")
+        self._local = threading.local()
+
+    @staticmethod
+    def digest(data):
+        return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+    def path(self, digest):
+        return os.path.join(self.root, digest[:2], digest)
+
+    def _db(self):
+        # one connection per thread and process (workers fork after import)
+        db = getattr(self._local, "db", None)
+        if db is None or self._local.pid != os.getpid():
+            os.makedirs(self.root, exist_ok=True)
+            db = sqlite3.connect(self.db_path, timeout=60, isolation_level=None)
+            db.execute("CREATE TABLE IF NOT EXISTS chunks (digest TEXT PRIMARY KEY, size INTEGER NOT NULL, refs INTEGER NOT NULL)")
+            self._local.db = db
+            self._local.pid = os.getpid()
+        return db
+
+    def add(self, chunks):
+        """Reference [(digest, data), ...] once per entry, storing the chunks not stored yet"""
+        if not chunks:
+            return
+        refs = Counter(digest for digest, _data in chunks)
+        sizes = {digest: len(data) for digest, data in chunks}
+        db = self._db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            db.executemany(
+                "INSERT INTO chunks (digest, size, refs) VALUES (?, ?, ?) "
+                "ON CONFLICT (digest) DO UPDATE SET refs = refs + excluded.refs",
+                [(digest, sizes[digest], count) for digest, count in refs.items()])
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        written = set()
+        for digest, data in chunks:
+            if digest in written:
+                continue
+            written.add(digest)
+            path = self.path(digest)
+            if os.path.exists(path):
+                continue
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+
+    def release(self, digests):
+        """Drop one reference per entry, returns the bytes freed"""
+        refs = Counter(digests)
+        if not refs:
+            return 0
+        freed = 0
+        db = self._db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            db.executemany("UPDATE chunks SET refs = refs - ? WHERE digest = ?",
+                           [(count, digest) for digest, count in refs.items()])
+            unused = []
+            digests = list(refs)
+            for start in range(0, len(digests), 500):
+                batch = digests[start:start + 500]
+                unused += db.execute(
+                    f"SELECT digest, size FROM chunks WHERE refs <= 0 AND digest IN ({','.join('?' * len(batch))})",
+                    batch).fetchall()
+            for digest, size in unused:
+                try:
+                    os.remove(self.path(digest))
+                except FileNotFoundError:
+                    pass
+                freed += size
+            db.executemany("DELETE FROM chunks WHERE digest = ?", [(digest,) for digest, _size in unused])
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        return freed
+
+    def share(self, digests):
+        """Bytes attributable to one reference per entry: each chunk's size split over its references"""
+        refs = Counter(digests)
+        digests = list(refs)
+        total = 0.0
+        db = self._db()
+        for start in range(0, len(digests), 500):
+            batch = digests[start:start + 500]
+            for digest, size, count in db.execute(
+                    f"SELECT digest, size, refs FROM chunks WHERE refs > 0 AND digest IN ({','.join('?' * len(batch))})",
+                    batch):
+                total += size * refs[digest] / count
+        return int(total)
+
+    def read(self, digest, start=0, end=None):
+        with open(self.path(digest), "rb") as f:
+            if start:
+                f.seek(start)
+            return f.read() if end is None else f.read(end - start)
+
+    def stats(self):
+        chunks, stored, referenced = self._db().execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(size * refs), 0) FROM chunks").fetchone()
+        return {"chunks": chunks, "stored_bytes": stored, "referenced_bytes": referenced}
+
+
+# chunks.idx records: end offset of the chunk in the log (cumulative), raw digest
+CHUNK_RECORD = struct.Struct("<Q16s")
+
+
+class ChunkIndex:
+    """The first count records of chunks.idx, memory-mapped.
+
+    A sequence of chunk end offsets for bisect, records are unpacked
+    only when probed.
+    """
+
+    def __init__(self, path, count):
+        self.count = count
+        self.data = b""
+        if count:
+            with open(path, "rb") as f:
+                self.data = mmap.mmap(f.fileno(), count * CHUNK_RECORD.size, access=mmap.ACCESS_READ)
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        if not 0 <= i < self.count:
+            raise IndexError(i)
+        return CHUNK_RECORD.unpack_from(self.data, i * CHUNK_RECORD.size)[0]
+
+    def chunk(self, i):
+        """(digest, start, end) of chunk i in the log"""
+        end, digest = CHUNK_RECORD.unpack_from(self.data, i * CHUNK_RECORD.size)
+        start = CHUNK_RECORD.unpack_from(self.data, (i - 1) * CHUNK_RECORD.size)[0] if i else 0
+        return digest.hex(), start, end
+
+    def chunks(self, first=0):
+        """(digest, length) of the chunks from first on"""
+        start = self[first - 1] if first else 0
+        for end, digest in CHUNK_RECORD.iter_unpack(self.data[first * CHUNK_RECORD.size:]):
+            yield digest.hex(), end - start
+            start = end
+
+    def close(self):
+        if self.count:
+            self.data.close()
+
+
+class DedupLogBackend(LogBackend):
+    """Logs split into content-defined chunks, each unique chunk stored once.
+
+    Reruns of a job share most of their output (checkout, dependency
+    install, the same tests), those chunks are stored once in the
+    ChunkStore. The build directory keeps chunks.idx, an append-only list
+    of (end offset, digest) records of the log in order, chunks.json with
+    the sizes and how many of those records are valid, and
+    pending-NNNNNN.log, the bytes after the last cut (at most max_size),
+    which become the last chunk on finalize(). Appends write only the new
+    records, reads bisect the records for the chunks a range covers.
+    """
+
+    name = "dedup"
+    log_files = ("chunks.json", "chunks.idx", "pending-*.log")
+
+    def __init__(self, build_path_func, store, min_size=4 * 1024, avg_size=16 * 1024, max_size=64 * 1024):
+        super().__init__(build_path_func)
+        self.store = store
+        self.min_size = min_size
+        self.avg_size = avg_size
+        self.max_size = max_size
+
+    def manifest_path(self, job_name, build_number):
+        return os.path.join(self.build_path_func(job_name, build_number), "chunks.json")
+
+    def index_path(self, job_name, build_number):
+        return os.path.join(self.build_path_func(job_name, build_number), "chunks.idx")
+
+    def pending_path(self, job_name, build_number, manifest):
+        # named after the chunk count: a new pending file is only used once the manifest points to it
+        return os.path.join(self.build_path_func(job_name, build_number), f"pending-{manifest['count']:06d}.log")
+
+    def load_manifest(self, job_name, build_number):
+        try:
+            with open(self.manifest_path(job_name, build_number), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            # chunk sizes are recorded so changing the settings never re-cuts a running build
+            return {"min_size": self.min_size, "avg_size": self.avg_size, "max_size": self.max_size,
+                    "size": 0, "chunked": 0, "count": 0}
+
+    def save_manifest(self, job_name, build_number, manifest):
+        path = self.manifest_path(job_name, build_number)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, separators=(",", ":"))
+        os.replace(tmp_path, path)
+
+    def open_index(self, job_name, build_number, manifest):
+        return ChunkIndex(self.index_path(job_name, build_number), manifest["count"])
+
+    def _write_index(self, job_name, build_number, first, start, chunks):
+        """Write [(digest, length)] as records first, ... of chunks starting at log offset start.
+
+        They count once the manifest is saved, records past the count are left
+        over from a crash or a truncate and get overwritten. The file never
+        shrinks under a reader's mmap.
+        """
+        end = start
+        records = []
+        for digest, length in chunks:
+            end += length
+            records.append(CHUNK_RECORD.pack(end, bytes.fromhex(digest)))
+        fd = os.open(self.index_path(job_name, build_number), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            os.pwrite(fd, b"".join(records), first * CHUNK_RECORD.size)
+        finally:
+            os.close(fd)
+
+    def chunk_list(self, job_name, build_number):
+        """[(digest, length)] of the chunked part of the log"""
+        index = self.open_index(job_name, build_number, self.load_manifest(job_name, build_number))
+        try:
+            return list(index.chunks())
+        finally:
+            index.close()
+
+    def _read_pending(self, job_name, build_number, manifest):
+        length = manifest["size"] - manifest["chunked"]
+        if not length:
+            return b""
+        with open(self.pending_path(job_name, build_number, manifest), "rb") as f:
+            return f.read(length)
+
+    def _write_pending(self, job_name, build_number, manifest, data):
+        path = self.pending_path(job_name, build_number, manifest)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def _remove_pending(self, job_name, build_number, manifest):
+        try:
+            os.remove(self.pending_path(job_name, build_number, manifest))
+        except FileNotFoundError:
+            pass
+
+    def exists(self, job_name, build_number):
+        return os.path.exists(self.manifest_path(job_name, build_number))
+
+    def size(self, job_name, build_number):
+        return self.load_manifest(job_name, build_number)["size"]
+
+    def _add_chunks(self, job_name, build_number, manifest, data, cuts):
+        pieces = []
+        start = 0
+        for end in cuts:
+            piece = data[start:end]
+            pieces.append((self.store.digest(piece), piece))
+            start = end
+        self.store.add(pieces)
+        self._write_index(job_name, build_number, manifest["count"], manifest["chunked"],
+                          [(digest, len(piece)) for digest, piece in pieces])
+        manifest["count"] += len(pieces)
+        manifest["chunked"] += start
+
+    def append(self, job_name, build_number, data):
+        manifest = self.load_manifest(job_name, build_number)
+        start_offset = manifest["size"]
+        buffered = self._read_pending(job_name, build_number, manifest) + data
+        cuts = chunk_boundaries(buffered, manifest["min_size"], manifest["avg_size"], manifest["max_size"])
+        old_manifest = dict(manifest)
+        if cuts:
+            self._add_chunks(job_name, build_number, manifest, buffered, cuts)
+        manifest["size"] = start_offset + len(data)
+        self._write_pending(job_name, build_number, manifest, buffered[cuts[-1]:] if cuts else buffered)
+        self.save_manifest(job_name, build_number, manifest)
+        if cuts:
+            self._remove_pending(job_name, build_number, old_manifest)
+        return start_offset
+
+    def truncate(self, job_name, build_number, size):
+        manifest = self.load_manifest(job_name, build_number)
+        if size >= manifest["size"]:
+            return
+        old_manifest = dict(manifest)
+        if size >= manifest["chunked"]:
+            pending = self._read_pending(job_name, build_number, manifest)[:size - manifest["chunked"]]
+            released = []
+        else:
+            index = self.open_index(job_name, build_number, manifest)
+            try:
+                cut = bisect.bisect_right(index, size)
+                digest, chunk_start, _end = index.chunk(cut)
+                released = [digest for digest, _length in index.chunks(cut)]
+            finally:
+                index.close()
+            # the kept part of the chunk the cut falls into is pending again
+            pending = self.store.read(digest, 0, size - chunk_start)
+            manifest["count"] = cut
+            manifest["chunked"] = chunk_start
+        manifest["size"] = size
+        self._write_pending(job_name, build_number, manifest, pending)
+        self.save_manifest(job_name, build_number, manifest)
+        if old_manifest["count"] != manifest["count"]:
+            self._remove_pending(job_name, build_number, old_manifest)
+        # references are dropped last: a crash in between leaks a reference, never loses a chunk
+        self.store.release(released)
+
+    def _pieces(self, index, manifest, start, end):
+        """(digest or None for pending, start, end within the piece) covering [start, end)"""
+        i = bisect.bisect_right(index, start)
+        pos = start
+        while pos < end and i < len(index):
+            digest, chunk_start, chunk_end = index.chunk(i)
+            take_end = min(end, chunk_end)
+            yield digest, pos - chunk_start, take_end - chunk_start
+            pos = take_end
+            i += 1
+        if pos < end:
+            yield None, pos - manifest["chunked"], end - manifest["chunked"]
+
+    def _read_piece(self, job_name, build_number, manifest, digest, start, end):
+        if digest is not None:
+            return self.store.read(digest, start, end)
+        with open(self.pending_path(job_name, build_number, manifest), "rb") as f:
+            f.seek(start)
+            return f.read(end - start)
+
+    def read_range(self, job_name, build_number, start, end):
+        manifest = self.load_manifest(job_name, build_number)
+        end = min(end, manifest["size"])
+        if start >= end:
+            return b""
+        index = self.open_index(job_name, build_number, manifest)
+        try:
+            return b"".join(self._read_piece(job_name, build_number, manifest, digest, s, e)
+                            for digest, s, e in self._pieces(index, manifest, start, end))
+        finally:
+            index.close()
+
+    def iter_range(self, job_name, build_number, start=0, end=None, chunk_size=STREAM_CHUNK_SIZE):
+        # one manifest load for the whole stream, batched to about chunk_size
+        manifest = self.load_manifest(job_name, build_number)
+        end = manifest["size"] if end is None else min(end, manifest["size"])
+        index = self.open_index(job_name, build_number, manifest)
+        try:
+            batch = []
+            batched = 0
+            for digest, s, e in self._pieces(index, manifest, start, end):
+                batch.append(self._read_piece(job_name, build_number, manifest, digest, s, e))
+                batched += e - s
+                if batched >= chunk_size:
+                    yield b"".join(batch)
+                    batch = []
+                    batched = 0
+            if batch:
+                yield b"".join(batch)
+        finally:
+            index.close()
+
+    def finalize(self, job_name, build_number):
+        """The pending bytes become the last chunk"""
+        manifest = self.load_manifest(job_name, build_number)
+        if manifest["size"] == manifest["chunked"]:
+            return
+        old_manifest = dict(manifest)
+        pending = self._read_pending(job_name, build_number, manifest)
+        self._add_chunks(job_name, build_number, manifest, pending, [len(pending)])
+        self.save_manifest(job_name, build_number, manifest)
+        self._remove_pending(job_name, build_number, old_manifest)
+
+    def delete(self, job_name, build_number):
+        """Drop the build's chunk references (the build directory is removed by the caller)"""
+        released = [digest for digest, _length in self.chunk_list(job_name, build_number)]
+        if not released:
+            return
+        manifest = self.load_manifest(job_name, build_number)
+        self.save_manifest(job_name, build_number, dict(manifest, size=0, chunked=0, count=0))
+        self.store.release(released)
+
+    def external_size(self, job_name, build_number):
+        """The build's share of the chunk store, shared chunks split over the builds using them"""
+        return self.store.share(digest for digest, _length in self.chunk_list(job_name, build_number))
@@ -0,0 +1,223 @@
+import os
+import json
+import fnmatch
+
+from django.conf import settings
+
+from .log_backends import find_tail_start, STREAM_CHUNK_SIZE
+
+DEFAULT_LOG_SIZE_LIMIT = {
+    "max_bytes": None,                        # cap logs above this, None = keep everything
+    "head_bytes": 16 * 1024 * 1024,           # kept from the start of a capped log
+    "tail_bytes": 16 * 1024 * 1024,           # at least this much of the end is kept
+    "tail_segment_bytes": 4 * 1024 * 1024,    # ring segment size, the tail drops one at a time
+    "jobs": {},                               # {"job-name-pattern": {overrides}}, first match wins
+}
+
+# Shown in place of the dropped range when a capped log is read
+DROPPED_MARKER = "\n[... {dropped} bytes ({start}-{end}) dropped by the log size limit ...]\n"
+
+
+def get_size_policy(job_name):
+    config = dict(DEFAULT_LOG_SIZE_LIMIT)
+    config.update(getattr(settings, "LOG_SIZE_LIMIT", {}))
+    for pattern, overrides in config.pop("jobs").items():
+        if fnmatch.fnmatchcase(job_name, pattern):
+            config.update(overrides)
+            break
+    return config
+
+
+class CappedLog:
+    """A log over its size limit: the head stays in the log backend, the end
+    lives in ring segments under tail/ and everything in between is dropped.
+
+    Offsets stay logical (bytes ingested so far), so Jenkins offsets,
+    stage offsets and lease checkpoints do not change meaning. cap.json:
+    head, tail_start (first kept tail byte), size and segment_size.
+    """
+
+    def __init__(self, backend, job_name, build_number, build_path):
+        self.backend = backend
+        self.job_name = job_name
+        self.build_number = build_number
+        self.state_path = os.path.join(build_path, "cap.json")
+        self.tail_dir = os.path.join(build_path, "tail")
+        self.state = self.load_state()
+
+    def load_state(self):
+        try:
+            with open(self.state_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def save_state(self):
+        tmp_path = self.state_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.state, f)
+        os.replace(tmp_path, self.state_path)
+
+    @property
+    def capped(self):
+        return self.state is not None
+
+    def size(self):
+        return self.state["size"] if self.state else self.backend.size(self.job_name, self.build_number)
+
+    def dropped_range(self):
+        """(start, end) of the dropped bytes, None while nothing was dropped"""
+        if not self.state or self.state["tail_start"] <= self.state["head"]:
+            return None
+        return self.state["head"], self.state["tail_start"]
+
+    def stream_size(self):
+        """Length of iter_range() over the whole log (the marker replaces the dropped range)"""
+        dropped = self.dropped_range()
+        if not dropped:
+            return self.size()
+        head, tail_start = dropped
+        marker = DROPPED_MARKER.format(dropped=tail_start - head, start=head, end=tail_start).encode()
+        return self.size() - (tail_start - head) + len(marker)
+
+    # ---- Writing ----
+    def append(self, data, policy):
+        """Append at the end, return the logical offset data starts at"""
+        if not self.state:
+            size = self.backend.size(self.job_name, self.build_number)
+            if not policy["max_bytes"] or size + len(data) <= policy["max_bytes"]:
+                return self.backend.append(self.job_name, self.build_number, data)
+            self._start_capping(size, policy)
+            if size < self.state["head"]:
+                take = self.state["head"] - size
+                self.backend.append(self.job_name, self.build_number, data[:take])
+                self.state["size"] = size + len(data[:take])
+                self._write_tail(data[take:])
+                return size
+
+        start_offset = self.state["size"]
+        self._write_tail(data)
+        return start_offset
+
+    def _start_capping(self, size, policy):
+        head = min(policy["head_bytes"], policy["max_bytes"])
+        self.state = {
+            "head": head,
+            "tail_start": max(head, size - policy["tail_bytes"]),
+            "size": max(head, size),
+            "segment_size": policy["tail_segment_bytes"],
+            "tail_bytes": policy["tail_bytes"],
+        }
+        os.makedirs(self.tail_dir, exist_ok=True)
+        if size > head:
+            # move the kept end of what is already stored to the ring, then cut the head
+            pos = self.state["tail_start"]
+            while pos < size:
+                end = min(size, pos + self.state["segment_size"])
+                self._write_segment_data(pos, self.backend.read_range(self.job_name, self.build_number, pos, end))
+                pos = end
+            self.backend.truncate(self.job_name, self.build_number, head)
+        self.save_state()
+
+    def segment_path(self, index):
+        return os.path.join(self.tail_dir, f"{index:06d}.log")
+
+    def _segment_of(self, offset):
+        return (offset - self.state["head"]) // self.state["segment_size"]
+
+    def _segment_base(self, index):
+        """Logical offset of the first byte stored in a segment file"""
+        return max(self.state["head"] + index * self.state["segment_size"], self.state["tail_start"])
+
+    def _write_segment_data(self, offset, data):
+        pos = 0
+        while pos < len(data):
+            index = self._segment_of(offset + pos)
+            seg_end = self.state["head"] + (index + 1) * self.state["segment_size"]
+            take = min(len(data) - pos, seg_end - (offset + pos))
+            with open(self.segment_path(index), "ab") as f:
+                f.write(data[pos:pos + take])
+            pos += take
+
+    def _write_tail(self, data):
+        if data:
+            self._write_segment_data(self.state["size"], data)
+            self.state["size"] += len(data)
+        # drop whole segments once the window is covered without them
+        keep_from = self.state["size"] - self.state["tail_bytes"]
+        index = self._segment_of(self.state["tail_start"])
+        while self.state["head"] + (index + 1) * self.state["segment_size"] <= keep_from:
+            try:
+                os.remove(self.segment_path(index))
+            except FileNotFoundError:
+                pass
+            index += 1
+            self.state["tail_start"] = self.state["head"] + index * self.state["segment_size"]
+        self.save_state()
+
+    # ---- Reading ----
+    def _read_tail(self, start, end):
+        parts = []
+        pos = start
+        while pos < end:
+            index = self._segment_of(pos)
+            seg_end = min(end, self.state["head"] + (index + 1) * self.state["segment_size"])
+            with open(self.segment_path(index), "rb") as f:
+                f.seek(pos - self._segment_base(index))
+                parts.append(f.read(seg_end - pos))
+            pos = seg_end
+        return b"".join(parts)
+
+    def read_range(self, start, end, exact=False):
+        """Bytes [start, end).
+
+        The dropped range reads as DROPPED_MARKER, or with exact=True as
+        newlines so the length matches (for the ingest indexes).
+        """
+        if not self.state:
+            return self.backend.read_range(self.job_name, self.build_number, start, end)
+        head, tail_start = self.state["head"], self.state["tail_start"]
+        end = min(end, self.state["size"])
+        parts = []
+        if start < head:
+            parts.append(self.backend.read_range(self.job_name, self.build_number, start, min(end, head)))
+        gap_start, gap_end = max(start, head), min(end, tail_start)
+        if gap_start < gap_end:
+            if exact:
+                parts.append(b"\n" * (gap_end - gap_start))
+            else:
+                parts.append(DROPPED_MARKER.format(dropped=tail_start - head, start=head, end=tail_start).encode())
+        if end > tail_start and max(start, tail_start) < end:
+            parts.append(self._read_tail(max(start, tail_start), end))
+        return b"".join(parts)
+
+    def iter_range(self, start=0, end=None, chunk_size=STREAM_CHUNK_SIZE):
+        """Bounded chunks; the dropped range comes out as one marker"""
+        if not self.state:
+            yield from self.backend.iter_range(self.job_name, self.build_number, start, end)
+            return
+        end = self.state["size"] if end is None else min(end, self.state["size"])
+        head, tail_start = self.state["head"], self.state["tail_start"]
+        for part_start, part_end in ((start, min(end, head)), (max(start, head), min(end, tail_start)),
+                                     (max(start, tail_start), end)):
+            if part_start >= part_end:
+                continue
+            if part_start >= head and part_end <= tail_start:
+                yield self.read_range(part_start, part_end)  # the marker
+                continue
+            pos = part_start
+            while pos < part_end:
+                chunk_end = min(part_end, pos + chunk_size)
+                yield self.read_range(pos, chunk_end)
+                pos = chunk_end
+
+    def tail(self, last_lines):
+        """Last N lines, taken from the tail window (plus the marker if it runs out)"""
+        if not self.state:
+            return self.backend.tail(self.job_name, self.build_number, last_lines)
+        tail_start, size = self.state["tail_start"], self.state["size"]
+        start = find_tail_start(lambda a, b: self._read_tail(a + tail_start, b + tail_start),
+                                size - tail_start, last_lines)
+        if start == 0 and self.dropped_range():
+            return self.read_range(self.state["head"], size)
+        return self._read_tail(tail_start + start, size)
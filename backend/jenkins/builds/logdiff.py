@@ -0,0 +1,369 @@
+import os
+import re
+from collections import deque
+from itertools import islice
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from .console import ESCAPE_RE
+from .storage import get_capped_log, get_plain_log_path, iter_plain_log
+
+DEFAULT_LOG_DIFF = {
+    "window_lines": 20000,      # lookahead per log while realigning, bounds memory with the filters below
+    "sync_lines": 3,            # equal lines in a row needed to realign after a change
+    "context_lines": 3,
+    "max_hunks": 500,           # most hunks per response (?max_hunks=)
+    "max_hunk_lines": 200,      # lines returned per side of a hunk, the counts stay exact
+    "filter_bits": 1 << 24,     # per log, only built when a change is longer than window_lines (power of two)
+}
+
+# regex, replacement; applied to plain (colour-stripped) lines before they are compared,
+# must not match across lines. The response shows the lines as they are.
+DEFAULT_DIFF_NORMALIZERS = [
+    (r"\b(?:\d{4}-\d\d-\d\d[T ])?\d{1,2}:\d\d:\d\d(?:[.,]\d+)?(?:Z|[+-]\d\d:?\d\d)?", "<time>"),
+    (r"\b[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}\b", "<uuid>"),
+    (r"\b(?=[0-9a-f]*[a-f])(?=[0-9a-f]*[0-9])[0-9a-f]{7,64}\b", "<hex>"),
+    (r"\b\d+(?:\.\d+)?\s?(?:ms|s|sec|secs|seconds?|min|mins|minutes?)\b", "<duration>"),
+    (r"/tmp/[\w.-]+", "/tmp/<tmp>"),
+    (r"#\d+\b", "#<n>"),
+]
+
+MAX_LINE_LENGTH = 2000          # longer lines are cut in the response
+MAX_LINE_BYTES = 1024 * 1024    # a line without newline longer than this is split
+NORMALIZE_BATCH = 256           # lines normalized per block, growing up to MAX_NORMALIZE_BATCH
+MAX_NORMALIZE_BATCH = 16384
+
+_compiled = None
+
+
+def get_diff_config():
+    config = dict(DEFAULT_LOG_DIFF)
+    config.update(getattr(settings, "LOG_DIFF", {}))
+    return config
+
+
+def get_normalizers():
+    global _compiled
+    if _compiled is None:
+        normalizers = getattr(settings, "LOG_DIFF_NORMALIZERS", DEFAULT_DIFF_NORMALIZERS)
+        _compiled = [(re.compile(pattern.encode("utf-8")), replacement.encode("utf-8"))
+                     for pattern, replacement in normalizers]
+    return _compiled
+
+
+@receiver(setting_changed)
+def _reset_normalizers(setting, **kwargs):
+    global _compiled
+    if setting == "LOG_DIFF_NORMALIZERS":
+        _compiled = None
+
+
+def normalize_keys(lines):
+    """Keys of the normalized lines"""
+    # the whole block goes through each regex, one C loop instead of one call per line
+    block = b"\n".join(lines)
+    for regex, replacement in get_normalizers():
+        block = regex.sub(replacement, block)
+    return list(map(hash, block.split(b"\n")))
+
+
+def _lines(data):
+    """(key, plain line) of complete lines, data ends with a newline"""
+    plain = ESCAPE_RE.sub(b"", data) if b"\x1b" in data else data
+    lines = plain.replace(b"\r", b"").split(b"\n")
+    lines.pop()
+    return zip(map(hash, lines), lines)
+
+
+def iter_lines(chunks):
+    """(key, plain line) per line of a raw log given as byte chunks.
+
+    The key is the hash of the plain line, equal keys are equal lines.
+    Lines are produced per chunk, nothing else of the log is held.
+    """
+    carry = b""
+    for chunk in chunks:
+        data = carry + chunk
+        cut = data.rfind(b"\n") + 1
+        if not cut and len(data) > MAX_LINE_BYTES:
+            cut = len(data)
+            data += b"\n"
+        carry = data[cut:]
+        if cut:
+            yield from _lines(data[:cut])
+    if carry:
+        yield from _lines(carry + b"\n")
+
+
+def build_lines(job_name, build_number):
+    """Opener of iter_lines() over a build's log for diff_lines().
+
+    plain.log has the escapes stripped already at ingest, it is used
+    unless the size limit stopped it; otherwise the raw log (with the
+    dropped range marker) is stripped here.
+    """
+    log = get_capped_log(job_name, build_number)
+    plain_path = get_plain_log_path(job_name, build_number)
+    if not log.capped and os.path.exists(plain_path):
+        return lambda: iter_lines(iter_plain_log(job_name, build_number))
+    return lambda: iter_lines(log.iter_range(0, None))
+
+
+class _ShingleFilter:
+    """Bloom filter over the keys of sync_lines consecutive lines of a whole log.
+    bits is rounded up to a power of two (positions are masked)."""
+
+    def __init__(self, bits):
+        bits = 1 << max(3, (bits - 1).bit_length())
+        self.mask = bits - 1
+        self.bits = bytearray(bits // 8)
+
+    def add(self, h):
+        for p in (h & self.mask, (h >> 32) & self.mask):
+            self.bits[p >> 3] |= 1 << (p & 7)
+
+    def __contains__(self, h):
+        for p in (h & self.mask, (h >> 32) & self.mask):
+            if not self.bits[p >> 3] & (1 << (p & 7)):
+                return False
+        return True
+
+
+class _Side:
+    """One log: a window of (plain key, line) read ahead, numbered from line_no.
+
+    Normalized keys are computed in NORMALIZE_BATCH line blocks and only
+    where they are needed: lines with equal plain keys are equal anyway,
+    so a log without per-line timestamps hardly goes through the regexes.
+    """
+
+    def __init__(self, open_lines, normalize):
+        self.open_lines = open_lines
+        self.lines = open_lines()
+        self.normalize = normalize
+        self.buf = []
+        self.norm = []      # normalized keys of the first len(norm) lines of buf
+        self.line_no = 1
+        self.done = False
+        self.filter = None
+
+    def fill(self, n):
+        if len(self.buf) < n and not self.done:
+            self.buf += islice(self.lines, n - len(self.buf))
+            self.done = len(self.buf) < n
+
+    def take(self, n):
+        taken = self.buf[:n]
+        del self.buf[:n]
+        del self.norm[:n]
+        self.line_no += len(taken)
+        return taken
+
+    def _normalize_to(self, n):
+        done = len(self.norm)
+        if n <= done:
+            return
+        if not self.normalize:
+            self.norm += [key for key, _line in self.buf[done:n]]
+            return
+        stop = min(len(self.buf), max(n, done + NORMALIZE_BATCH))
+        self.norm += normalize_keys([line for _key, line in self.buf[done:stop]])
+
+    def keys(self, n):
+        """Normalized keys of the first n lines of the window, and whether they reach the end of the log"""
+        n = min(n, len(self.buf))
+        self._normalize_to(n)
+        return self.norm[:n], self.done and n == len(self.buf)
+
+    @staticmethod
+    def shingle(keys, at_end, i, k):
+        """Key of lines i..i+k-1, shorter only at the end of the log, None if not read yet"""
+        if i + k <= len(keys):
+            return hash(tuple(keys[i:i + k]))
+        return hash(tuple(keys[i:])) if at_end else None
+
+    def shingle_filter(self, bits, k):
+        """Filter of every shingle of the log, built with a second read of it"""
+        if self.filter is None:
+            self.filter = _ShingleFilter(bits)
+            recent = deque(maxlen=k)
+            lines = self.open_lines()
+            while True:
+                batch = [line for _key, line in islice(lines, NORMALIZE_BATCH)]
+                if not batch:
+                    break
+                for key in (normalize_keys(batch) if self.normalize else map(hash, batch)):
+                    recent.append(key)
+                    if len(recent) == k:
+                        self.filter.add(hash(tuple(recent)))
+            while recent:
+                self.filter.add(hash(tuple(recent)))  # the short ones at the end
+                recent.popleft()
+        return self.filter
+
+
+def _normalized_run(a, b, limit):
+    """Lines from the start of both windows that are the same after normalization.
+
+    Goes on in growing blocks while the plain lines keep differing (per-line
+    timestamps), returns to the cheaper plain comparison once they agree.
+    """
+    common = 0
+    batch = NORMALIZE_BATCH
+    while common < limit:
+        a._normalize_to(min(limit, common + batch))
+        b._normalize_to(min(limit, common + batch))
+        stop = min(len(a.norm), len(b.norm), limit)
+        a_norm, b_norm = a.norm, b.norm
+        while common < stop and a_norm[common] == b_norm[common]:
+            common += 1
+        if common < stop or a.buf[common - 1][0] == b.buf[common - 1][0]:
+            break
+        batch = min(batch * 2, MAX_NORMALIZE_BATCH)
+    return common
+
+
+def _find_sync(a, b, k, window):
+    """(i, j) with i + j smallest so that k lines from a.buf[i] and b.buf[j] are the same, None if none"""
+    radius = 64
+    while True:
+        # most changes are short: look close first, the window only for long ones
+        ra, rb = min(radius, len(a.buf)), min(radius, len(b.buf))
+        a_keys, a_end = a.keys(ra + k)
+        b_keys, b_end = b.keys(rb + k)
+        positions = {}
+        for j in range(rb):
+            shingle = _Side.shingle(b_keys, b_end, j, k)
+            if shingle is not None:
+                positions.setdefault(shingle, j)
+        best = None
+        for i in range(ra):
+            if best is not None and i >= best[0] + best[1]:
+                break
+            j = positions.get(_Side.shingle(a_keys, a_end, i, k))
+            if j is not None and (best is None or i + j < best[0] + best[1]):
+                best = (i, j)
+        if best is not None:
+            return best
+        if (ra == len(a.buf) and rb == len(b.buf)) or radius >= window:
+            return None
+        radius *= 4
+
+
+def _unmatched_prefix(side, other_filter, k):
+    """Leading lines of side.buf whose content the other log has nowhere (up to k in a row that it has)"""
+    keys, at_end = side.keys(len(side.buf))
+    present = 0
+    for i in range(len(keys)):
+        shingle = _Side.shingle(keys, at_end, i, k)
+        if shingle is None:
+            return i - present
+        if shingle in other_filter:
+            present += 1
+            if present == k:
+                return i + 1 - present
+        else:
+            present = 0
+    return len(keys) - present
+
+
+def _text(line):
+    return line[:MAX_LINE_LENGTH].decode("utf-8", errors="replace")
+
+
+class _Hunk:
+    def __init__(self, a_start, b_start, before, max_lines):
+        self.a_start = a_start
+        self.b_start = b_start
+        self.a_lines = 0
+        self.b_lines = 0
+        self.before = [_text(line) for line in before]
+        self.removed = []
+        self.added = []
+        self.max_lines = max_lines
+
+    def add(self, removed, added):
+        self.removed += [_text(line) for _key, line in removed[:self.max_lines - len(self.removed)]]
+        self.added += [_text(line) for _key, line in added[:self.max_lines - len(self.added)]]
+        self.a_lines += len(removed)
+        self.b_lines += len(added)
+
+    def as_dict(self, after):
+        return {
+            "a_start": self.a_start,
+            "a_lines": self.a_lines,
+            "b_start": self.b_start,
+            "b_lines": self.b_lines,
+            "before": self.before,
+            "removed": self.removed,
+            "added": self.added,
+            "after": [_text(line) for _key, line in after],
+        }
+
+
+def diff_lines(open_a, open_b, config=None, context=None, normalize=True):
+    """Differing hunks between two logs, in order.
+
+    open_a / open_b return a fresh iter_lines() of each log. Both are read
+    once in step, window_lines ahead at most: equal lines are skipped, at a
+    difference the nearest point where sync_lines lines agree again closes
+    the hunk. A change longer than the window is split off using a filter
+    of all the lines of the other log (a second read, only then): lines the
+    other log does not contain at all are removed or added, so even a very
+    long change realigns. a_start / b_start are 1-based line numbers (for a
+    pure insertion a_start is the line it comes before).
+    """
+    config = config or get_diff_config()
+    window = config["window_lines"]
+    k = config["sync_lines"]
+    context = config["context_lines"] if context is None else context
+    a, b = _Side(open_a, normalize), _Side(open_b, normalize)
+    before = deque(maxlen=context)
+    hunk = None
+
+    while True:
+        a.fill(window)
+        b.fill(window)
+        common = 0
+        limit = min(len(a.buf), len(b.buf))
+        while common < limit and a.buf[common][0] == b.buf[common][0]:
+            common += 1
+        if not common and normalize:
+            # the plain lines differ, they may still be the same after normalization
+            common = _normalized_run(a, b, limit)
+        if common:
+            if hunk is not None:
+                yield hunk.as_dict(a.buf[:min(common, context)])
+                hunk = None
+            before.extend(line for _key, line in a.buf[max(0, common - context):common])
+            a.take(common)
+            b.take(common)
+            continue
+        if not a.buf and not b.buf:
+            if hunk is not None:
+                yield hunk.as_dict([])
+            return
+
+        if hunk is None:
+            hunk = _Hunk(a.line_no, b.line_no, before if context else [], config["max_hunk_lines"])
+            before.clear()
+        if not a.buf or not b.buf:
+            hunk.add(a.take(len(a.buf)), b.take(len(b.buf)))
+            continue
+        found = _find_sync(a, b, k, window)
+        if found is not None:
+            i, j = found
+            hunk.add(a.take(i), b.take(j))
+            continue
+        if a.done and b.done:
+            hunk.add(a.take(len(a.buf)), b.take(len(b.buf)))
+            continue
+        # the change is longer than the window: drop what the other log has nowhere
+        i = _unmatched_prefix(a, b.shingle_filter(config["filter_bits"], k), k)
+        j = _unmatched_prefix(b, a.shingle_filter(config["filter_bits"], k), k)
+        if not i and not j:
+            # both fronts occur further on in the other log (moved blocks): count a part as changed
+            i = j = max(k, window // 4)
+        hunk.add(a.take(i), b.take(j))
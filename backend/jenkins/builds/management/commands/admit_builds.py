@@ -0,0 +1,21 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from builds.admission import admit_waiting_builds, waiting_builds
+
+
+class Command(BaseCommand):
+    help = "Admit waiting builds within the BUILD_ADMISSION caps (also runs on start and on every finished build)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--loop", action="store_true", help="Keep admitting every --interval seconds")
+        parser.add_argument("--interval", type=float, default=10)
+
+    def handle(self, *args, **options):
+        while True:
+            admitted = admit_waiting_builds()
+            self.stdout.write(f"Admitted {len(admitted)} builds, {waiting_builds().count()} waiting")
+            if not options["loop"]:
+                break
+            time.sleep(options["interval"])
@@ -0,0 +1,52 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework.renderers import JSONRenderer
+
+from builds.models import BuildRecord
+from builds.serializers import BuildRecordSerializer
+from builds.listing import parse_fields, field_plan, iter_json_rows
+
+
+class Command(BaseCommand):
+    help = "Compare the serializer list path with the .values() fast path (same bytes, time per run)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--repeat", type=int, default=5)
+        parser.add_argument("--fields", default=None, help="Sparse fieldset, e.g. id,job_name,status")
+        parser.add_argument("--limit", type=int, default=None, help="Only the newest N builds")
+
+    def handle(self, *args, **options):
+        try:
+            fields = parse_fields(options["fields"], BuildRecordSerializer().fields)
+        except ValueError as e:
+            raise CommandError(str(e))
+        queryset = BuildRecord.objects.all().order_by('-created_at')
+        if options["limit"]:
+            queryset = queryset[:options["limit"]]
+        plan = field_plan(BuildRecordSerializer(fields=fields))
+        if plan is None:
+            raise CommandError("The serializer has fields the fast path cannot encode")
+
+        def serializer_path():
+            return JSONRenderer().render(BuildRecordSerializer(queryset, many=True, fields=fields).data)
+
+        def fast_path():
+            return b"".join(iter_json_rows(queryset, plan))
+
+        slow, fast = serializer_path(), fast_path()
+        if slow != fast:
+            raise CommandError("Outputs differ, the fast path is not byte compatible")
+
+        rows = queryset.count()
+        results = {}
+        for name, func in (("serializer", serializer_path), ("fast", fast_path)):
+            timings = []
+            for _ in range(options["repeat"]):
+                start = time.perf_counter()
+                func()
+                timings.append(time.perf_counter() - start)
+            results[name] = min(timings)
+            self.stdout.write(f"{name:>10}: {results[name] * 1000:.1f} ms for {rows} rows, {len(fast)} bytes")
+        if results["fast"]:
+            self.stdout.write(f"speedup: {results['serializer'] / results['fast']:.1f}x (identical output)")
@@ -0,0 +1,51 @@
+import os
+import sys
+import json
+import subprocess
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+# What a worker process loads: Django, the tasks module and everything it imports
+PROBE = """
+import time
+started = time.perf_counter()
+import django
+django.setup()
+import builds.tasks
+from builds.profiling import startup_stats
+import json
+print(json.dumps(startup_stats(started)))
+"""
+
+
+class Command(BaseCommand):
+    help = "Cold start time and RSS of a worker process per settings profile (each in a fresh interpreter)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--profiles", default="jenkins.settings,jenkins.settings_worker",
+                            help="Comma separated settings modules to compare")
+        parser.add_argument("--repeat", type=int, default=5)
+
+    def probe(self, settings_module):
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE=settings_module)
+        result = subprocess.run([sys.executable, "-c", PROBE], cwd=settings.BASE_DIR, env=env,
+                                capture_output=True, text=True)
+        if result.returncode != 0:
+            raise CommandError(f"{settings_module} failed to start:\n{result.stderr}")
+        return json.loads(result.stdout.strip().splitlines()[-1])
+
+    def handle(self, *args, **options):
+        results = {}
+        for settings_module in [p.strip() for p in options["profiles"].split(",") if p.strip()]:
+            runs = [self.probe(settings_module) for _ in range(options["repeat"])]
+            best = min(runs, key=lambda run: run["seconds"])
+            results[settings_module] = best
+            self.stdout.write(f"{settings_module:>28}: {best['seconds'] * 1000:7.1f} ms, "
+                              f"RSS {best['rss_bytes'] / 2**20:6.1f} MiB, {best['modules']:5d} modules, "
+                              f"apps {','.join(best['apps'])}")
+        if len(results) > 1:
+            (base_name, base), *others = results.items()
+            for name, run in others:
+                self.stdout.write(f"{name} vs {base_name}: {run['seconds'] / base['seconds']:.2f}x time, "
+                                  f"{(run['rss_bytes'] - base['rss_bytes']) / 2**20:+.1f} MiB")
@@ -0,0 +1,23 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from builds.telemetry import collect_once, get_telemetry_config
+
+
+class Command(BaseCommand):
+    help = "Sample queue length, queue waits and executor use of every Jenkins controller (JENKINS_TELEMETRY)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--loop", action="store_true", help="Keep collecting every --interval seconds")
+        parser.add_argument("--interval", type=float, default=None, help="Defaults to JENKINS_TELEMETRY['interval']")
+
+    def handle(self, *args, **options):
+        interval = options["interval"] or get_telemetry_config()["interval"]
+        while True:
+            started = time.monotonic()
+            for sample in collect_once():
+                self.stdout.write(str(sample))
+            if not options["loop"]:
+                break
+            time.sleep(max(0.0, interval - (time.monotonic() - started)))
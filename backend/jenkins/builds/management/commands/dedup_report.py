@@ -0,0 +1,131 @@
+import os
+import time
+import tempfile
+
+from django.core.management.base import BaseCommand
+
+from builds.models import BuildRecord
+from builds.log_backends import chunk_boundaries, STREAM_CHUNK_SIZE
+from builds.storage import get_backend, get_log_backend, get_storage_config
+
+MIB = 1024 * 1024
+
+
+class Command(BaseCommand):
+    help = "Dedup ratio per job of the chunked (LOG_STORAGE backend \"dedup\") logs and their read throughput"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--job", help="Only this job")
+        parser.add_argument("--estimate", action="store_true",
+                            help="Also chunk logs stored in other backends in memory, to see what dedup would save")
+        parser.add_argument("--bench", type=int, default=0, metavar="N",
+                            help="Read the N largest chunked logs, compared with a plain file copy of each")
+        parser.add_argument("--repeat", type=int, default=3)
+
+    def handle(self, *args, **options):
+        dedup = get_backend("dedup")
+        builds = (BuildRecord.objects.exclude(build_number__isnull=True)
+                  .exclude(log_path__endswith=".tar.gz").order_by("job_name", "build_number"))
+        if options["job"]:
+            builds = builds.filter(job_name=options["job"])
+
+        jobs = {}
+        chunked = []
+        for job_name, build_number in builds.values_list("job_name", "build_number").distinct():
+            backend = get_log_backend(job_name, build_number)
+            if backend.name == "dedup":
+                manifest = dedup.load_manifest(job_name, build_number)
+                pieces = dedup.chunk_list(job_name, build_number)
+                pending = manifest["size"] - manifest["chunked"]
+                kind = "dedup"
+                chunked.append((manifest["size"], job_name, build_number))
+            elif options["estimate"] and backend.exists(job_name, build_number):
+                pieces, pending = self.estimate(backend, job_name, build_number)
+                kind = "estimate"
+            else:
+                continue
+            job = jobs.setdefault(job_name, {"dedup": 0, "estimate": 0, "bytes": 0, "pending": 0, "chunks": {}})
+            job[kind] += 1
+            job["bytes"] += sum(length for _digest, length in pieces) + pending
+            job["pending"] += pending  # not chunked yet (running builds), counted as unique
+            job["chunks"].update(pieces)
+
+        if not jobs:
+            self.stdout.write("No chunked logs" + ("" if options["estimate"] else " (--estimate chunks the others)"))
+        else:
+            self.stdout.write(f"{'job':<40} {'builds':>7} {'est.':>5} {'logical MiB':>12} {'unique MiB':>11} {'ratio':>6}")
+            total_bytes = total_unique = 0
+            for job_name, job in jobs.items():
+                unique = sum(job["chunks"].values()) + job["pending"]
+                total_bytes += job["bytes"]
+                total_unique += unique
+                self.stdout.write(
+                    f"{job_name:<40} {job['dedup'] + job['estimate']:>7} {job['estimate']:>5} "
+                    f"{job['bytes'] / MIB:>12.1f} {unique / MIB:>11.1f} {self.ratio(job['bytes'], unique):>6}")
+            self.stdout.write(f"{'all jobs (chunks shared by jobs counted per job)':<54} "
+                              f"{total_bytes / MIB:>12.1f} {total_unique / MIB:>11.1f} {self.ratio(total_bytes, total_unique):>6}")
+
+        stats = dedup.store.stats()
+        if stats["chunks"]:
+            self.stdout.write(
+                f"chunk store {get_storage_config()['chunk_store']}: {stats['chunks']} chunks, "
+                f"{stats['stored_bytes'] / MIB:.1f} MiB stored for {stats['referenced_bytes'] / MIB:.1f} MiB "
+                f"referenced ({self.ratio(stats['referenced_bytes'], stats['stored_bytes'])})")
+
+        if options["bench"]:
+            for size, job_name, build_number in sorted(chunked, reverse=True)[:options["bench"]]:
+                self.bench(dedup, job_name, build_number, size, options["repeat"])
+
+    @staticmethod
+    def ratio(logical, stored):
+        return f"{logical / stored:.2f}x" if stored else "-"
+
+    @staticmethod
+    def estimate(backend, job_name, build_number):
+        """(digest, length) chunks and leftover bytes the dedup backend would store for a log"""
+        config = get_storage_config()
+        dedup = get_backend("dedup")
+        pieces = []
+        buffered = b""
+        for data in backend.iter_range(job_name, build_number):
+            buffered += data
+            start = 0
+            for end in chunk_boundaries(buffered, config["chunk_min_bytes"], config["chunk_avg_bytes"],
+                                        config["chunk_max_bytes"]):
+                pieces.append((dedup.store.digest(buffered[start:end]), end - start))
+                start = end
+            buffered = buffered[start:]
+        if buffered:
+            pieces.append((dedup.store.digest(buffered), len(buffered)))
+        return pieces, 0
+
+    def bench(self, dedup, job_name, build_number, size, repeat):
+        with tempfile.TemporaryDirectory() as tmp:
+            plain_path = os.path.join(tmp, "full.log")
+            with open(plain_path, "wb") as f:
+                for data in dedup.iter_range(job_name, build_number):
+                    f.write(data)
+
+            def read_plain():
+                with open(plain_path, "rb") as f:
+                    while f.read(STREAM_CHUNK_SIZE):
+                        pass
+
+            def read_chunked():
+                for _data in dedup.iter_range(job_name, build_number):
+                    pass
+
+            results = {}
+            for name, func in (("plain", read_plain), ("chunked", read_chunked)):
+                timings = []
+                for _ in range(repeat):
+                    start = time.perf_counter()
+                    func()
+                    timings.append(time.perf_counter() - start)
+                results[name] = min(timings)
+        chunks = dedup.load_manifest(job_name, build_number)["count"]
+        throughput = {name: size / MIB / seconds if seconds else 0 for name, seconds in results.items()}
+        self.stdout.write(
+            f"{job_name} #{build_number}: {size / MIB:.1f} MiB in {chunks} chunks, "
+            f"plain {throughput['plain']:.0f} MiB/s, chunked {throughput['chunked']:.0f} MiB/s "
+            f"({results['chunked'] / results['plain'] if results['plain'] else 0:.1f}x the time, warm page cache)")
@@ -0,0 +1,51 @@
+import os
+
+from django.core.management.base import BaseCommand
+
+from builds.models import BuildRecord, ACTIVE_STATUSES
+from builds.storage import BASE_BUILD_PATH, get_sharded_build_path
+
+
+class Command(BaseCommand):
+    help = "Move logs from BASE_BUILD_PATH/{job}/{build_number}/ into the hash-sharded layout"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--dry-run", action="store_true", help="Only print the moves")
+        parser.add_argument("--job", help="Migrate a single job")
+
+    def handle(self, *args, **options):
+        if not os.path.isdir(BASE_BUILD_PATH):
+            self.stdout.write("Nothing to migrate")
+            return
+
+        jobs = [options["job"]] if options["job"] else sorted(os.listdir(BASE_BUILD_PATH))
+        moved = 0
+        for job_name in jobs:
+            job_dir = os.path.join(BASE_BUILD_PATH, job_name)
+            if not os.path.isdir(job_dir):
+                continue
+            # a poller holds the paths of a running build, it moves once the build finished
+            active = set(BuildRecord.objects.filter(job_name=job_name, status__in=ACTIVE_STATUSES)
+                         .values_list("build_number", flat=True))
+            for entry in os.scandir(job_dir):
+                # legacy build dirs are the build number, shard dirs start with "s"
+                if not entry.is_dir() or not entry.name.isdigit():
+                    continue
+                if int(entry.name) in active:
+                    self.stderr.write(f"Skipping {entry.path}: build is still active")
+                    continue
+                target = get_sharded_build_path(job_name, entry.name)
+                if os.path.exists(target):
+                    self.stderr.write(f"Skipping {entry.path}: {target} already exists")
+                    continue
+                self.stdout.write(f"{entry.path} -> {target}")
+                if options["dry_run"]:
+                    continue
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                os.replace(entry.path, target)
+                (BuildRecord.objects
+                 .filter(job_name=job_name, build_number=int(entry.name), log_path__startswith=entry.path)
+                 .update(log_path=os.path.join(target, "full.log")))
+                moved += 1
+
+        self.stdout.write(f"Moved {moved} build directories")
@@ -0,0 +1,67 @@
+import os
+import sys
+import time
+import socket
+import subprocess
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from builds.fleet import get_fleet_config, register_node, remove_node, rebalance, live_nodes
+
+
+class Command(BaseCommand):
+    help = "Run a poller fleet node: pollers worker pool, node heartbeat and rebalancing"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--name", default=socket.gethostname(), help="Node name, unique in the fleet")
+        parser.add_argument("--no-worker", action="store_true",
+                            help="Only heartbeat and rebalance (workers started separately with POLLER_NODE set)")
+
+    def handle(self, *args, **options):
+        # imported here: builds.tasks connects to the broker on import
+        from builds.tasks import start_and_poll_build
+
+        name = options["name"]
+        config = get_fleet_config()
+        if not config["enabled"]:
+            self.stderr.write("POLLER_FLEET is not enabled, builds will not be assigned to nodes")
+
+        worker = None
+        worker_exit = None
+        if not options["no_worker"]:
+            env = dict(os.environ, POLLER_NODE=name)
+            if env.get("DJANGO_SETTINGS_MODULE") == "jenkins.settings":  # manage.py default, workers use the lean profile
+                env["DJANGO_SETTINGS_MODULE"] = "jenkins.settings_worker"
+            worker = subprocess.Popen([sys.executable, "worker.py", "pollers"], cwd=settings.BASE_DIR, env=env)
+
+        register_node(name)
+        self.stdout.write(f"Node {name} joined, live nodes: {', '.join(live_nodes())}")
+        try:
+            while True:
+                register_node(name)
+                moved = rebalance(start_and_poll_build)
+                if moved:
+                    self.stdout.write(f"Rebalanced {moved} builds")
+                if worker is None:
+                    time.sleep(config["heartbeat_interval"])
+                    continue
+                try:
+                    # returns as soon as the worker exits: no heartbeat for a node without pollers
+                    worker_exit = worker.wait(timeout=config["heartbeat_interval"])
+                except subprocess.TimeoutExpired:
+                    continue
+                break
+        except KeyboardInterrupt:
+            pass
+        finally:
+            remove_node(name)
+            # hand this node's builds to the remaining nodes right away
+            moved = rebalance(start_and_poll_build)
+            self.stdout.write(f"Node {name} left, moved {moved} builds")
+            if worker and worker.poll() is None:
+                worker.terminate()
+                worker.wait()
+        if worker_exit is not None:
+            # non-zero so a supervisor restarts the node
+            raise CommandError(f"Poller worker of node {name} exited with status {worker_exit}")
@@ -0,0 +1,32 @@
+import requests
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = "Post a Jenkins notification-plugin style event to the webhook (local stand-in for Jenkins)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("job_name")
+        parser.add_argument("build_number", type=int)
+        parser.add_argument("--phase", default="COMPLETED", help="QUEUED, STARTED, COMPLETED or FINALIZED")
+        parser.add_argument("--status", default="SUCCESS", help="Build result for COMPLETED/FINALIZED")
+        parser.add_argument("--api", default="http://localhost:8000", help="Base URL of this API")
+
+    def handle(self, *args, **options):
+        payload = {
+            "name": options["job_name"],
+            "build": {
+                "number": options["build_number"],
+                "phase": options["phase"],
+                "status": options["status"] if options["phase"] in ("COMPLETED", "FINALIZED") else None,
+            },
+        }
+        headers = {}
+        token = getattr(settings, "JENKINS_WEBHOOK", {}).get("token")
+        if token:
+            headers["X-Jenkins-Token"] = token
+
+        r = requests.post(f"{options['api']}/api/builds/webhook/jenkins/", json=payload, headers=headers, timeout=10)
+        self.stdout.write(f"{r.status_code} {r.text}")
@@ -0,0 +1,28 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from builds.changefeed import prune_changes
+from builds.retention import get_policy, sweep
+
+
+class Command(BaseCommand):
+    help = "Delete or archive build logs according to LOG_RETENTION, prune the status change feed"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--dry-run", action="store_true", help="Only report what would be expired")
+        parser.add_argument("--loop", action="store_true", help="Keep sweeping every sweep_interval seconds")
+
+    def handle(self, *args, **options):
+        while True:
+            policy = get_policy()
+            stats = sweep(policy, dry_run=options["dry_run"])
+            self.stdout.write(
+                f"Retention sweep: age={stats['age']} count={stats['count']} "
+                f"bytes={stats['bytes']} failed={stats['failed']}"
+            )
+            if not options["dry_run"]:
+                self.stdout.write(f"Pruned {prune_changes()} status changes")
+            if not options["loop"]:
+                break
+            time.sleep(policy["sweep_interval"])
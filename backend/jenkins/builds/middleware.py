@@ -0,0 +1,92 @@
+import time
+import logging
+import threading
+
+from django.db import connection
+
+from .profiling import get_profiling_config
+
+logger = logging.getLogger("jenkins_worker")
+
+# {"logs": {"count": n, "seconds": total, "max": slowest, "db_seconds": total, "queries": n}}
+REQUEST_STATS = {}
+_stats_lock = threading.Lock()
+
+
+class _QueryTimer:
+    """connection.execute_wrapper that adds up the query time of a request"""
+
+    def __init__(self):
+        self.seconds = 0.0
+        self.queries = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.seconds += time.perf_counter() - started
+            self.queries += 1
+
+
+def _action_name(request):
+    """BuildRecordViewSet action of the request, None for other views"""
+    match = getattr(request, "resolver_match", None)
+    view = getattr(match.func, "cls", None) if match else None
+    if view is None or view.__name__ != "BuildRecordViewSet":
+        return None
+    return match.url_name.split("-", 1)[-1]
+
+
+def _record(action, seconds, timer):
+    with _stats_lock:
+        stats = REQUEST_STATS.setdefault(action, {"count": 0, "seconds": 0.0, "max": 0.0,
+                                                  "db_seconds": 0.0, "queries": 0})
+        stats["count"] += 1
+        stats["seconds"] += seconds
+        stats["max"] = max(stats["max"], seconds)
+        stats["db_seconds"] += timer.seconds
+        stats["queries"] += timer.queries
+
+
+def request_stats():
+    with _stats_lock:
+        return {action: dict(stats) for action, stats in REQUEST_STATS.items()}
+
+
+class RequestTimingMiddleware:
+    """Time of the builds API actions: a Server-Timing header (app and db),
+    per-action totals for /api/builds/profiler/ and a log line for slow ones.
+
+    Streamed bodies (exports, fast lists) are produced after the middleware
+    returns: their header is marked as covering the headers only, and they
+    are left out of the totals and the slow log.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        config = get_profiling_config()
+        if not config["request_timing"]:
+            return self.get_response(request)
+
+        timer = _QueryTimer()
+        started = time.perf_counter()
+        with connection.execute_wrapper(timer):
+            response = self.get_response(request)
+        seconds = time.perf_counter() - started
+
+        action = _action_name(request)
+        if action is None:
+            return response
+        if response.streaming:
+            response["Server-Timing"] = f'app;dur={seconds * 1000:.1f};desc="headers, body streamed"'
+            return response
+        _record(action, seconds, timer)
+        response["Server-Timing"] = (f"app;dur={seconds * 1000:.1f}, "
+                                     f'db;dur={timer.seconds * 1000:.1f};desc="{timer.queries} queries"')
+        if seconds > config["slow_request_seconds"]:
+            logger.warning(f"Slow API request {request.method} {request.path} ({action}): {seconds:.2f}s, "
+                           f"{timer.queries} queries in {timer.seconds:.2f}s")
+        return response
@@ -1,5 +1,27 @@
 from django.db import models
 
+# Builds that still occupy a slot / have a poller (STOPPED is draining the last output)
+ACTIVE_STATUSES = ["PENDING", "RUNNING", "STOPPED"]
+
+class JenkinsController(models.Model):
+    """A Jenkins controller builds can run on, see builds/controllers.py"""
+    name = models.CharField(max_length=100, unique=True)
+    url = models.CharField(max_length=500)
+    username = models.CharField(max_length=255)
+    token = models.CharField(max_length=255)
+    # comma separated fnmatch patterns of the jobs living on this controller
+    job_patterns = models.CharField(max_length=1000, blank=True, default="")
+    is_default = models.BooleanField(default=False)
+    enabled = models.BooleanField(default=True)
+    # per worker process: HTTP pool size / concurrent requests, and request rate
+    max_connections = models.IntegerField(default=20)
+    requests_per_second = models.FloatField(default=20.0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return self.name
+
+
 class BuildRecord(models.Model):
     STATUS_CHOICES = [
         ('PENDING', 'Pending'),
@@ -12,15 +34,152 @@ class BuildRecord(models.Model):
 
     job_name = models.CharField(max_length=255)
     build_number = models.IntegerField(null=True, blank=True)
+    # None = the controller from settings.JENKINS_CONTROLLER
+    controller = models.ForeignKey(JenkinsController, null=True, blank=True, on_delete=models.PROTECT, related_name='builds')
     status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='PENDING')
     start_time = models.DateTimeField(auto_now_add=True)
     end_time = models.DateTimeField(null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     log_path = models.CharField(max_length=500, blank=True, null=True)
+    # get_build_size() of a finished build, measured once by the retention sweep
+    log_bytes = models.BigIntegerField(null=True, blank=True)
+    queue_url = models.CharField(max_length=500, blank=True, null=True)
+    # Pushed by the Jenkins webhook, lets the poller finish without asking Jenkins
+    jenkins_result = models.CharField(max_length=20, blank=True, null=True)
+    jenkins_event_at = models.DateTimeField(null=True, blank=True)
+    # Maintained at ingest from the problem index (builds/problems.py)
+    error_count = models.IntegerField(default=0)
+    warning_count = models.IntegerField(default=0)
+    # Admission control (builds/admission.py): waiting while enqueued_at is set and admitted_at is not
+    team = models.CharField(max_length=100, blank=True, default="")
+    enqueued_at = models.DateTimeField(null=True, blank=True)
+    admitted_at = models.DateTimeField(null=True, blank=True)
+    # Poller node the fleet coordinator hashed this build to (builds/fleet.py)
+    assigned_node = models.CharField(max_length=255, blank=True, null=True)
+    # Where the time went (builds/telemetry.py): trigger POST sent, queue item
+    # created, build started / finished as reported by Jenkins
+    triggered_at = models.DateTimeField(null=True, blank=True)
+    queued_at = models.DateTimeField(null=True, blank=True)
+    jenkins_started_at = models.DateTimeField(null=True, blank=True)
+    jenkins_finished_at = models.DateTimeField(null=True, blank=True)
 
     class Meta:
         unique_together = ('job_name', 'build_number')
 
     def __str__(self):
         return f"{self.job_name} - {self.build_number or 'Pending'}"
+
+    def refresh_from_db(self, *args, **kwargs):
+        super().refresh_from_db(*args, **kwargs)
+        # baseline for the change feed (see signals.py), a status another
+        # process saved must not be published again by this instance
+        self._loaded_status = self.__dict__.get("status")
+
+
+class BuildStatusChange(models.Model):
+    """One BuildRecord status transition; the id is the change feed cursor"""
+    build = models.ForeignKey(BuildRecord, on_delete=models.CASCADE, related_name='status_changes')
+    job_name = models.CharField(max_length=255)
+    build_number = models.IntegerField(null=True, blank=True)
+    old_status = models.CharField(max_length=20, null=True, blank=True)
+    new_status = models.CharField(max_length=20)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        ordering = ['id']
+
+    def __str__(self):
+        return f"#{self.id} {self.job_name} - {self.build_number}: {self.old_status} -> {self.new_status}"
+
+
+class BuildLease(models.Model):
+    """Which poller streams a Jenkins build, see builds/leases.py"""
+    job_name = models.CharField(max_length=255)
+    build_number = models.IntegerField()
+    owner = models.CharField(max_length=255)
+    acquired_at = models.DateTimeField()
+    heartbeat_at = models.DateTimeField()
+    expires_at = models.DateTimeField()
+    # Checkpoint: Jenkins progressiveText offset and our stored log size at that point
+    log_offset = models.BigIntegerField(default=0)
+    stored_size = models.BigIntegerField(default=0)
+
+    class Meta:
+        unique_together = ('job_name', 'build_number')
+
+    def __str__(self):
+        return f"{self.job_name} - {self.build_number} owned by {self.owner}"
+
+
+class PollerNode(models.Model):
+    """A registered poller worker node, alive while heartbeat_at is recent"""
+    name = models.CharField(max_length=255, unique=True)
+    started_at = models.DateTimeField(auto_now_add=True)
+    heartbeat_at = models.DateTimeField()
+
+    def __str__(self):
+        return self.name
+
+
+class TestCaseName(models.Model):
+    """Interned test name; index is the test's bit/slot in TestRun arrays"""
+    job_name = models.CharField(max_length=255)
+    name = models.CharField(max_length=1000)
+    index = models.IntegerField()
+
+    class Meta:
+        unique_together = [('job_name', 'name'), ('job_name', 'index')]
+
+    def __str__(self):
+        return f"{self.job_name}: {self.name}"
+
+
+class TestRun(models.Model):
+    """One build's test report, see builds/testreports.py.
+
+    passed/failed/skipped are bitmaps over TestCaseName.index, durations a
+    float32 array in the same order.
+    """
+    build = models.OneToOneField(BuildRecord, on_delete=models.CASCADE, related_name='test_run')
+    job_name = models.CharField(max_length=255)
+    build_number = models.IntegerField()
+    total = models.IntegerField(default=0)
+    failed_count = models.IntegerField(default=0)
+    skipped_count = models.IntegerField(default=0)
+    duration = models.FloatField(default=0)
+    passed = models.BinaryField()
+    failed = models.BinaryField()
+    skipped = models.BinaryField()
+    durations = models.BinaryField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ('job_name', 'build_number')
+        indexes = [models.Index(fields=['job_name', '-build_number'])]
+
+    def __str__(self):
+        return f"{self.job_name} - {self.build_number}: {self.failed_count}/{self.total} failed"
+
+
+class ControllerSample(models.Model):
+    """Queue and executor state of a controller at one collector tick, see builds/telemetry.py"""
+    # None = the controller from settings.JENKINS_CONTROLLER
+    controller = models.ForeignKey(JenkinsController, null=True, blank=True, on_delete=models.CASCADE,
+                                   related_name='samples')
+    at = models.DateTimeField()
+    queue_length = models.IntegerField(default=0)
+    queue_blocked = models.IntegerField(default=0)
+    queue_stuck = models.IntegerField(default=0)
+    # seconds the items in the queue have been waiting so far
+    wait_avg = models.FloatField(default=0)
+    wait_max = models.FloatField(default=0)
+    executors_total = models.IntegerField(default=0)
+    executors_busy = models.IntegerField(default=0)
+    nodes_offline = models.IntegerField(default=0)
+
+    class Meta:
+        indexes = [models.Index(fields=['controller', 'at'])]
+
+    def __str__(self):
+        return f"{self.controller or 'default'} @ {self.at}: queue {self.queue_length}, busy {self.executors_busy}/{self.executors_total}"
@@ -0,0 +1,178 @@
+import os
+import re
+import json
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+# name, level, regex; matched against plain (colour-stripped) lines
+DEFAULT_PROBLEM_PATTERNS = [
+    ("compiler_error", "error", r"^\S+\.\w+:\d+(?::\d+)?:\s*(?:fatal )?error\b"),
+    ("compiler_error", "error", r"\berror (?:CS|TS|C)\d+\b"),
+    ("maven_error", "error", r"^\[ERROR\]"),
+    ("test_failure", "error", r"^(?:FAIL|FAILED)\b|\bTests run:.*(?:Failures|Errors): [1-9]"),
+    ("stack_trace", "error", r"^Traceback \(most recent call last\)|^Exception in thread |^\s*Caused by: "),
+    ("exception", "error", r"^[\w.$]+(?:Exception|Error): "),
+    ("error", "error", r"\bERROR\b"),
+    ("warning", "warning", r"\b(?:WARN(?:ING)?|[Ww]arning)\b"),
+]
+
+CONTEXT_BEFORE = 3
+CONTEXT_AFTER = 3
+MAX_STORED_PROBLEMS = 2000   # counts keep going, the index stops growing
+MAX_LINE_LENGTH = 2000       # longer lines are cut in the index
+MAX_CARRY = 64 * 1024        # most of a cut line re-read from plain.log
+
+_compiled = None
+
+
+def get_patterns():
+    """[(name, level, compiled regex)], first match wins for a line"""
+    global _compiled
+    if _compiled is None:
+        patterns = getattr(settings, "BUILD_PROBLEM_PATTERNS", DEFAULT_PROBLEM_PATTERNS)
+        _compiled = [(name, level, re.compile(pattern.encode("utf-8"))) for name, level, pattern in patterns]
+    return _compiled
+
+
+@receiver(setting_changed)
+def _reset_patterns(setting, **kwargs):
+    global _compiled
+    if setting == "BUILD_PROBLEM_PATTERNS":
+        _compiled = None
+
+
+def classify(line):
+    for name, level, regex in get_patterns():
+        if regex.search(line):
+            return name, level
+    return None
+
+
+def _text(line):
+    return line[:MAX_LINE_LENGTH].decode("utf-8", errors="replace").rstrip("\r")
+
+
+def _empty_state():
+    return {
+        "offset": 0,        # plain.log bytes already parsed
+        "line_start": 0,    # offset of the unterminated line
+        "line_no": 0,       # 1-based number of the last complete line
+        "counts": {"error": 0, "warning": 0},
+        "stored": 0,
+        "before": [],       # last CONTEXT_BEFORE lines
+        "pending": [],      # problems still collecting after-context
+    }
+
+
+def load_problem_state(state_path):
+    try:
+        with open(state_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return _empty_state()
+
+
+def _save_state(state_path, state):
+    tmp_path = state_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(state, f)
+    os.replace(tmp_path, state_path)
+
+
+def update_problem_index(state_path, index_path, read_range, start_offset, data):
+    """Match the complete lines of a freshly appended plain-text chunk.
+
+    Problems go to index_path (one JSON object per line) once their
+    after-context is complete; the partial last line is re-read with
+    read_range(start, end) on the next call. Returns the level counts.
+    """
+    state = load_problem_state(state_path)
+    if start_offset < state["offset"] or not data:
+        return state["counts"]
+
+    pos = 0
+    buf, buf_offset = data, start_offset
+    if state["line_start"] < start_offset:
+        if start_offset - state["line_start"] <= MAX_CARRY:
+            buf, buf_offset = read_range(state["line_start"], start_offset) + data, state["line_start"]
+        elif b"\n" in data:
+            # cut line too long to re-read, count it but do not match it
+            pos = data.find(b"\n") + 1
+            state["line_no"] += 1
+            state["before"] = (state["before"] + [_text(data[:pos - 1])])[-CONTEXT_BEFORE:]
+        else:
+            state["offset"] = start_offset + len(data)
+            _save_state(state_path, state)
+            return state["counts"]
+
+    # context lines stay bytes until something needs them as text
+    before = [line.encode("utf-8") for line in state["before"]]
+    finished = []
+    while True:
+        nl = buf.find(b"\n", pos)
+        if nl == -1:
+            break
+        line = buf[pos:nl]
+        state["line_no"] += 1
+
+        if state["pending"]:
+            text = _text(line)
+            for problem in state["pending"]:
+                problem["after"].append(text)
+            while state["pending"] and len(state["pending"][0]["after"]) >= CONTEXT_AFTER:
+                finished.append(state["pending"].pop(0))
+
+        match = classify(line)
+        if match:
+            name, level = match
+            state["counts"][level] = state["counts"].get(level, 0) + 1
+            if state["stored"] < MAX_STORED_PROBLEMS:
+                state["stored"] += 1
+                state["pending"].append({
+                    "line": state["line_no"],
+                    "offset": buf_offset + pos,
+                    "level": level,
+                    "pattern": name,
+                    "text": _text(line),
+                    "before": [_text(b) for b in before],
+                    "after": [],
+                })
+
+        before.append(line)
+        if len(before) > CONTEXT_BEFORE:
+            before.pop(0)
+        pos = nl + 1
+
+    state["before"] = [_text(b) for b in before]
+    if finished:
+        with open(index_path, "a", encoding="utf-8") as f:
+            for problem in finished:
+                f.write(json.dumps(problem) + "\n")
+
+    state["offset"] = start_offset + len(data)
+    state["line_start"] = buf_offset + pos
+    _save_state(state_path, state)
+    return state["counts"]
+
+
+def read_problems(state_path, index_path, level=None, offset=0, limit=200):
+    """Problems in line order (pending ones included), without touching the log"""
+    problems = []
+    try:
+        with open(index_path, "r", encoding="utf-8") as f:
+            for raw in f:
+                problems.append(json.loads(raw))
+    except FileNotFoundError:
+        pass
+    state = load_problem_state(state_path)
+    problems.extend(state["pending"])
+    if level:
+        problems = [p for p in problems if p["level"] == level]
+    return {
+        "counts": state["counts"],
+        "truncated": state["stored"] >= MAX_STORED_PROBLEMS,
+        "total": len(problems),
+        "problems": problems[offset:offset + limit],
+    }
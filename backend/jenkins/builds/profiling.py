@@ -0,0 +1,228 @@
+import os
+import sys
+import time
+import signal
+import socket
+import logging
+import threading
+from collections import Counter
+
+from django.conf import settings
+
+logger = logging.getLogger("jenkins_worker")
+
+DEFAULT_PROFILING = {
+    "poll_spans": False,             # time per phase of every poll loop, logged with the progress lines
+    "request_timing": False,         # Server-Timing header and per-action stats for the builds API
+    "slow_request_seconds": 1.0,     # API requests above this are logged
+    "sampler_interval": 0.01,        # seconds between stack samples while the sampler runs
+    "sampler_signal": "SIGUSR2",     # kill -USR2 <pid> starts / stops the sampler of that process
+    "dump_dir": "profiles",          # folded stacks are written here when the sampler stops
+}
+
+
+def get_profiling_config():
+    config = dict(DEFAULT_PROFILING)
+    config.update(getattr(settings, "PROFILING", {}))
+    return config
+
+
+# ---- Spans: where the time of a loop goes ----
+class _Span:
+    __slots__ = ("spans", "name", "started")
+
+    def __init__(self, spans, name):
+        self.spans = spans
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.spans.add(self.name, time.perf_counter() - self.started)
+
+
+class _NoSpan:
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc):
+        pass
+
+
+_NO_SPAN = _NoSpan()
+
+
+class Spans:
+    """Seconds per named phase: with spans("http"): ...
+
+    Two perf_counter calls per span, nothing is kept per iteration.
+    Disabled spans cost one attribute check.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.totals = Counter()
+        self.started = time.perf_counter()
+
+    def __call__(self, name):
+        return _Span(self, name) if self.enabled else _NO_SPAN
+
+    def add(self, name, seconds):
+        if self.enabled:
+            self.totals[name] += seconds
+
+    def summary(self):
+        if not self.enabled:
+            return ""
+        wall = time.perf_counter() - self.started
+        parts = [f"{name}={seconds:.2f}s" for name, seconds in self.totals.most_common()]
+        parts.append(f"other={max(0.0, wall - sum(self.totals.values())):.2f}s")
+        return f"wall={wall:.2f}s " + " ".join(parts)
+
+
+def poll_spans():
+    return Spans(get_profiling_config()["poll_spans"])
+
+
+# ---- Sampling profiler ----
+class Sampler:
+    """Samples the stacks of every thread of the process from a background
+    thread and counts them in the folded format of flamegraph.pl /
+    speedscope ("thread;outer;...;inner count"). Costs one
+    sys._current_frames() walk per interval and nothing while stopped.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.counts = Counter()
+        self.samples = 0
+        self.started_at = None
+        self._labels = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self):
+        self.started_at = time.time()
+        self._thread = threading.Thread(target=self._run, name="profiling-sampler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    def _label(self, code):
+        label = self._labels.get(code)
+        if label is None:
+            label = self._labels[code] = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+        return label
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(self._label(frame.f_code))
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self.counts[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def folded(self):
+        return "".join(f"{stack} {count}\n" for stack, count in self.counts.most_common())
+
+
+_sampler = None
+_sampler_lock = threading.Lock()
+
+
+def start_sampler(interval=None):
+    """Start sampling this process, False if it already runs"""
+    global _sampler
+    with _sampler_lock:
+        if _sampler is not None:
+            return False
+        _sampler = Sampler(interval or get_profiling_config()["sampler_interval"])
+        _sampler.start()
+    logger.info(f"Sampling profiler started in pid {os.getpid()}")
+    return True
+
+
+def stop_sampler():
+    """Stop sampling and write the folded stacks, returns (path, folded), None if not running"""
+    global _sampler
+    with _sampler_lock:
+        sampler, _sampler = _sampler, None
+    if sampler is None:
+        return None
+    sampler.stop()
+    folded = sampler.folded()
+    dump_dir = get_profiling_config()["dump_dir"]
+    os.makedirs(dump_dir, exist_ok=True)
+    path = os.path.join(dump_dir, f"{socket.gethostname()}-{os.getpid()}-{time.strftime('%Y%m%d-%H%M%S')}.folded")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(folded)
+    logger.info(f"Sampling profiler stopped in pid {os.getpid()}: {sampler.samples} samples written to {path}")
+    return path, folded
+
+
+def sampler_status():
+    sampler = _sampler
+    return {
+        "pid": os.getpid(),
+        "running": sampler is not None,
+        "samples": sampler.samples if sampler else 0,
+        "started_at": sampler.started_at if sampler else None,
+    }
+
+
+def _toggle_sampler(signum, frame):
+    # the dump is written off the signal handler, the interrupted code goes on
+    if not start_sampler():
+        threading.Thread(target=stop_sampler, name="profiling-dump", daemon=True).start()
+
+
+def install_signal_handler():
+    """kill -USR2 <pid> toggles the sampler of a process (API or worker).
+
+    Only possible from the main thread; worker processes inherit the
+    handler from the process that ran django.setup().
+    """
+    name = get_profiling_config()["sampler_signal"]
+    signum = getattr(signal, name, None) if name else None
+    if signum is None or threading.current_thread() is not threading.main_thread():
+        return False
+    signal.signal(signum, _toggle_sampler)
+    return True
+
+
+# ---- Process startup ----
+def rss_bytes():
+    """Resident set size of this process (peak RSS where /proc is missing)"""
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+def startup_stats(started):
+    """Time since started (a perf_counter value), RSS and what got loaded"""
+    from django.apps import apps
+    return {
+        "seconds": time.perf_counter() - started,
+        "rss_bytes": rss_bytes(),
+        "modules": len(sys.modules),
+        "apps": [config.label for config in apps.get_app_configs()],
+    }
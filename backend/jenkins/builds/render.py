@@ -0,0 +1,299 @@
+import os
+import re
+import json
+import html
+
+from django.conf import settings
+
+from .console import ESCAPE_RE, NOTE_START, _hold_start
+
+DEFAULT_LOG_RENDER = {
+    "segment_bytes": 256 * 1024,    # raw bytes per rendered segment (kept per build once used)
+}
+
+# Control characters left after the escapes are gone (tab, newline and CR stay)
+CONTROL_RE = re.compile(r"[\x00-\x08\x0b\x0c\x0e-\x1f\x7f]")
+
+# SGR state: bold, dim, italic, underline, strike, inverse, fg, bg.
+# fg/bg are None, a palette index (0-255) or "#rrggbb".
+DEFAULT_STATE = [False, False, False, False, False, False, None, None]
+FLAGS = {1: 0, 2: 1, 3: 2, 4: 3, 9: 4, 7: 5}
+FLAG_RESETS = {22: (0, 1), 23: (2,), 24: (3,), 29: (4,), 27: (5,)}
+FLAG_CLASSES = ["ansi-bold", "ansi-dim", "ansi-italic", "ansi-underline", "ansi-strike"]
+CUBE_LEVELS = [0, 95, 135, 175, 215, 255]
+
+
+def get_render_config():
+    config = dict(DEFAULT_LOG_RENDER)
+    config.update(getattr(settings, "LOG_RENDER", {}))
+    return config
+
+
+# ---- SGR -> styles ----
+def _palette(index):
+    """xterm 256 colour palette entry above the 16 themed ones"""
+    if index < 232:
+        index -= 16
+        r, g, b = index // 36, index // 6 % 6, index % 6
+        return f"#{CUBE_LEVELS[r]:02x}{CUBE_LEVELS[g]:02x}{CUBE_LEVELS[b]:02x}"
+    level = 8 + (index - 232) * 10
+    return f"#{level:02x}{level:02x}{level:02x}"
+
+
+def _extended_colour(params, i):
+    """38;5;n / 38;2;r;g;b starting at params[i] (the 5 or 2), returns (colour, next index)"""
+    try:
+        if params[i] == 5:
+            return max(0, min(255, params[i + 1])), i + 2
+        if params[i] == 2:
+            r, g, b = (max(0, min(255, v)) for v in params[i + 1:i + 4])
+            return f"#{r:02x}{g:02x}{b:02x}", i + 4
+    except (IndexError, ValueError):
+        pass
+    return None, len(params)
+
+
+def apply_sgr(state, sequence):
+    """New state after an ESC[...m sequence"""
+    try:
+        params = [int(p) if p else 0 for p in sequence[2:-1].decode("ascii").split(";")]
+    except ValueError:
+        return state
+    state = list(state)
+    i = 0
+    while i < len(params):
+        p = params[i]
+        i += 1
+        if p == 0:
+            state = list(DEFAULT_STATE)
+        elif p in FLAGS:
+            state[FLAGS[p]] = True
+        elif p in FLAG_RESETS:
+            for flag in FLAG_RESETS[p]:
+                state[flag] = False
+        elif 30 <= p <= 37 or 90 <= p <= 97:
+            state[6] = p - 30 if p < 90 else p - 90 + 8
+        elif 40 <= p <= 47 or 100 <= p <= 107:
+            state[7] = p - 40 if p < 100 else p - 100 + 8
+        elif p == 39:
+            state[6] = None
+        elif p == 49:
+            state[7] = None
+        elif p in (38, 48):
+            colour, i = _extended_colour(params, i)
+            if colour is not None:
+                state[6 if p == 38 else 7] = colour
+    return state
+
+
+def style_of(state):
+    """(classes, inline style) for a state. The 16 themed colours are
+    classes (ansi-fg-N / ansi-bg-N) for the frontend stylesheet, the
+    256 palette and true colour are inline colours built from numbers."""
+    classes = [name for name, on in zip(FLAG_CLASSES, state) if on]
+    fg, bg = state[6], state[7]
+    if state[5]:
+        fg, bg = bg, fg
+        if fg is None and bg is None:
+            classes.append("ansi-inverse")
+    styles = []
+    for prefix, prop, colour in (("fg", "color", fg), ("bg", "background-color", bg)):
+        if isinstance(colour, int) and colour < 16:
+            classes.append(f"ansi-{prefix}-{colour}")
+        elif colour is not None:
+            styles.append(f"{prop}:{_palette(colour) if isinstance(colour, int) else colour}")
+    return " ".join(classes), ";".join(styles)
+
+
+# ---- Rendering ----
+def _utf8_hold(buf):
+    """Index where an incomplete UTF-8 character at the end of buf starts"""
+    for back in range(1, min(4, len(buf)) + 1):
+        byte = buf[-back]
+        if byte & 0xC0 != 0x80:  # lead byte (or ASCII)
+            length = 2 if byte & 0xE0 == 0xC0 else 3 if byte & 0xF0 == 0xE0 else 4 if byte & 0xF8 == 0xF0 else 1
+            return len(buf) - back if length > back else len(buf)
+    return len(buf)
+
+
+def render_runs(data, state, final=False):
+    """Styled runs of a raw log segment.
+
+    data starts with the bytes held back by the previous segment. Returns
+    (runs, end state, held bytes) with runs as [text, classes, style];
+    an escape or UTF-8 character cut at the end is held for the next
+    segment unless final.
+    """
+    hold = len(data) if final else _hold_start(data)
+    hold = hold if final else min(hold, _utf8_hold(data[:hold]))
+    body, held = data[:hold], data[hold:]
+
+    runs = []
+    styles = {}
+
+    def emit(raw):
+        text = CONTROL_RE.sub("", raw.decode("utf-8", errors="replace"))
+        if not text:
+            return
+        key = tuple(state)
+        style = styles.get(key)
+        if style is None:
+            style = styles[key] = style_of(state)
+        if runs and runs[-1][1:] == list(style):
+            runs[-1][0] += text
+        else:
+            runs.append([text, *style])
+
+    pos = 0
+    for match in ESCAPE_RE.finditer(body):
+        emit(body[pos:match.start()])
+        pos = match.end()
+        sequence = match.group()
+        if sequence.endswith(b"m") and not sequence.startswith(NOTE_START):
+            state = apply_sgr(state, sequence)
+    emit(body[pos:])
+    return runs, state, held
+
+
+def runs_to_html(runs):
+    """Sanitized HTML fragment: escaped text, only ansi-* classes and numeric colours"""
+    parts = []
+    for text, classes, style in runs:
+        text = html.escape(text, quote=False)
+        if not classes and not style:
+            parts.append(text)
+            continue
+        attrs = (f' class="{classes}"' if classes else "") + (f' style="{style}"' if style else "")
+        parts.append(f"<span{attrs}>{text}</span>")
+    return "".join(parts)
+
+
+def runs_to_json(runs):
+    """Compact spans: [text] or [text, classes] or [text, classes, style]"""
+    spans = []
+    for text, classes, style in runs:
+        spans.append([text, classes, style] if style else [text, classes] if classes else [text])
+    return spans
+
+
+# ---- Segments and the disk cache ----
+class RenderCache:
+    """Rendered segments of one build under render/: NNNNNN.html,
+    NNNNNN.json and NNNNNN.state.json (SGR state and held bytes at the
+    end of the segment, the start of the next one). A segment is written
+    once all its raw bytes exist and is never rendered again; the
+    growing last segment of an active build is rendered per request.
+
+    Segment k covers raw bytes [k * segment_bytes, (k + 1) * segment_bytes).
+    With a dropped range (log size limit) the segment holding its start
+    shows the marker, the ones inside it are skipped. final: the build
+    ended, so the last segment is finished too.
+    """
+
+    def __init__(self, render_dir, read_range, size, dropped=None, final=False):
+        self.render_dir = render_dir
+        self.read_range = read_range
+        self.size = size
+        self.dropped = dropped
+        self.final = final
+        self.segment_bytes = self._segment_bytes()
+
+    def _segment_bytes(self):
+        try:
+            with open(os.path.join(self.render_dir, "render.json"), "r", encoding="utf-8") as f:
+                return json.load(f)["segment_bytes"]
+        except FileNotFoundError:
+            return get_render_config()["segment_bytes"]
+
+    def _save_config(self):
+        path = os.path.join(self.render_dir, "render.json")
+        if not os.path.exists(path):
+            self._write(path, json.dumps({"segment_bytes": self.segment_bytes}).encode())
+
+    def _write(self, path, data):
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def path(self, index, kind):
+        return os.path.join(self.render_dir, f"{index:06d}.{kind}")
+
+    def count(self):
+        return max(1, -(-self.size // self.segment_bytes))
+
+    def bounds(self, index):
+        start = index * self.segment_bytes
+        return start, min(self.size, start + self.segment_bytes)
+
+    def skipped(self, index):
+        """Entirely inside the dropped range"""
+        if not self.dropped:
+            return False
+        start, end = index * self.segment_bytes, (index + 1) * self.segment_bytes
+        return start >= self.dropped[0] and end <= self.dropped[1]
+
+    def cacheable(self, index):
+        if self.final:
+            return index < self.count()
+        start, end = index * self.segment_bytes, (index + 1) * self.segment_bytes
+        if end > self.size:
+            return False
+        # the marker names the current dropped range, which still moves while the build runs
+        return not (self.dropped and start < self.dropped[1] and end > self.dropped[0])
+
+    def load_state(self, index):
+        """End state of a cached segment, None if it is not cached"""
+        try:
+            with open(self.path(index, "state.json"), "r", encoding="utf-8") as f:
+                saved = json.load(f)
+            return saved["state"], saved["held"].encode("latin-1")
+        except FileNotFoundError:
+            return None
+
+    def _start_state(self, index):
+        """SGR state and held bytes at the start of a segment, rendering
+        (and caching) the earlier ones that are missing"""
+        j = index - 1
+        while j >= 0:
+            saved = None if self.skipped(j) else self.load_state(j)
+            if saved:
+                break
+            j -= 1
+        state, held = saved if j >= 0 else (list(DEFAULT_STATE), b"")
+        for k in range(j + 1, index):
+            if self.skipped(k):
+                continue
+            _runs, state, held = self._render(k, state, held)
+        return state, held
+
+    def _render(self, index, state, held):
+        start, end = self.bounds(index)
+        if self.dropped and self.dropped[0] <= start < self.dropped[1]:
+            start = self.dropped[1]
+            held = b""  # the bytes held before the gap belong to dropped content
+        last = self.final and index == self.count() - 1
+        runs, end_state, end_held = render_runs(held + self.read_range(start, end), state, final=last)
+        if self.cacheable(index):
+            os.makedirs(self.render_dir, exist_ok=True)
+            self._save_config()
+            self._write(self.path(index, "html"), runs_to_html(runs).encode("utf-8"))
+            self._write(self.path(index, "json"), json.dumps(runs_to_json(runs), separators=(",", ":")).encode("utf-8"))
+            self._write(self.path(index, "state.json"), json.dumps({
+                "state": end_state, "held": end_held.decode("latin-1"),
+            }).encode("utf-8"))
+        return runs, end_state, end_held
+
+    def segment(self, index, kind):
+        """(rendered bytes, finished) of a segment as "html" or "json"."""
+        if self.cacheable(index):
+            try:
+                with open(self.path(index, kind), "rb") as f:
+                    return f.read(), True
+            except FileNotFoundError:
+                pass
+        state, held = self._start_state(index)
+        runs, _state, _held = self._render(index, state, held)
+        if kind == "html":
+            return runs_to_html(runs).encode("utf-8"), self.cacheable(index)
+        return json.dumps(runs_to_json(runs), separators=(",", ":")).encode("utf-8"), self.cacheable(index)
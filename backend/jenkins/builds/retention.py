@@ -0,0 +1,173 @@
+import os
+import shutil
+import fnmatch
+import tarfile
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import F, Q, Sum, Window
+from django.db.models.functions import RowNumber
+from django.utils import timezone
+
+from .models import BuildRecord, ACTIVE_STATUSES
+from .storage import get_build_path, get_build_size, get_shard, get_log_backend
+
+logger = logging.getLogger("jenkins_worker")
+
+DEFAULT_RETENTION = {
+    "max_age_days": None,          # expire logs of builds that ended before this
+    "max_builds_per_job": None,    # keep only the newest N builds of each job
+    "max_total_bytes": None,       # expire oldest logs until the total fits
+    "action": "delete",            # "delete" or "archive"
+    "archive_path": "builds/archive",
+    "sweep_interval": 3600,        # seconds between sweeps in --loop mode
+}
+
+
+def get_policy():
+    policy = dict(DEFAULT_RETENTION)
+    policy.update(getattr(settings, "LOG_RETENTION", {}))
+    return policy
+
+
+def get_archive_path(policy, job_name, build_number):
+    shard = get_shard(job_name, build_number)
+    return os.path.join(policy["archive_path"], str(job_name), shard, f"{build_number}.tar.gz")
+
+
+def _candidates():
+    """Finished builds whose logs were neither deleted nor archived, oldest first"""
+    return (BuildRecord.objects
+            .exclude(status__in=ACTIVE_STATUSES)
+            .exclude(build_number__isnull=True)
+            .filter(log_path__isnull=False)
+            .exclude(log_path__endswith=".tar.gz")
+            .only("id", "job_name", "build_number", "end_time", "created_at", "log_path", "log_bytes")
+            .order_by("end_time", "id"))
+
+
+def measure_new_builds(candidates):
+    """Fill log_bytes of the builds not measured yet, a finished build is walked once.
+
+    Chunk store shares are taken at that point and drift a little as other
+    builds sharing the chunks come and go.
+    """
+    for build in candidates.filter(log_bytes__isnull=True).iterator():
+        build.log_bytes = get_build_size(build.job_name, build.build_number)
+        BuildRecord.objects.filter(id=build.id).update(log_bytes=build.log_bytes)
+
+
+def select_expired(policy, now=None):
+    """Return {build_id: (build, path, reason)} for everything the policy expires"""
+    now = now or timezone.now()
+    candidates = _candidates()
+    expired = {}
+
+    def expire(builds, reason):
+        for build in builds.iterator():
+            if build.id not in expired:
+                expired[build.id] = (build, get_build_path(build.job_name, build.build_number), reason)
+
+    if policy["max_age_days"] is not None:
+        cutoff = now - timedelta(days=policy["max_age_days"])
+        expire(candidates.filter(Q(end_time__lt=cutoff) | Q(end_time__isnull=True, created_at__lt=cutoff)), "age")
+
+    if policy["max_builds_per_job"] is not None:
+        ranked = candidates.annotate(rank=Window(RowNumber(), partition_by=[F("job_name")],
+                                                 order_by=F("build_number").desc()))
+        expire(ranked.filter(rank__gt=policy["max_builds_per_job"]), "count")
+
+    if policy["max_total_bytes"] is not None:
+        measure_new_builds(candidates)
+        total = (candidates.aggregate(total=Sum("log_bytes"))["total"] or 0) - sum(
+            build.log_bytes or 0 for build, _path, _reason in expired.values())
+        for build in candidates.iterator():  # oldest first
+            if total <= policy["max_total_bytes"]:
+                break
+            if build.id in expired:
+                continue
+            expired[build.id] = (build, get_build_path(build.job_name, build.build_number), "bytes")
+            total -= build.log_bytes or 0
+
+    return expired
+
+
+def remove_build_dir(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    try:
+        os.rmdir(os.path.dirname(path))  # drop the shard dir once it is empty
+    except OSError:
+        pass
+
+
+class _LogReader:
+    """File object over a backend's iter_range, tarfile copies full.log from it"""
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.buffer = b""
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                break
+            self.buffer += chunk
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+def archive_build(policy, build, path):
+    archive_path = get_archive_path(policy, build.job_name, build.build_number)
+    os.makedirs(os.path.dirname(archive_path), exist_ok=True)
+    backend = get_log_backend(build.job_name, build.build_number)
+    tmp_path = archive_path + ".tmp"
+    with tarfile.open(tmp_path, "w:gz") as tar:
+        if backend.name == "file":
+            tar.add(path, arcname=str(build.build_number))
+        else:
+            # segments / chunks are streamed into the archive as one full.log, no copy on disk
+            log_file = lambda info: None if any(
+                fnmatch.fnmatch(os.path.basename(info.name), pattern) for pattern in backend.log_files) else info
+            tar.add(path, arcname=str(build.build_number), filter=log_file)
+            info = tarfile.TarInfo(f"{build.build_number}/full.log")
+            info.size = backend.size(build.job_name, build.build_number)
+            info.mtime = int(os.path.getmtime(path))
+            tar.addfile(info, _LogReader(backend.iter_range(build.job_name, build.build_number, 0, info.size)))
+    os.replace(tmp_path, archive_path)
+    if backend.name != "file":
+        backend.delete(build.job_name, build.build_number)
+    remove_build_dir(path)
+    return archive_path
+
+
+def sweep(policy=None, dry_run=False):
+    """Apply the retention policy once. Returns counts per reason."""
+    policy = policy or get_policy()
+    expired = select_expired(policy)
+    stats = {"age": 0, "count": 0, "bytes": 0, "failed": 0}
+
+    for build, path, reason in expired.values():
+        if dry_run:
+            logger.info(f"[dry-run] would {policy['action']} {path} ({reason})")
+            stats[reason] += 1
+            continue
+        try:
+            if policy["action"] == "archive" and os.path.isdir(path):
+                new_log_path = archive_build(policy, build, path)
+            else:
+                # tiered and dedup storage keep data outside the build dir
+                get_log_backend(build.job_name, build.build_number).delete(build.job_name, build.build_number)
+                remove_build_dir(path)
+                new_log_path = None
+            BuildRecord.objects.filter(id=build.id).update(log_path=new_log_path)
+            stats[reason] += 1
+        except Exception as e:
+            logger.exception(f"Retention failed for {build}: {e}")
+            stats["failed"] += 1
+
+    return stats
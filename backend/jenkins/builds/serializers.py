@@ -5,3 +5,10 @@ class BuildRecordSerializer(serializers.ModelSerializer):
     class Meta:
         model = BuildRecord
         fields = '__all__'
+
+    def __init__(self, *args, fields=None, **kwargs):
+        # sparse fieldsets: ?fields=id,status,... (see BuildRecordViewSet.get_serializer)
+        super().__init__(*args, **kwargs)
+        if fields is not None:
+            for name in set(self.fields) - set(fields):
+                self.fields.pop(name)
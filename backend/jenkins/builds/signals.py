@@ -0,0 +1,23 @@
+from django.db.models.signals import post_init, post_save
+from django.dispatch import receiver
+
+from .models import BuildRecord, ACTIVE_STATUSES
+from .changefeed import publish
+from .admission import slot_freed
+
+
+@receiver(post_init, sender=BuildRecord)
+def remember_status(sender, instance, **kwargs):
+    # __dict__ so deferred loads (.only()) do not fetch status just for this
+    instance._loaded_status = instance.__dict__.get("status") if instance.pk else None
+
+
+@receiver(post_save, sender=BuildRecord)
+def publish_status_change(sender, instance, created, **kwargs):
+    old_status = getattr(instance, "_loaded_status", None)
+    if created or instance.status != old_status:
+        publish(instance, None if created else old_status)
+        if not created and old_status in ACTIVE_STATUSES and instance.status not in ACTIVE_STATUSES:
+            slot_freed()
+    instance._loaded_status = instance.status
+
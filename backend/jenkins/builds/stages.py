@@ -0,0 +1,155 @@
+import os
+import re
+import json
+
+# Jenkins wraps some markers in hidden ConsoleNotes: ESC[8mha:////<base64>ESC[0m
+CONSOLE_NOTE_RE = re.compile(rb"\x1b\[8mha:.*?\x1b\[0m")
+PIPELINE_RE = re.compile(rb"^\[Pipeline\] (.*?)\r?$")
+BLOCK_NAME_RE = re.compile(rb"^\{ \((.*)\)$")
+
+# Lines longer than this are never stage markers, so we do not re-read them
+MAX_MARKER_LINE = 64 * 1024
+
+
+def _empty_index():
+    return {
+        "stages": [],
+        "state": {
+            "offset": 0,          # bytes of full.log already parsed
+            "line_start": 0,      # offset of the unterminated line, if any
+            "pending": None,      # "stage" / "parallel" seen, waiting for "{"
+            "stack": [],          # open "{" blocks, stage index or None
+        },
+    }
+
+
+def load_stage_index(index_path):
+    try:
+        with open(index_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return _empty_index()
+
+
+def save_stage_index(index_path, index):
+    tmp_path = index_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(index, f)
+    os.replace(tmp_path, index_path)
+
+
+def _handle_marker(index, marker, line_start, line_end):
+    state = index["state"]
+    stages = index["stages"]
+
+    if marker in (b"stage", b"parallel"):
+        state["pending"] = marker.decode()
+        return
+
+    if marker.startswith(b"{"):
+        name_match = BLOCK_NAME_RE.match(marker)
+        name = name_match.group(1).decode("utf-8", errors="replace") if name_match else None
+        kind = None
+        if name and name.startswith("Branch: "):
+            kind, name = "branch", name[len("Branch: "):]
+        elif name and state["pending"] == "stage":
+            kind = "stage"
+        state["pending"] = None
+
+        if kind is None:
+            state["stack"].append(None)
+            return
+
+        parent = next((i for i in reversed(state["stack"]) if i is not None), None)
+        path = f"{stages[parent]['path']}/{name}" if parent is not None else name
+        stages.append({
+            "name": name,
+            "path": path,
+            "kind": kind,
+            "parent": parent,
+            "start": line_start,
+            "end": None,
+        })
+        state["stack"].append(len(stages) - 1)
+        return
+
+    if marker == b"}":
+        if state["stack"]:
+            opened = state["stack"].pop()
+            if opened is not None:
+                stages[opened]["end"] = line_end
+
+
+def update_stage_index(index_path, read_range, start_offset, data):
+    """Parse a freshly appended chunk and extend the stage byte ranges.
+
+    data is what was just written to the log at start_offset. A line cut
+    by the previous chunk is re-read with read_range(start, end) so markers
+    split across chunk boundaries are still found.
+    """
+    index = load_stage_index(index_path)
+    state = index["state"]
+
+    if start_offset < state["offset"]:
+        return index  # chunk already indexed (e.g. replayed after takeover)
+
+    pos = 0
+    buf, buf_offset = data, start_offset
+    if state["line_start"] < start_offset:
+        if start_offset - state["line_start"] <= MAX_MARKER_LINE:
+            carry = read_range(state["line_start"], start_offset)
+            buf, buf_offset = carry + data, state["line_start"]
+        else:
+            # too long to be a marker, skip the rest of that line
+            if b"\n" not in data:
+                state["offset"] = start_offset + len(data)
+                save_stage_index(index_path, index)
+                return index
+            pos = data.find(b"\n") + 1
+
+    while True:
+        nl = buf.find(b"\n", pos)
+        if nl == -1:
+            break
+        line = CONSOLE_NOTE_RE.sub(b"", buf[pos:nl])
+        match = PIPELINE_RE.match(line)
+        if match:
+            _handle_marker(index, match.group(1), buf_offset + pos, buf_offset + nl + 1)
+        pos = nl + 1
+
+    state["offset"] = start_offset + len(data)
+    if pos < len(buf):
+        state["line_start"] = buf_offset + pos
+    else:
+        state["line_start"] = state["offset"]
+
+    save_stage_index(index_path, index)
+    return index
+
+
+def list_stages(index, log_size):
+    """Stage ranges with sizes; stages still running end at the current log size"""
+    result = []
+    for stage in index["stages"]:
+        end = stage["end"] if stage["end"] is not None else log_size
+        result.append({
+            "name": stage["name"],
+            "path": stage["path"],
+            "kind": stage["kind"],
+            "start": stage["start"],
+            "end": end,
+            "size": end - stage["start"],
+            "running": stage["end"] is None,
+        })
+    return result
+
+
+def find_stage(stages, name):
+    """Match on the full path first ("Tests/unit") and then on the bare name"""
+    for stage in stages:
+        if stage["path"] == name:
+            return stage
+    for stage in stages:
+        if stage["name"] == name:
+            return stage
+    return None
@@ -1,37 +1,296 @@
 import os
 import json
+import hashlib
+
+from django.conf import settings
+
+from .stages import update_stage_index, load_stage_index
+from .console import normalize_chunk, OffsetMap
+from .problems import update_problem_index, read_problems, load_problem_state, MAX_CARRY
+from .logcap import CappedLog, get_size_policy
+from .render import RenderCache
+from .log_backends import (
+    FileLogBackend, SegmentedLogBackend, TieredLogBackend, DedupLogBackend,
+    FilesystemObjectStore, S3ObjectStore, SegmentCache, ChunkStore, STREAM_CHUNK_SIZE,
+)
 
 BASE_BUILD_PATH = "builds/logs"
 
-def get_build_path(job_name, build_number):
+DEFAULT_LOG_STORAGE = {
+    "backend": "file",
+    "segment_size": 8 * 1024 * 1024,
+    "read_workers": 4,
+    "object_store": None,
+    "cache_path": "builds/segment-cache",
+    "cache_max_bytes": 2 * 1024 * 1024 * 1024,
+    "chunk_store": "builds/chunk-store",
+    "chunk_min_bytes": 4 * 1024,
+    "chunk_avg_bytes": 16 * 1024,
+    "chunk_max_bytes": 64 * 1024,
+}
+
+_backends = {}
+# get_build_path() runs for every file of every append, resolved sharded paths skip the stat calls
+_sharded_paths = {}
+MAX_CACHED_PATHS = 4096
+
+def get_shard(job_name, build_number):
+    """Shard directory name, spreads the builds of a job over 256 subdirectories"""
+    key = f"{job_name}/{build_number}".encode("utf-8")
+    # "s" prefix keeps shard dirs from clashing with legacy numeric build dirs
+    return "s" + hashlib.md5(key).hexdigest()[:2]
+
+def get_legacy_build_path(job_name, build_number):
     return os.path.join(BASE_BUILD_PATH, str(job_name), str(build_number))
 
+def get_sharded_build_path(job_name, build_number):
+    shard = get_shard(job_name, build_number)
+    return os.path.join(BASE_BUILD_PATH, str(job_name), shard, str(build_number))
+
+def get_build_path(job_name, build_number):
+    """Sharded path for new builds, legacy flat path for logs not migrated yet"""
+    key = (job_name, str(build_number))
+    sharded = _sharded_paths.get(key)
+    if sharded:
+        return sharded
+    sharded = get_sharded_build_path(job_name, build_number)
+    if os.path.isdir(sharded):
+        # nothing moves a build out of the sharded layout, and sharded is also the
+        # fallback: the answer never changes once the directory exists
+        if len(_sharded_paths) >= MAX_CACHED_PATHS:
+            _sharded_paths.clear()
+        _sharded_paths[key] = sharded
+        return sharded
+    legacy = get_legacy_build_path(job_name, build_number)
+    if os.path.isdir(legacy):
+        return legacy
+    return sharded
+
 def get_full_log_path(job_name, build_number):
     return os.path.join(get_build_path(job_name, build_number), "full.log")
 
 def get_meta_path(job_name, build_number):
     return os.path.join(get_build_path(job_name, build_number), "meta.json")
 
+def get_stage_index_path(job_name, build_number):
+    return os.path.join(get_build_path(job_name, build_number), "stages.json")
+
+def get_plain_log_path(job_name, build_number):
+    """full.log without ANSI colours and ConsoleNotes"""
+    return os.path.join(get_build_path(job_name, build_number), "plain.log")
+
+def get_plain_map_path(job_name, build_number):
+    return os.path.join(get_build_path(job_name, build_number), "plain.map")
+
+def get_plain_state_path(job_name, build_number):
+    return os.path.join(get_build_path(job_name, build_number), "plain.json")
+
+def get_plain_carry_path(job_name, build_number):
+    """Unterminated last line of the plain text once plain.log stopped at the size limit"""
+    return os.path.join(get_build_path(job_name, build_number), "plain.carry")
+
+def get_problem_index_path(job_name, build_number):
+    return os.path.join(get_build_path(job_name, build_number), "problems.jsonl")
+
+def get_problem_state_path(job_name, build_number):
+    return os.path.join(get_build_path(job_name, build_number), "problems.json")
+
+def get_build_size(job_name, build_number):
+    """Total bytes stored for a build: its directory plus what the log
+    backend keeps elsewhere (offloaded segments, its share of the chunk store)"""
+    path = get_build_path(job_name, build_number)
+    total = get_log_backend(job_name, build_number).external_size(job_name, build_number) if os.path.isdir(path) else 0
+    for root, _dirs, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+def get_storage_config():
+    config = dict(DEFAULT_LOG_STORAGE)
+    config.update(getattr(settings, "LOG_STORAGE", {}))
+    return config
+
+def _make_object_store(config):
+    store_config = dict(config["object_store"] or {"type": "filesystem", "root": "builds/object-store"})
+    store_type = store_config.pop("type")
+    if store_type == "s3":
+        return S3ObjectStore(**store_config)
+    return FilesystemObjectStore(**store_config)
+
+def get_backend(name=None):
+    """Shared backend instance by name, the configured one by default"""
+    config = get_storage_config()
+    name = name or config["backend"]
+    if name not in _backends:
+        if name == "file":
+            backend = FileLogBackend(get_build_path)
+        elif name == "segmented":
+            backend = SegmentedLogBackend(get_build_path, segment_size=config["segment_size"],
+                                          read_workers=config["read_workers"])
+        elif name == "tiered":
+            backend = TieredLogBackend(get_build_path, _make_object_store(config),
+                                       SegmentCache(config["cache_path"], config["cache_max_bytes"]),
+                                       segment_size=config["segment_size"], read_workers=config["read_workers"])
+        elif name == "dedup":
+            backend = DedupLogBackend(get_build_path, ChunkStore(config["chunk_store"]),
+                                      min_size=config["chunk_min_bytes"], avg_size=config["chunk_avg_bytes"],
+                                      max_size=config["chunk_max_bytes"])
+        else:
+            raise ValueError(f"Unknown log storage backend: {name}")
+        _backends[name] = backend
+    return _backends[name]
+
+def get_log_backend(job_name, build_number):
+    """Backend holding this build's log; existing builds keep the format they were written in"""
+    build_path = get_build_path(job_name, build_number)
+    if os.path.exists(os.path.join(build_path, "segments.json")):
+        # tiered builds may have remote segments, tiered can read plain segmented ones too
+        configured = get_storage_config()["backend"]
+        return get_backend("tiered" if configured == "tiered" else "segmented")
+    if os.path.exists(os.path.join(build_path, "chunks.json")):
+        return get_backend("dedup")
+    if os.path.exists(os.path.join(build_path, "full.log")):
+        return get_backend("file")
+    return get_backend()
+
+def get_capped_log(job_name, build_number):
+    """The build's log with the size limit applied (see builds/logcap.py), offsets are logical"""
+    return CappedLog(get_log_backend(job_name, build_number), job_name, build_number,
+                     get_build_path(job_name, build_number))
+
+def get_render_dir(job_name, build_number):
+    return os.path.join(get_build_path(job_name, build_number), "render")
+
+def get_render_cache(job_name, build_number, final=False):
+    """Rendered (HTML / styled span) segments of the log, see builds/render.py"""
+    log = get_capped_log(job_name, build_number)
+    return RenderCache(get_render_dir(job_name, build_number), log.read_range, log.size(),
+                       log.dropped_range(), final)
+
 def ensure_build_dir(job_name, build_number):
     path = get_build_path(job_name, build_number)
     os.makedirs(path, exist_ok=True)
     return path
 
 def append_to_log(job_name, build_number, content):
+    """Store a chunk and run the ingest indexes over it.
+
+    Returns the problem counts so far ({"error": n, "warning": m}), or
+    None when there was nothing to append.
+    """
     ensure_build_dir(job_name, build_number)
-    with open(get_full_log_path(job_name, build_number), "a", encoding="utf-8") as f:
-        f.write(content)
+    data = content.encode("utf-8") if isinstance(content, str) else content
+    if not data:
+        return None
+    log = get_capped_log(job_name, build_number)
+    dropped = log.dropped_range()
+    start_offset = log.append(data, get_size_policy(job_name))
+    read_range = lambda start, end: log.read_range(start, end, exact=True)
+    update_stage_index(get_stage_index_path(job_name, build_number), read_range, start_offset, data)
+    if log.capped:
+        if log.dropped_range() != dropped:
+            _record_dropped_range(job_name, build_number, log.dropped_range())
+        # plain.log and plain.map stop where the cap started; the tail is still
+        # normalized so the problem index sees the end of the log
+        plain_offset, plain = normalize_chunk(get_plain_state_path(job_name, build_number), read_range,
+                                              None, None, start_offset, data)
+        return _index_capped_tail(job_name, build_number, plain_offset, plain)
+    plain_offset, plain = normalize_chunk(get_plain_state_path(job_name, build_number), read_range,
+                                          get_plain_log_path(job_name, build_number),
+                                          get_plain_map_path(job_name, build_number), start_offset, data)
+    return update_problem_index(get_problem_state_path(job_name, build_number),
+                                get_problem_index_path(job_name, build_number),
+                                lambda start, end: read_plain_range(job_name, build_number, start, end),
+                                plain_offset, plain)
 
-def read_log(job_name, build_number, tail_lines=None):
+def _index_capped_tail(job_name, build_number, plain_offset, plain):
+    """update_problem_index() for plain text past the end of plain.log.
+
+    plain.carry keeps the unterminated last line, the only part the
+    index re-reads; it starts at the line start or the end of plain.log.
+    """
+    state_path = get_problem_state_path(job_name, build_number)
+    carry_path = get_plain_carry_path(job_name, build_number)
+    plain_path = get_plain_log_path(job_name, build_number)
+    stored = os.path.getsize(plain_path) if os.path.exists(plain_path) else 0
+    carry_start = max(load_problem_state(state_path)["line_start"], stored)
     try:
-        path = get_full_log_path(job_name, build_number)
-        with open(path, "r", encoding="utf-8") as f:
-            if tail_lines:
-                lines = f.readlines()
-                return "".join(lines[-tail_lines:])
-            return f.read()
+        with open(carry_path, "rb") as f:
+            carry = f.read()
     except FileNotFoundError:
+        carry = b""
+
+    def read_range(start, end):
+        head = read_plain_range(job_name, build_number, start, min(end, stored)) if start < stored else b""
+        return head + carry[max(start, carry_start) - carry_start:max(end, carry_start) - carry_start]
+
+    counts = update_problem_index(state_path, get_problem_index_path(job_name, build_number),
+                                  read_range, plain_offset, plain)
+    line_start = max(load_problem_state(state_path)["line_start"], stored)
+    carry = (carry + plain)[line_start - carry_start:]
+    tmp_path = carry_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(carry if len(carry) <= MAX_CARRY else b"")  # longer lines are not re-read
+    os.replace(tmp_path, carry_path)
+    return counts
+
+def finalize_log(job_name, build_number):
+    """Build finished: let the backend seal/offload what it holds"""
+    get_log_backend(job_name, build_number).finalize(job_name, build_number)
+
+def log_exists(job_name, build_number):
+    return get_log_backend(job_name, build_number).exists(job_name, build_number)
+
+def get_log_size(job_name, build_number):
+    """Bytes ingested so far, including any dropped by the size limit"""
+    return get_capped_log(job_name, build_number).size()
+
+def read_log_range(job_name, build_number, start, end):
+    """Raw log bytes [start, end)"""
+    return get_capped_log(job_name, build_number).read_range(start, end)
+
+def tail_log(job_name, build_number, last_lines=1000):
+    """Last N lines of the raw log as text"""
+    return get_capped_log(job_name, build_number).tail(last_lines).decode(errors="replace")
+
+def iter_log(job_name, build_number, start=0, end=None):
+    """Raw log in bounded chunks"""
+    return get_capped_log(job_name, build_number).iter_range(start, end)
+
+def read_plain_range(job_name, build_number, start, end):
+    """Bytes [start, end) of plain.log"""
+    with open(get_plain_log_path(job_name, build_number), "rb") as f:
+        f.seek(start)
+        return f.read(max(0, end - start))
+
+def iter_plain_log(job_name, build_number, chunk_size=STREAM_CHUNK_SIZE):
+    """plain.log in bounded chunks"""
+    with open(get_plain_log_path(job_name, build_number), "rb") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+def read_offset_map(job_name, build_number):
+    return OffsetMap(get_plain_map_path(job_name, build_number))
+
+def read_problem_index(job_name, build_number, level=None, offset=0, limit=200):
+    return read_problems(get_problem_state_path(job_name, build_number),
+                         get_problem_index_path(job_name, build_number), level, offset, limit)
+
+def read_stage_index(job_name, build_number):
+    return load_stage_index(get_stage_index_path(job_name, build_number))
+
+def read_log(job_name, build_number, tail_lines=None):
+    if not log_exists(job_name, build_number):
         return None
+    if tail_lines:
+        return tail_log(job_name, build_number, tail_lines)
+    return read_log_range(job_name, build_number, 0, get_log_size(job_name, build_number)).decode("utf-8", errors="replace")
 
 def read_logs(file_path, last_lines=1000):
     """Read last N lines of a log file efficiently"""
@@ -56,9 +315,22 @@ def read_logs(file_path, last_lines=1000):
 
 def save_meta(job_name, build_number, meta_dict):
     ensure_build_dir(job_name, build_number)
+    dropped = get_capped_log(job_name, build_number).dropped_range()
+    if dropped:
+        meta_dict = dict(meta_dict, dropped_range=_dropped_meta(dropped))
     with open(get_meta_path(job_name, build_number), "w", encoding="utf-8") as f:
         json.dump(meta_dict, f)
 
+def _dropped_meta(dropped):
+    start, end = dropped
+    return {"start": start, "end": end, "bytes": end - start}
+
+def _record_dropped_range(job_name, build_number, dropped):
+    meta = read_meta(job_name, build_number) or {}
+    meta["dropped_range"] = _dropped_meta(dropped)
+    with open(get_meta_path(job_name, build_number), "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+
 def read_meta(job_name, build_number):
     try:
         with open(get_meta_path(job_name, build_number), "r", encoding="utf-8") as f:
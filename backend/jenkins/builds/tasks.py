@@ -1,14 +1,26 @@
 import os
 import django
 import time
+from django.apps import apps
 
-os.environ.setdefault("DJANGO_SETTINGS_MODULE", "jenkins.settings")
-django.setup()
+if not apps.ready:
+    # imported by the dramatiq CLI directly: set up the ORM-only worker profile
+    # (worker.py, manage.py and the web app have set Django up already)
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "jenkins.settings_worker")
+    django.setup()
 
 import requests
 from django.utils import timezone
 from .models import BuildRecord
-from .storage import append_to_log, save_meta
+from .storage import append_to_log, save_meta, get_full_log_path, finalize_log, get_log_size
+from .leases import make_owner_id, acquire_lease, resume_offset, heartbeat, release_lease, hand_over_lease, get_lease_config
+from .controllers import get_build_client
+from .testreports import ingest_test_report
+from .fleet import POLLER_NODE, node_queue, enqueue_poller, is_assigned_elsewhere
+from .changefeed import wait_for_build_event, forget_build_events
+from .webhooks import get_webhook_config
+from .profiling import poll_spans
+from .telemetry import apply_build_times, from_millis, BUILD_TIMES_TREE
 from builds.broker import broker
 import dramatiq
 import logging
@@ -23,11 +35,158 @@ if not logger.handlers:
     handler.setFormatter(formatter)
     logger.addHandler(handler)
 
-JENKINS_USER = "admin"
-JENKINS_TOKEN = "11675a28f9e88da72c7844548ac4aa14f0"
-JENKINS_URL = "http://localhost:8080"
+# Short control actors (trigger/stop) and hours-long pollers use separate
+# queues so that a poller pool with every thread busy never delays a stop.
+# Worker pools per queue are configured in settings.DRAMATIQ_WORKER_POOLS.
+CONTROL_QUEUE = "control"
+POLLER_QUEUE = "pollers"
+# Lower is served first when one worker consumes both queues
+CONTROL_PRIORITY = 0
+POLLER_PRIORITY = 100
+POLLER_TIME_LIMIT = 24 * 60 * 60 * 1000
 
-@dramatiq.actor
+# A fleet node's workers also consume the node's own poller queue
+if POLLER_NODE:
+    broker.declare_queue(node_queue(POLLER_NODE))
+
+# progressiveText is streamed to storage in chunks of this size, never decoded
+INGEST_CHUNK_SIZE = 256 * 1024
+
+# Statuses a poller still has work for (STOPPED = stop requested, drain pending)
+POLLABLE_STATUSES = ['PENDING', 'RUNNING', 'STOPPED']
+
+
+def trigger_jenkins_build(build_record):
+    """Trigger the Jenkins job, return the queue item URL (None marks the record FAILED)"""
+    job_name = build_record.job_name
+    client = get_build_client(build_record)
+    trigger_url = f"{client.url}/job/{job_name}/build?delay=0sec"
+    logger.info(f"Triggering Jenkins build at: {trigger_url}")
+
+    try:
+        r = client.post(trigger_url, timeout=15)
+        if r.status_code not in [200, 201]:
+            logger.error(f"Failed to trigger build, status_code={r.status_code}")
+            build_record.status = 'FAILED'
+            build_record.save()
+            return None
+        build_record.triggered_at = timezone.now()
+        logger.info("Build triggered successfully")
+    except Exception as e:
+        logger.exception(f"Exception while triggering Jenkins build: {e}")
+        build_record.status = 'FAILED'
+        build_record.save()
+        return None
+
+    queue_url = r.headers.get('Location')
+    if not queue_url:
+        logger.error("No Location header returned from Jenkins, cannot fetch queue info")
+        build_record.status = 'FAILED'
+        build_record.save()
+        return None
+    return queue_url
+
+
+def wait_for_build_number(build_record, queue_url):
+    """Poll the Jenkins queue item until it turns into a build, return its number"""
+    job_name = build_record.job_name
+    client = get_build_client(build_record)
+    queue_api = queue_url + "api/json"
+    build_number = None
+    waited = 0
+    max_wait = 30
+    while build_number is None and waited < max_wait:
+        try:
+            q = client.get(queue_api, timeout=10).json()
+            if not build_record.queued_at and q.get('inQueueSince'):
+                build_record.queued_at = from_millis(q['inQueueSince'])
+            executable = q.get('executable')
+            if executable and executable.get('number'):
+                build_number = executable['number']
+                build_record.build_number = build_number
+                build_record.status = 'RUNNING'
+                build_record.start_time = timezone.now()
+                build_record.log_path = get_full_log_path(job_name, build_number)
+                build_record.save()
+                logger.info(f"Build started with build_number={build_number}")
+                break
+        except Exception as e:
+            logger.exception(f"Error while polling queue: {e}")
+        time.sleep(2)
+        waited += 2
+
+    if build_number is None:
+        logger.error("Build number not obtained after waiting, marking FAILED")
+        build_record.status = 'FAILED'
+        build_record.save()
+    return build_number
+
+
+def store_problem_counts(build_record, counts):
+    """Copy the ingest-time problem counts onto the record for list views"""
+    if not counts:
+        return
+    error_count, warning_count = counts.get("error", 0), counts.get("warning", 0)
+    if (error_count, warning_count) != (build_record.error_count, build_record.warning_count):
+        build_record.error_count = error_count
+        build_record.warning_count = warning_count
+        BuildRecord.objects.filter(id=build_record.id).update(error_count=error_count, warning_count=warning_count)
+
+
+def ingest_progressive_log(client, log_api, build_record, log_offset, timeout=30, spans=None):
+    """Stream progressiveText from log_offset into the log as raw bytes.
+
+    Returns (response headers, bytes stored). Memory stays bounded by
+    INGEST_CHUNK_SIZE and a multi-byte character cut between chunks is
+    just two appends of its bytes. If the connection breaks mid-body,
+    what was stored is kept and reported as "more data" so the next
+    request continues right after it. With spans, the time goes to
+    "disk" (append and indexes) and "http" (everything else).
+    """
+    received = 0
+    started = time.perf_counter()
+    disk = 0.0
+    try:
+        with client.get(log_api, params={"start": log_offset}, timeout=timeout, stream=True) as r:
+            r.raise_for_status()
+            for chunk in r.iter_content(chunk_size=INGEST_CHUNK_SIZE):
+                append_started = time.perf_counter()
+                store_problem_counts(build_record, append_to_log(build_record.job_name, build_record.build_number, chunk))
+                disk += time.perf_counter() - append_started
+                received += len(chunk)
+            return r.headers, received
+    except requests.RequestException as e:
+        if not received:
+            raise
+        logger.warning(f"progressiveText cut after {received} bytes at offset {log_offset}: {e}")
+        return {"X-More-Data": "true"}, received
+    finally:
+        if spans is not None:
+            spans.add("disk", disk)
+            spans.add("http", time.perf_counter() - started - disk)
+
+
+@dramatiq.actor(queue_name=CONTROL_QUEUE, priority=CONTROL_PRIORITY)
+def trigger_build(build_id):
+    """Trigger a Jenkins build and hand it over to the poller pool."""
+    try:
+        build_record = BuildRecord.objects.get(id=build_id)
+    except BuildRecord.DoesNotExist:
+        logger.error(f"BuildRecord {build_id} does not exist, not triggering.")
+        return
+
+    # Redelivered message: the build was already triggered
+    if not (build_record.build_number or build_record.queue_url):
+        queue_url = trigger_jenkins_build(build_record)
+        if not queue_url:
+            return
+        build_record.queue_url = queue_url
+        build_record.save(update_fields=["queue_url", "triggered_at", "updated_at"])
+
+    enqueue_poller(start_and_poll_build, build_record)
+
+
+@dramatiq.actor(queue_name=CONTROL_QUEUE, priority=CONTROL_PRIORITY)
 def stop_build(build_id):
     """Stop a running Jenkins build."""
     try:
@@ -38,10 +197,11 @@ def stop_build(build_id):
 
         job_name = build_record.job_name
         build_number = build_record.build_number
-        stop_url = f"{JENKINS_URL}/job/{job_name}/{build_number}/stop"
+        client = get_build_client(build_record)
+        stop_url = f"{client.url}/job/{job_name}/{build_number}/stop"
 
         logger.info(f"Sending stop command to Jenkins for {job_name} #{build_number}")
-        r = requests.post(stop_url, auth=(JENKINS_USER, JENKINS_TOKEN), timeout=20, verify=False)
+        r = client.post(stop_url, timeout=20)
 
         if r.status_code in [200, 201]:
             logger.info(f"Jenkins accepted stop for {job_name} #{build_number}")
@@ -54,11 +214,12 @@ def stop_build(build_id):
     except Exception as e:
         logger.exception(f"Error while stopping build_id={build_id}: {e}")
 
-@dramatiq.actor
+@dramatiq.actor(queue_name=POLLER_QUEUE, priority=POLLER_PRIORITY, time_limit=POLLER_TIME_LIMIT)
 def start_and_poll_build(build_id):
     """Poll Jenkins build logs and update BuildRecord"""
     logger.info(f"Task started for BuildRecord id={build_id}")
     build_record = None
+    lease = None
 
     try:
         try:
@@ -68,110 +229,117 @@ def start_and_poll_build(build_id):
             logger.error(f"BuildRecord {build_id} does not exist. Exiting task.")
             return
 
+        if is_assigned_elsewhere(build_record):
+            logger.info(f"Build id={build_id} moved to node {build_record.assigned_node}, dropping stale message")
+            return
+
         job_name = build_record.job_name
         logger.info(f"Job name: {job_name}")
 
-        # Trigger build if needed
+        # Trigger build if needed (normally already done by trigger_build)
         if not build_record.build_number:
-            trigger_url = f"{JENKINS_URL}/job/{job_name}/build?delay=0sec"
-            logger.info(f"Triggering Jenkins build at: {trigger_url}")
-
-            try:
-                r = requests.post(trigger_url, auth=(JENKINS_USER, JENKINS_TOKEN), timeout=15, verify=False)
-                if r.status_code not in [200, 201]:
-                    logger.error(f"Failed to trigger build, status_code={r.status_code}")
-                    build_record.status = 'FAILED'
-                    build_record.save()
-                    return
-                logger.info("Build triggered successfully")
-            except Exception as e:
-                logger.exception(f"Exception while triggering Jenkins build: {e}")
-                build_record.status = 'FAILED'
-                build_record.save()
-                return
-
-            # Poll queue for build number
-            queue_url = r.headers.get('Location')
+            queue_url = build_record.queue_url or trigger_jenkins_build(build_record)
             if not queue_url:
-                logger.error("No Location header returned from Jenkins, cannot fetch queue info")
-                build_record.status = 'FAILED'
-                build_record.save()
                 return
-
-            queue_api = queue_url + "api/json"
-            build_number = None
-            waited = 0
-            max_wait = 30
-            while build_number is None and waited < max_wait:
-                try:
-                    q = requests.get(queue_api, auth=(JENKINS_USER, JENKINS_TOKEN), timeout=10, verify=False).json()
-                    executable = q.get('executable')
-                    if executable and executable.get('number'):
-                        build_number = executable['number']
-                        build_record.build_number = build_number
-                        build_record.status = 'RUNNING'
-                        build_record.start_time = timezone.now()
-                        build_record.save()
-                        logger.info(f"Build started with build_number={build_number}")
-                        break
-                except Exception as e:
-                    logger.exception(f"Error while polling queue: {e}")
-                time.sleep(2)
-                waited += 2
-
+            build_number = wait_for_build_number(build_record, queue_url)
             if build_number is None:
-                logger.error("Build number not obtained after waiting, marking FAILED")
-                build_record.status = 'FAILED'
-                build_record.save()
                 return
         else:
             build_number = build_record.build_number
-            build_record.status = 'RUNNING'
+
+        # ---- Single flight: only the lease owner streams this build ----
+        lease_config = get_lease_config()
+        lease = acquire_lease(job_name, build_number, make_owner_id())
+        if lease is None:
+            if build_record.status in POLLABLE_STATUSES:
+                # stand by: the owner hands over on a rebalance, or its lease expires if it dies
+                enqueue_poller(start_and_poll_build, build_record, delay=lease_config["heartbeat_interval"] * 1000)
+            logger.info(f"{job_name} #{build_number} is polled by another worker, standing by")
+            return
+        if build_record.status not in POLLABLE_STATUSES:
+            logger.info(f"{job_name} #{build_number} already finished with {build_record.status}, nothing to poll")
+            return
+
+        if build_record.status != 'RUNNING' or not build_record.log_path:
+            if build_record.status == 'PENDING':
+                build_record.status = 'RUNNING'
             build_record.start_time = build_record.start_time or timezone.now()
+            build_record.log_path = get_full_log_path(job_name, build_number)
             build_record.save()
-            logger.info(f"Build already triggered, continuing with build_number={build_number}")
+            logger.info(f"Continuing with build_number={build_number}")
 
         # Poll progressive logs
+        client = get_build_client(build_record)
         poll_interval = 2
+        webhook_config = get_webhook_config()
+        # Jenkins pushes completion, so a quiet build can be polled less often
+        idle_poll_interval = webhook_config["idle_poll_interval"] if webhook_config["enabled"] else poll_interval
+        current_interval = poll_interval
         db_refresh_interval = 5
         stable_timeout = 15
-        log_offset = 0
+        # resumes from the checkpoint when taking over from a dead owner
+        log_offset = resume_offset(lease, get_log_size(job_name, build_number))
         finished = False
         no_log_since = None
         last_db_check = 0
+        last_heartbeat = time.time()
         poll_count = 0
-        logger.info(f"Start polling logs for build_number={build_number}")
+        spans = poll_spans()  # http / disk / db / sleep per poll, see builds/profiling.py
+        logger.info(f"Start polling logs for build_number={build_number} at offset={log_offset}")
+
+        def keep_lease():
+            """Heartbeat and checkpoint when due, False once another worker took the build"""
+            nonlocal last_heartbeat
+            if time.time() - last_heartbeat <= lease_config["heartbeat_interval"]:
+                return True
+            with spans("db"):
+                alive = heartbeat(lease, log_offset, get_log_size(job_name, build_number))
+            if not alive:
+                logger.warning(f"Lost lease on {job_name} #{build_number}, another worker took over")
+                return False
+            last_heartbeat = time.time()
+            return True
 
         while not finished:
             poll_count += 1
-            log_api = f"{JENKINS_URL}/job/{job_name}/{build_number}/logText/progressiveText"
+            log_api = f"{client.url}/job/{job_name}/{build_number}/logText/progressiveText"
 
             try:
-                # ---- Throttled DB refresh ----
+                # ---- Lease heartbeat and offset checkpoint ----
+                if not keep_lease():
+                    return
+
+                # ---- Throttled DB refresh (immediate after a pushed event) ----
                 if time.time() - last_db_check > db_refresh_interval:
-                    build_record.refresh_from_db()
+                    with spans("db"):
+                        build_record.refresh_from_db()
                     last_db_check = time.time()
+                    if is_assigned_elsewhere(build_record):
+                        logger.info(f"{job_name} #{build_number} moved to node {build_record.assigned_node}, handing over")
+                        hand_over_lease(lease, log_offset, get_log_size(job_name, build_number))
+                        lease = None  # the checkpoint stays for the next owner
+                        return
 
                 if build_record.status == "STOPPED":
                     logger.info(f"Build #{build_number} marked STOPPED — sending stop and draining logs.")
-                    stop_url = f"{JENKINS_URL}/job/{job_name}/{build_number}/stop"
+                    stop_url = f"{client.url}/job/{job_name}/{build_number}/stop"
                     try:
-                        requests.post(stop_url, auth=(JENKINS_USER, JENKINS_TOKEN), timeout=20, verify=False)
+                        client.post(stop_url, timeout=20)
                         logger.info(f"Stop command sent to Jenkins for build #{build_number}")
                     except Exception as e:
                         logger.warning(f"Failed to stop Jenkins build: {e}")
 
                     # Poll progressive logs until Jenkins confirms build stopped
                     while True:
-                        r = requests.get(log_api, params={"start": log_offset}, auth=(JENKINS_USER, JENKINS_TOKEN), timeout=30, verify=False)
-                        text_chunk = r.text or ""
-                        if text_chunk:
-                            append_to_log(job_name, build_number, text_chunk)
-                            log_offset = int(r.headers.get("X-Text-Size", log_offset + len(text_chunk)))
+                        # a slow abort outlives the ttl: keep the lease so no standby drains it too
+                        if not keep_lease():
+                            return
+                        headers, received = ingest_progressive_log(client, log_api, build_record, log_offset)
+                        if received:
+                            log_offset = int(headers.get("X-Text-Size", log_offset + received))
 
                         # Check if Jenkins build finished
-                        info = requests.get(f"{JENKINS_URL}/job/{job_name}/{build_number}/api/json",
-                                            auth=(JENKINS_USER, JENKINS_TOKEN), timeout=10, verify=False).json()
+                        info = client.get(f"{client.url}/job/{job_name}/{build_number}/api/json", timeout=10).json()
                         if not info.get("building", True):
                             logger.info(f"Jenkins build #{build_number} fully stopped.")
                             break
@@ -179,9 +347,9 @@ def start_and_poll_build(build_id):
                     
                     # Fetch final build result to reflect ABORTED/FAILURE if any
                     try:
-                        info = requests.get(f"{JENKINS_URL}/job/{job_name}/{build_number}/api/json",
-                                            auth=(JENKINS_USER, JENKINS_TOKEN), timeout=10, verify=False).json()
+                        info = client.get(f"{client.url}/job/{job_name}/{build_number}/api/json", timeout=10).json()
                         build_record.status = info.get("result") or "STOPPED"
+                        apply_build_times(build_record, info)
                     except Exception:
                         build_record.status = "STOPPED"
                     build_record.end_time = timezone.now()
@@ -189,41 +357,49 @@ def start_and_poll_build(build_id):
                     finished = True
                     continue
 
-                # ---- Fetch progressive logs ----
-                r = requests.get(
-                    log_api,
-                    params={"start": log_offset},
-                    auth=(JENKINS_USER, JENKINS_TOKEN),
-                    timeout=30,
-                    verify=False,
-                )
-                r.raise_for_status()
-                text_chunk = r.text or ""
-                append_to_log(job_name, build_number, text_chunk)
-                
+                # ---- Stream progressive logs straight to storage (byte offsets) ----
+                headers, received = ingest_progressive_log(client, log_api, build_record, log_offset, spans=spans)
+
                 prev_offset = log_offset
-                log_offset = int(r.headers.get("X-Text-Size", log_offset + len(text_chunk)))
+                log_offset = int(headers.get("X-Text-Size", log_offset + received))
 
                 # ---- Small periodic info log ----
                 if poll_count % 10 == 0:
-                    logger.info(f"Polling #{poll_count}: offset={log_offset}, job={job_name}")
+                    logger.info(f"Polling #{poll_count}: offset={log_offset}, job={job_name} {spans.summary()}")
+
+                # ---- Completion pushed by Jenkins: drain and stop without asking ----
+                if build_record.jenkins_result and headers.get("X-More-Data") != "true":
+                    finished = True
+                    logger.info(f"Build #{build_number} completion pushed by Jenkins, logs drained")
+                    continue
 
                 # ---- Detect end conditions ----
-                if r.headers.get("X-More-Data") == "true":
+                if headers.get("X-More-Data") == "true":
                     no_log_since = None
-                    time.sleep(poll_interval)
+                    if received or build_record.jenkins_result:
+                        current_interval = poll_interval
+                    else:
+                        current_interval = min(current_interval * 2, idle_poll_interval)
+                    with spans("sleep"):
+                        pushed = wait_for_build_event(build_id, current_interval)
+                    if pushed:
+                        last_db_check = 0
                     continue
                 
-                if r.headers.get("X-More-Data") == "false" or "X-More-Data" not in r.headers:
-                    build_info_api = f"{JENKINS_URL}/job/{job_name}/{build_number}/api/json"
-                    info = requests.get(build_info_api, auth=(JENKINS_USER, JENKINS_TOKEN), timeout=10, verify=False).json()
+                if headers.get("X-More-Data") == "false" or "X-More-Data" not in headers:
+                    build_info_api = f"{client.url}/job/{job_name}/{build_number}/api/json"
+                    with spans("http"):
+                        info = client.get(build_info_api, timeout=10).json()
 
                     if info.get("building") is False:
                         finished = True
                         logger.info(f"Build logs completed for #{build_number}")
                     else:
                         # build still running but Jenkins hasn't updated logs yet
-                        time.sleep(poll_interval)
+                        with spans("sleep"):
+                            pushed = wait_for_build_event(build_id, poll_interval)
+                        if pushed:
+                            last_db_check = 0
                     continue
 
                 # ---- Stable timeout detection ----
@@ -236,17 +412,29 @@ def start_and_poll_build(build_id):
                 else:
                     no_log_since = None
                 
-                time.sleep(poll_interval)
+                with spans("sleep"):
+                    time.sleep(poll_interval)
 
             except Exception as e:
                 logger.exception(f"Error while polling logs: {e}")
                 time.sleep(poll_interval)
 
-        # Fetch final result
-        build_info_api = f"{JENKINS_URL}/job/{job_name}/{build_number}/api/json"
+        forget_build_events(build_id)
+        if spans.enabled:
+            logger.info(f"Polled {job_name} #{build_number} in {poll_count} iterations: {spans.summary()}")
+
+        # Fetch final result (a pushed one wins) and the Jenkins start / duration in one request
+        build_info_api = f"{client.url}/job/{job_name}/{build_number}/api/json"
         try:
-            info = requests.get(build_info_api, auth=(JENKINS_USER, JENKINS_TOKEN), timeout=10, verify=False).json()
-            result = info.get('result')
+            try:
+                info = client.get(build_info_api, params={"tree": BUILD_TIMES_TREE}, timeout=10).json()
+            except Exception as e:
+                if not build_record.jenkins_result:
+                    raise
+                logger.warning(f"Could not fetch build times of #{build_number}: {e}")
+                info = {}
+            result = build_record.jenkins_result or info.get('result')
+            apply_build_times(build_record, info)
             build_record.status = result if result else 'FAILED'
             build_record.end_time = timezone.now()
             build_record.save()
@@ -257,6 +445,12 @@ def start_and_poll_build(build_id):
             build_record.end_time = timezone.now()
             build_record.save()
 
+        # Test report: fetched once here, queried later from the compact store
+        try:
+            ingest_test_report(client, build_record)
+        except Exception as e:
+            logger.exception(f"Error ingesting test report: {e}")
+
         # Save meta.json
         try:
             save_meta(job_name, build_number, {
@@ -268,8 +462,17 @@ def start_and_poll_build(build_id):
         except Exception as e:
             logger.exception(f"Error saving meta.json: {e}")
 
+        # The final status is saved, a failing backend must not turn it into FAILED
+        try:
+            finalize_log(job_name, build_number)
+        except Exception as e:
+            logger.exception(f"Error finalizing log of #{build_number}: {e}")
+
     except Exception as e:
       logger.exception(f"Unhandled exception in worker for build_id={build_id}: {e}")
       if build_record:
           build_record.status = 'FAILED'
           build_record.save()
+    finally:
+        if lease:
+            release_lease(lease)
@@ -1,22 +1,25 @@
 import os
 import django
 import time
+from django.apps import apps
 
-os.environ.setdefault("DJANGO_SETTINGS_MODULE", "jenkins.settings")
-django.setup()
+if not apps.ready:
+    # imported by the dramatiq CLI directly: set up the ORM-only worker profile
+    # (worker.py, manage.py and the web app have set Django up already)
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "jenkins.settings_worker")
+    django.setup()
 
 import requests
 import logging
 from django.utils import timezone
 import dramatiq
 from .models import BuildRecord
-from .storage import append_to_log, save_meta, read_meta
+from .storage import append_to_log, save_meta, get_full_log_path, finalize_log, get_log_size
+from .controllers import get_build_client
+from .leases import make_owner_id, acquire_lease, resume_offset, heartbeat, release_lease, get_lease_config
+from .telemetry import apply_build_times
 from builds.broker import broker
 
-JENKINS_URL = "http://localhost:8080"
-JENKINS_USER = "admin"
-JENKINS_TOKEN = "11675a28f9e88da72c7844548ac4aa14f0"
-
 # Setup logger
 logger = logging.getLogger("jenkins_worker")
 logger.setLevel(logging.INFO)
@@ -26,11 +29,10 @@ if not logger.handlers:
     handler.setFormatter(logging.Formatter("%(asctime)s [%(levelname)s] %(message)s"))
     logger.addHandler(handler)
 
-def http_post(url, data=None, retries=3, timeout=10):
+def http_post(client, url, data=None, retries=3, timeout=10):
     for attempt in range(retries):
         try:
-            r = requests.post(url, data=data, auth=(JENKINS_USER, JENKINS_TOKEN),
-                              timeout=timeout, verify=False)
+            r = client.post(url, data=data, timeout=timeout)
             r.raise_for_status()
             return r
         except requests.RequestException as e:
@@ -41,10 +43,9 @@ def http_post(url, data=None, retries=3, timeout=10):
             time.sleep(1)
     return None
 
-def http_get(url, params=None, timeout=10, skip_warning=False):
+def http_get(client, url, params=None, timeout=10, skip_warning=False):
     try:
-        r = requests.get(url, params=params, auth=(JENKINS_USER, JENKINS_TOKEN),
-                         timeout=timeout, verify=False)
+        r = client.get(url, params=params, timeout=timeout)
         r.raise_for_status()
         return r
     except requests.RequestException as e:
@@ -55,18 +56,18 @@ def http_get(url, params=None, timeout=10, skip_warning=False):
         logger.error(f"GET {url} failed (unexpected exception): {e}")
         return None
 
-def get_running_build_number(job_name):
+def get_running_build_number(client, job_name):
     running_build_number = None
 
     # 1️⃣ Check the latest build only
-    r_job = http_get(f"{JENKINS_URL}/job/{job_name}/api/json?tree=lastBuild[number,building]")
+    r_job = http_get(client, f"{client.url}/job/{job_name}/api/json?tree=lastBuild[number,building]")
     if r_job:
         last_build = r_job.json().get("lastBuild")
         if last_build and last_build.get("building"):
             return last_build["number"]
 
     # 2️⃣ Also check the queue to see if a build is waiting
-    r_queue = http_get(f"{JENKINS_URL}/queue/api/json?tree=items[task[name],id]")
+    r_queue = http_get(client, f"{client.url}/queue/api/json?tree=items[task[name],id]")
     if r_queue:
         for item in r_queue.json().get("items", []):
             if item.get("task", {}).get("name") == job_name:
@@ -75,46 +76,73 @@ def get_running_build_number(job_name):
 
     return running_build_number
 
-@dramatiq.actor(time_limit=24*60*60*1000)
+def wait_for_queued_build(client, queue_id, attempts=10):
+    """Build number of a queue item once Jenkins starts it, None if it is still queued"""
+    for _ in range(attempts):
+        r_item = http_get(client, f"{client.url}/queue/item/{queue_id}/api/json", skip_warning=True)
+        if r_item:
+            executable = r_item.json().get("executable") or {}
+            if executable.get("number"):
+                return executable["number"]
+        time.sleep(2)
+    return None
+
+@dramatiq.actor(queue_name="pollers", priority=100, time_limit=24*60*60*1000)
 def start_and_poll_build(build_id):
     """Start Jenkins build and poll until completion (basic)."""
     build_record = None
+    lease = None
     log_offset = 0
     try:
         build_record = BuildRecord.objects.get(id=build_id)
         job_name = build_record.job_name
-        logger.info(f"Preparing build for job={job_name}")
+        client = get_build_client(build_record)
+        logger.info(f"Preparing build for job={job_name} on {client.name}")
 
         # --- 1️⃣ Check for already running build ---
-        running_build_number = get_running_build_number(job_name)
+        running_build_number = get_running_build_number(client, job_name)
+        if isinstance(running_build_number, str) and running_build_number.startswith("queued-"):
+            # leases, logs and polling need the real build number, not the queue item
+            queue_id = running_build_number[len("queued-"):]
+            running_build_number = wait_for_queued_build(client, queue_id)
+            if running_build_number is None:
+                logger.info(f"{job_name} queue item {queue_id} has not started yet, retrying later")
+                start_and_poll_build.send_with_options(args=(build_id,), delay=get_lease_config()["heartbeat_interval"] * 1000)
+                return
 
         if running_build_number:
+            # another worker may already be attached to this build
+            lease = acquire_lease(job_name, running_build_number, make_owner_id())
+            if lease is None:
+                logger.info(f"{job_name} #{running_build_number} is polled by another worker, not attaching")
+                return
             logger.info(f"Build already running: {job_name} #{running_build_number}, attaching logs")
             build_record.build_number = running_build_number
             build_record.status = "RUNNING"
             build_record.start_time = build_record.start_time or timezone.now()
+            build_record.log_path = get_full_log_path(job_name, running_build_number)
             build_record.save()
 
-            # Load last log_offset from meta
-            meta = read_meta(job_name, running_build_number) or {}
-            log_offset = meta.get("last_log_offset", 0)
+            # Continue from the lease checkpoint (skips what is stored already)
+            log_offset = resume_offset(lease, get_log_size(job_name, running_build_number))
 
             # assign build_number for later usage
             build_number = running_build_number
         else:
             logger.info(f"Starting build for job={job_name}")
             # --- 2️⃣ Trigger new build as usual ---
-            trigger_url = f"{JENKINS_URL}/job/{job_name}/build?delay=0sec"
-            r = http_post(trigger_url)
+            trigger_url = f"{client.url}/job/{job_name}/build?delay=0sec"
+            r = http_post(client, trigger_url)
             if not r:
                 build_record.status = "FAILED"
                 build_record.save()
                 return
+            build_record.triggered_at = timezone.now()
 
             # Wait for build number
             build_number = None
             for _ in range(10):
-                r_info = http_get(f"{JENKINS_URL}/job/{job_name}/api/json")
+                r_info = http_get(client, f"{client.url}/job/{job_name}/api/json")
                 if r_info:
                     info = r_info.json()
                     if info.get("builds"):
@@ -128,9 +156,15 @@ def start_and_poll_build(build_id):
                 build_record.save()
                 return
 
+            lease = acquire_lease(job_name, build_number, make_owner_id())
+            if lease is None:
+                logger.info(f"{job_name} #{build_number} is polled by another worker")
+                return
+
             build_record.build_number = build_number
             build_record.status = "RUNNING"
             build_record.start_time = timezone.now()
+            build_record.log_path = get_full_log_path(job_name, build_number)
             build_record.save()
             log_offset = 0
             logger.info(f"Build started with build_number={build_number}")
@@ -139,18 +173,27 @@ def start_and_poll_build(build_id):
         poll_interval_logs = 2
         poll_interval_status = 15
         last_status_check = time.time()
+        heartbeat_interval = get_lease_config()["heartbeat_interval"]
+        last_heartbeat = time.time()
         while True:
             build_record.refresh_from_db()
 
+            if time.time() - last_heartbeat >= heartbeat_interval:
+                if not heartbeat(lease, log_offset, get_log_size(job_name, build_number)):
+                    logger.warning(f"Lost lease on {job_name} #{build_number}, another worker took over")
+                    return
+                last_heartbeat = time.time()
+
             # Fetch progressive logs
-            log_api = f"{JENKINS_URL}/job/{job_name}/{build_number}/logText/progressiveText"
-            r_log = http_get(log_api, params={"start": log_offset}, timeout=10, skip_warning=True)
+            log_api = f"{client.url}/job/{job_name}/{build_number}/logText/progressiveText"
+            r_log = http_get(client, log_api, params={"start": log_offset}, timeout=10, skip_warning=True)
             more_data = False
 
             if r_log:
-                if r_log.text:
-                    append_to_log(job_name, build_number, r_log.text)
-                    log_offset = int(r_log.headers.get("X-Text-Size", log_offset + len(r_log.text)))
+                # raw bytes: offsets are byte offsets, no decode/re-encode round trip
+                if r_log.content:
+                    append_to_log(job_name, build_number, r_log.content)
+                    log_offset = int(r_log.headers.get("X-Text-Size", log_offset + len(r_log.content)))
                     # logger.info(f"✅ Progressive log fetch SUCCESS for {job_name} #{build_number}, offset={log_offset}")
 
                     # Save intermediate log_offset for resumability
@@ -171,13 +214,14 @@ def start_and_poll_build(build_id):
             building = True
             result = None
             if time.time() - last_status_check >= poll_interval_status:
-                build_api = f"{JENKINS_URL}/job/{job_name}/{build_number}/api/json"
-                r_status = http_get(build_api, timeout=5, skip_warning=True)
+                build_api = f"{client.url}/job/{job_name}/{build_number}/api/json"
+                r_status = http_get(client, build_api, timeout=5, skip_warning=True)
                 last_status_check = time.time()
                 if r_status:
                     info = r_status.json()
                     building = info.get("building", True)
                     result = info.get("result")
+                    apply_build_times(build_record, info)
                     # logger.info(f"📊 Build status check SUCCESS for {job_name} #{build_number}: building={building}, result={result}")
                 else:
                     # logger.warning(f"⏱️ Build status check TIMEOUT for {job_name} #{build_number}")
@@ -186,11 +230,11 @@ def start_and_poll_build(build_id):
             if not building:
                 stable_offset = False
                 while not stable_offset:
-                    r_log = http_get(log_api, params={"start": log_offset}, timeout=10, skip_warning=True)
+                    r_log = http_get(client, log_api, params={"start": log_offset}, timeout=10, skip_warning=True)
                     if r_log:
-                        text = r_log.text or ""
-                        append_to_log(job_name, build_record.build_number, text)
-                        new_offset = int(r_log.headers.get("X-Text-Size", log_offset + len(text)))
+                        data = r_log.content or b""
+                        append_to_log(job_name, build_record.build_number, data)
+                        new_offset = int(r_log.headers.get("X-Text-Size", log_offset + len(data)))
                         save_meta(job_name, build_record.build_number, {
                             "status": build_record.status,
                             "start_time": str(build_record.start_time),
@@ -221,16 +265,20 @@ def start_and_poll_build(build_id):
             "last_log_offset": log_offset,
         })
         logger.info(f"✅ Log collection complete and meta saved for {job_name} #{build_record.build_number}")
+        finalize_log(job_name, build_record.build_number)
+        release_lease(lease)
 
     except Exception as e:
         logger.exception(f"Error in start_and_poll_build: {e}")
         if build_record:
             build_record.status = "FAILED"
             build_record.save()
+        if lease:
+            release_lease(lease)
     finally:
         return
 
-@dramatiq.actor
+@dramatiq.actor(queue_name="control", priority=0)
 def stop_build(build_id):
     """Stop Jenkins build."""
     try:
@@ -241,12 +289,13 @@ def stop_build(build_id):
 
         job_name = build_record.job_name
         build_number = build_record.build_number
-        stop_url = f"{JENKINS_URL}/job/{job_name}/{build_number}/stop"
+        client = get_build_client(build_record)
+        stop_url = f"{client.url}/job/{job_name}/{build_number}/stop"
 
         logger.info(f"Requesting stop for Jenkins build: {job_name} #{build_number}")
 
         # Call Jenkins stop API
-        r = http_post(stop_url)
+        r = http_post(client, stop_url)
         if r:
             build_record.status = "STOPPED"
             build_record.end_time = timezone.now()
@@ -0,0 +1,185 @@
+import re
+import logging
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.utils import timezone
+
+from .models import BuildRecord, ControllerSample, JenkinsController, ACTIVE_STATUSES
+from .controllers import get_client
+
+logger = logging.getLogger("jenkins_worker")
+
+DEFAULT_JENKINS_TELEMETRY = {
+    "interval": 15,            # seconds between collector ticks (manage.py collect_telemetry --loop)
+    "retention_days": 30,      # samples older than this are deleted by the collector
+}
+
+# Only the fields we keep, both endpoints are one request per controller and tick
+QUEUE_TREE = "items[id,inQueueSince,blocked,stuck]"
+COMPUTER_TREE = "busyExecutors,totalExecutors,computer[offline]"
+BUILD_TIMES_TREE = "result,timestamp,duration"
+
+QUEUE_ITEM_RE = re.compile(r"/queue/item/(\d+)/?$")
+
+# (name, start field, end field) of the phases a build goes through
+PHASES = [
+    ("admission_wait", "enqueued_at", "admitted_at"),        # our fair queue (builds/admission.py)
+    ("trigger", "triggered_at", "queued_at"),                # trigger POST until the queue item exists
+    ("queue_wait", "queued_at", "jenkins_started_at"),       # Jenkins queue: executors, throttling, quiet period
+    ("run", "jenkins_started_at", "jenkins_finished_at"),    # the build itself
+    ("poller_lag", "jenkins_finished_at", "end_time"),       # until our poller recorded the result
+]
+
+
+def get_telemetry_config():
+    config = dict(DEFAULT_JENKINS_TELEMETRY)
+    config.update(getattr(settings, "JENKINS_TELEMETRY", {}))
+    return config
+
+
+def from_millis(value):
+    """Jenkins epoch milliseconds -> aware datetime"""
+    return datetime.fromtimestamp(value / 1000, tz=dt_timezone.utc) if value else None
+
+
+def queue_item_id(queue_url):
+    match = QUEUE_ITEM_RE.search(queue_url or "")
+    return int(match.group(1)) if match else None
+
+
+def apply_build_times(build_record, info):
+    """Jenkins start / end of a build from its api/json (timestamp, duration in ms), not saved"""
+    started = from_millis(info.get("timestamp"))
+    if started:
+        build_record.jenkins_started_at = started
+        if info.get("duration"):
+            build_record.jenkins_finished_at = started + timedelta(milliseconds=info["duration"])
+
+
+# ---- Collector ----
+def sampled_controllers():
+    """Enabled controllers, plus the settings default while it has builds (or nothing else exists)"""
+    controllers = list(JenkinsController.objects.filter(enabled=True))
+    if not controllers or BuildRecord.objects.filter(controller__isnull=True, status__in=ACTIVE_STATUSES).exists():
+        controllers.append(None)
+    return controllers
+
+
+def collect_controller(controller, now=None):
+    """Fetch queue and executors of one controller once and store a sample"""
+    client = get_client(controller)
+    now = now or timezone.now()
+    queue = client.get("queue/api/json", params={"tree": QUEUE_TREE}, timeout=10)
+    queue.raise_for_status()
+    computers = client.get("computer/api/json", params={"tree": COMPUTER_TREE}, timeout=10)
+    computers.raise_for_status()
+    items = queue.json().get("items") or []
+    computer_info = computers.json()
+
+    waits = [(now - from_millis(item["inQueueSince"])).total_seconds() for item in items if item.get("inQueueSince")]
+    sample = ControllerSample.objects.create(
+        controller=controller,
+        at=now,
+        queue_length=len(items),
+        queue_blocked=sum(1 for item in items if item.get("blocked")),
+        queue_stuck=sum(1 for item in items if item.get("stuck")),
+        wait_avg=sum(waits) / len(waits) if waits else 0,
+        wait_max=max(waits, default=0),
+        executors_total=computer_info.get("totalExecutors") or 0,
+        executors_busy=computer_info.get("busyExecutors") or 0,
+        nodes_offline=sum(1 for computer in computer_info.get("computer") or [] if computer.get("offline")),
+    )
+    record_queued_times(controller, items)
+    return sample
+
+
+def record_queued_times(controller, items):
+    """queued_at of our builds still waiting in the Jenkins queue (matched by queue item id)"""
+    since = {item["id"]: from_millis(item.get("inQueueSince")) for item in items if item.get("id")}
+    if not since:
+        return
+    waiting = BuildRecord.objects.filter(controller=controller, queued_at__isnull=True, build_number__isnull=True,
+                                         queue_url__isnull=False, status__in=ACTIVE_STATUSES)
+    for build_id, queue_url in waiting.values_list("id", "queue_url"):
+        queued_at = since.get(queue_item_id(queue_url))
+        if queued_at:
+            BuildRecord.objects.filter(id=build_id, queued_at__isnull=True).update(queued_at=queued_at)
+
+
+def collect_once():
+    """One tick over all controllers, returns the stored samples"""
+    config = get_telemetry_config()
+    now = timezone.now()
+    samples = []
+    for controller in sampled_controllers():
+        try:
+            samples.append(collect_controller(controller, now))
+        except Exception as e:
+            logger.warning(f"Telemetry from {controller or 'default'} controller failed: {e}")
+    ControllerSample.objects.filter(at__lt=now - timedelta(days=config["retention_days"])).delete()
+    return samples
+
+
+# ---- Queries ----
+def controller_series(controller, since, bucket_seconds=300):
+    """Samples of a controller averaged per bucket (max for waits and queue length)"""
+    rows = (ControllerSample.objects.filter(controller=controller, at__gte=since).order_by("at")
+            .values_list("at", "queue_length", "queue_blocked", "wait_avg", "wait_max",
+                         "executors_total", "executors_busy", "nodes_offline"))
+    buckets = []
+    current = None
+    for at, length, blocked, wait_avg, wait_max, total, busy, offline in rows:
+        key = int(at.timestamp()) // bucket_seconds
+        if current is None or current["key"] != key:
+            current = {"key": key, "n": 0, "length": 0, "length_max": 0, "blocked": 0, "wait_avg": 0.0,
+                       "wait_max": 0.0, "total": 0, "busy": 0, "offline": 0}
+            buckets.append(current)
+        current["n"] += 1
+        current["length"] += length
+        current["length_max"] = max(current["length_max"], length)
+        current["blocked"] += blocked
+        current["wait_avg"] += wait_avg
+        current["wait_max"] = max(current["wait_max"], wait_max)
+        current["total"] += total
+        current["busy"] += busy
+        current["offline"] = max(current["offline"], offline)
+
+    series = []
+    for b in buckets:
+        n = b["n"]
+        series.append({
+            "at": datetime.fromtimestamp(b["key"] * bucket_seconds, tz=dt_timezone.utc),
+            "samples": n,
+            "queue_length": round(b["length"] / n, 2),
+            "queue_length_max": b["length_max"],
+            "queue_blocked": round(b["blocked"] / n, 2),
+            "wait_avg": round(b["wait_avg"] / n, 1),
+            "wait_max": round(b["wait_max"], 1),
+            "executors_total": round(b["total"] / n, 2),
+            "executors_busy": round(b["busy"] / n, 2),
+            "utilization": round(b["busy"] / b["total"], 3) if b["total"] else None,
+            "nodes_offline": b["offline"],
+        })
+    return series
+
+
+def _percentile(values, fraction):
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def build_phase_summary(builds, limit=10000):
+    """p50 / p90 / p99 / max seconds per phase over the newest builds of a queryset"""
+    fields = sorted({field for _name, start, end in PHASES for field in (start, end)})
+    rows = list(builds.order_by("-id").values(*fields)[:limit])
+    phases = {}
+    for name, start, end in PHASES:
+        seconds = sorted((row[end] - row[start]).total_seconds() for row in rows if row[start] and row[end])
+        phases[name] = {
+            "builds": len(seconds),
+            "p50": round(_percentile(seconds, 0.5), 1),
+            "p90": round(_percentile(seconds, 0.9), 1),
+            "p99": round(_percentile(seconds, 0.99), 1),
+            "max": round(seconds[-1], 1),
+        } if seconds else {"builds": 0}
+    return {"builds": len(rows), "phases": phases}
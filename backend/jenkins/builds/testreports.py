@@ -0,0 +1,233 @@
+import logging
+from array import array
+
+from django.db import IntegrityError, transaction
+from django.db.models import Max
+
+from .models import TestCaseName, TestRun
+
+logger = logging.getLogger("jenkins_worker")
+
+# Only the fields we keep, the full testReport carries stdout/stderr of every case
+TEST_REPORT_TREE = "suites[name,cases[className,name,status,duration]]"
+
+PASSED = {"PASSED", "FIXED"}
+FAILED = {"FAILED", "REGRESSION"}
+SKIPPED = {"SKIPPED"}
+
+# Values per IN (...) query, well below sqlite's bound parameter limit
+QUERY_BATCH = 500
+
+
+def fetch_test_report(client, job_name, build_number):
+    """testReport api/json of a build, None when the job publishes no tests"""
+    r = client.get(f"{client.url}/job/{job_name}/{build_number}/testReport/api/json",
+                   params={"tree": TEST_REPORT_TREE}, timeout=60)
+    if r.status_code == 404:
+        return None
+    r.raise_for_status()
+    return r.json()
+
+
+def iter_cases(report):
+    """(name, status, duration) for every case of a report"""
+    for suite in report.get("suites") or []:
+        for case in suite.get("cases") or []:
+            class_name = case.get("className") or suite.get("name") or ""
+            name = f"{class_name}.{case.get('name')}" if class_name else str(case.get("name"))
+            yield name, (case.get("status") or "").upper(), float(case.get("duration") or 0)
+
+
+def _batches(values):
+    values = list(values)
+    for start in range(0, len(values), QUERY_BATCH):
+        yield values[start:start + QUERY_BATCH]
+
+
+def intern_names(job_name, names, retries=5):
+    """{name: index}, new names get the next free indexes of the job"""
+    names = set(names)
+    for _ in range(retries):
+        known = {}
+        for batch in _batches(names):
+            known.update(TestCaseName.objects.filter(job_name=job_name, name__in=batch).values_list("name", "index"))
+        missing = sorted(names - known.keys())
+        if not missing:
+            return known
+        try:
+            with transaction.atomic():
+                highest = TestCaseName.objects.filter(job_name=job_name).aggregate(m=Max("index"))["m"]
+                start = 0 if highest is None else highest + 1
+                TestCaseName.objects.bulk_create([
+                    TestCaseName(job_name=job_name, name=name, index=start + i) for i, name in enumerate(missing)
+                ])
+        except IntegrityError:
+            continue  # another build of the job interned names at the same time
+    raise RuntimeError(f"Could not intern test names for {job_name}")
+
+
+def _to_bitmap(indexes):
+    value = 0
+    for index in indexes:
+        value |= 1 << index
+    return value.to_bytes((value.bit_length() + 7) // 8, "little")
+
+
+def _from_bitmap(data):
+    return int.from_bytes(bytes(data), "little")
+
+
+def _bits(value):
+    """Set bit positions of an int, cheap for sparse maps"""
+    while value:
+        low = value & -value
+        yield low.bit_length() - 1
+        value ^= low
+
+
+def store_test_report(build_record, report):
+    """Intern the case names and save the run, returns the TestRun"""
+    cases = list(iter_cases(report))
+    index = intern_names(build_record.job_name, (name for name, _status, _duration in cases))
+
+    passed, failed, skipped = [], [], []
+    durations = array("f", bytes(4 * (max(index.values(), default=-1) + 1)))
+    for name, case_status, duration in cases:
+        i = index[name]
+        durations[i] = duration
+        if case_status in FAILED:
+            failed.append(i)
+        elif case_status in SKIPPED:
+            skipped.append(i)
+        elif case_status in PASSED:
+            passed.append(i)
+
+    run, _created = TestRun.objects.update_or_create(
+        build=build_record,
+        defaults={
+            "job_name": build_record.job_name,
+            "build_number": build_record.build_number,
+            "total": len(cases),
+            "failed_count": len(failed),
+            "skipped_count": len(skipped),
+            "duration": sum(duration for _name, _status, duration in cases),
+            "passed": _to_bitmap(passed),
+            "failed": _to_bitmap(failed),
+            "skipped": _to_bitmap(skipped),
+            "durations": durations.tobytes(),
+        },
+    )
+    return run
+
+
+def ingest_test_report(client, build_record):
+    """Post-build stage: fetch the report once and keep it compact"""
+    report = fetch_test_report(client, build_record.job_name, build_record.build_number)
+    if not report:
+        return None
+    run = store_test_report(build_record, report)
+    logger.info(f"Stored {run.total} test results ({run.failed_count} failed) for "
+                f"{build_record.job_name} #{build_record.build_number}")
+    return run
+
+
+def _load_runs(job_name, last, fields=("passed", "failed")):
+    """Last N runs of a job, oldest first"""
+    rows = (TestRun.objects.filter(job_name=job_name).order_by("-build_number")
+            .values_list("build_number", *fields)[:last])
+    return [(row[0], *[_from_bitmap(data) for data in row[1:]]) for row in reversed(rows)]
+
+
+def _names(job_name, indexes):
+    names = {}
+    for batch in _batches(indexes):
+        names.update(TestCaseName.objects.filter(job_name=job_name, index__in=batch).values_list("index", "name"))
+    return names
+
+
+def flaky_tests(job_name, last=1000, min_flips=2, limit=100):
+    """Tests that went pass -> fail or fail -> pass at least min_flips times"""
+    runs = _load_runs(job_name, last)
+    flips, failures, last_failed = {}, {}, {}
+    prev_passed = prev_failed = 0
+    for build_number, passed, failed in runs:
+        for i in _bits((prev_passed & failed) | (prev_failed & passed)):
+            flips[i] = flips.get(i, 0) + 1
+        for i in _bits(failed):
+            failures[i] = failures.get(i, 0) + 1
+            last_failed[i] = build_number
+        # a test missing from a run keeps its previous state
+        prev_passed = (prev_passed & ~failed) | passed
+        prev_failed = (prev_failed & ~passed) | failed
+
+    flaky = sorted((i for i, n in flips.items() if n >= min_flips), key=lambda i: (-flips[i], -failures[i]))[:limit]
+    names = _names(job_name, flaky)
+    return {
+        "job_name": job_name,
+        "runs": len(runs),
+        "tests": [{
+            "name": names.get(i),
+            "flips": flips[i],
+            "failures": failures.get(i, 0),
+            "last_failed_build": last_failed.get(i),
+        } for i in flaky],
+    }
+
+
+def failure_trends(job_name, last=100, test_name=None, top=20):
+    """Per-build totals and the most failing tests over the last N runs.
+
+    With test_name, the status of that one test in every run instead.
+    """
+    if test_name:
+        case = TestCaseName.objects.filter(job_name=job_name, name=test_name).first()
+        if not case:
+            return None
+        bit = 1 << case.index
+        history = []
+        for build_number, passed, failed, skipped in _load_runs(job_name, last, ("passed", "failed", "skipped")):
+            if failed & bit:
+                case_status = "FAILED"
+            elif passed & bit:
+                case_status = "PASSED"
+            elif skipped & bit:
+                case_status = "SKIPPED"
+            else:
+                case_status = None  # not run
+            history.append({"build_number": build_number, "status": case_status})
+        return {"job_name": job_name, "test": test_name, "history": history}
+
+    rows = list(TestRun.objects.filter(job_name=job_name).order_by("-build_number")
+                .values("build_number", "total", "failed_count", "skipped_count", "duration", "failed")[:last])
+    rows.reverse()
+    failures = {}
+    for row in rows:
+        for i in _bits(_from_bitmap(row.pop("failed"))):
+            failures[i] = failures.get(i, 0) + 1
+    most = sorted(failures, key=lambda i: -failures[i])[:top]
+    names = _names(job_name, most)
+    return {
+        "job_name": job_name,
+        "builds": rows,
+        "most_failing": [{"name": names.get(i), "failures": failures[i]} for i in most],
+    }
+
+
+def build_test_results(build_record, status_filter="FAILED"):
+    """Names of the tests with a status in one build"""
+    run = TestRun.objects.filter(build=build_record).first()
+    if not run:
+        return None
+    bitmap = {"FAILED": run.failed, "PASSED": run.passed, "SKIPPED": run.skipped}[status_filter]
+    indexes = list(_bits(_from_bitmap(bitmap)))
+    durations = array("f")
+    durations.frombytes(bytes(run.durations))
+    names = _names(run.job_name, indexes)
+    return {
+        "total": run.total,
+        "failed": run.failed_count,
+        "skipped": run.skipped_count,
+        "duration": run.duration,
+        "tests": sorted(({"name": names.get(i), "duration": round(durations[i], 3)} for i in indexes),
+                        key=lambda t: t["name"] or ""),
+    }
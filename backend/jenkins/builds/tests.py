@@ -1,3 +1,1065 @@
-from django.test import TestCase
+import io
+import os
+import shutil
+import tempfile
+from unittest import mock
 
-# Create your tests here.
+from django.test import SimpleTestCase, TestCase, override_settings
+
+
+class LogDirMixin:
+    """Run each test in an empty directory: build logs live under relative paths"""
+
+    def setUp(self):
+        super().setUp()
+        self._cwd = os.getcwd()
+        self._tmp = tempfile.mkdtemp()
+        os.chdir(self._tmp)
+
+    def tearDown(self):
+        os.chdir(self._cwd)
+        shutil.rmtree(self._tmp, ignore_errors=True)
+        super().tearDown()
+
+
+class StorageMixin(LogDirMixin):
+    """LogDirMixin with fresh log backend instances, so LOG_STORAGE overrides apply"""
+
+    def setUp(self):
+        super().setUp()
+        from builds import storage
+        patcher = mock.patch.dict(storage._backends, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+# ---- Worker pools (worker.py) ----
+@override_settings(DRAMATIQ_WORKER_POOLS={
+    "control": {"queues": ["control"], "processes": 1, "threads": 8},
+    "pollers": {"queues": ["pollers"], "processes": 2, "threads": 32},
+})
+class WorkerArgsTests(SimpleTestCase):
+    def test_pool_args_parse_for_dramatiq(self):
+        import worker
+        args = worker.parse_args("control", [])
+        self.assertEqual(args.broker, "builds.broker")
+        self.assertEqual(args.modules, ["builds.tasks"])
+        self.assertEqual(args.queues, ["control"])
+        self.assertEqual((args.processes, args.threads), (1, 8))
+
+    def test_fleet_node_adds_its_queue(self):
+        import worker
+        from builds.fleet import node_queue
+        with mock.patch.dict(os.environ, POLLER_NODE="node-a"):
+            args = worker.parse_args("pollers", ["--verbose"])
+        self.assertEqual(args.queues, ["pollers", node_queue("node-a")])
+        self.assertEqual((args.processes, args.threads), (2, 32))
+        self.assertTrue(args.verbose)
+
+
+class WorkerProfileTests(LogDirMixin, SimpleTestCase):
+    def test_worker_settings_load_without_the_web_apps(self):
+        import json
+        import subprocess
+        import sys
+        from django.conf import settings
+        from builds.management.commands.bench_worker_startup import PROBE
+        # the worker profile as deployed, only on the test database engine
+        with open("probe_settings.py", "w") as f:
+            f.write("from jenkins.settings_worker import *\n"
+                    "DATABASES = {'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}}\n")
+        web = ["rest_framework", "corsheaders", "django.contrib.admin", "django.contrib.sessions", "builds.views"]
+        probe = PROBE + f"import sys\nprint(json.dumps([m for m in {web!r} if m in sys.modules]))\n"
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE="probe_settings",
+                   PYTHONPATH=os.pathsep.join([self._tmp, str(settings.BASE_DIR)]))
+        result = subprocess.run([sys.executable, "-c", probe], cwd=settings.BASE_DIR, env=env,
+                                capture_output=True, text=True)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        stats, loaded = (json.loads(line) for line in result.stdout.strip().splitlines()[-2:])
+        self.assertEqual(stats["apps"], ["builds"])
+        self.assertEqual(loaded, [])
+
+
+# ---- Change feed and admission ----
+@override_settings(BUILD_CHANGE_FEED={"settle_seconds": 0})
+class ChangeFeedTests(TestCase):
+    def test_cursor_follows_transitions(self):
+        from builds.changefeed import changes_since, current_cursor
+        from builds.models import BuildRecord
+        cursor = current_cursor()
+        build = BuildRecord.objects.create(job_name="app")
+        build.status = "RUNNING"
+        build.save()
+        build.save()  # no transition, nothing published
+
+        changes = changes_since(cursor)
+        self.assertEqual([(c["old_status"], c["new_status"]) for c in changes], [(None, "PENDING"), ("PENDING", "RUNNING")])
+        self.assertEqual(changes_since(changes[-1]["id"]), [])
+        self.assertEqual(current_cursor(), changes[-1]["id"])
+
+    def test_stopping_a_waiting_build_is_published(self):
+        from django.utils import timezone
+        from builds.changefeed import changes_since, current_cursor
+        from builds.models import BuildRecord
+        build = BuildRecord.objects.create(job_name="app", enqueued_at=timezone.now())
+        cursor = current_cursor()
+
+        response = self.client.post(f"/api/builds/{build.id}/stop/")
+        self.assertEqual(response.status_code, 200)
+        build.refresh_from_db()
+        self.assertEqual(build.status, "ABORTED")
+        changes = changes_since(cursor)
+        self.assertEqual([(c["build_id"], c["old_status"], c["new_status"]) for c in changes],
+                         [(build.id, "PENDING", "ABORTED")])
+
+
+    @override_settings(BUILD_CHANGE_FEED={"settle_seconds": 60})
+    def test_cursor_stops_at_a_gap_until_it_settles(self):
+        from datetime import timedelta
+        from django.utils import timezone
+        from builds.changefeed import changes_since, current_cursor
+        from builds.models import BuildRecord, BuildStatusChange
+        changes = BuildStatusChange.objects.order_by("id")
+        first = BuildRecord.objects.create(job_name="a")
+        old = timezone.now() - timedelta(minutes=5)
+        changes.filter(build=first).update(created_at=old)
+        cursor = current_cursor()
+
+        # an unbroken run of ids is served at once
+        second = BuildRecord.objects.create(job_name="b")
+        self.assertEqual([c["build_id"] for c in changes_since(cursor)], [second.id])
+        cursor = current_cursor()
+
+        # "late" got its id before "third" but has not committed yet
+        late, third = (BuildRecord.objects.create(job_name=job) for job in ("c", "d"))
+        changes.filter(build=late).delete()
+        self.assertEqual(changes_since(cursor), [])
+        self.assertEqual(current_cursor(), cursor)
+        changes.filter(build=third).update(created_at=old)
+        self.assertEqual([c["build_id"] for c in changes_since(cursor)], [third.id])
+
+    def test_prune_drops_changes_past_retention(self):
+        from datetime import timedelta
+        from django.utils import timezone
+        from builds.changefeed import prune_changes
+        from builds.models import BuildRecord, BuildStatusChange
+        old, new = (BuildRecord.objects.create(job_name=job) for job in ("a", "b"))
+        BuildStatusChange.objects.filter(build=old).update(created_at=timezone.now() - timedelta(days=8))
+        self.assertEqual(prune_changes(), 1)
+        self.assertEqual(list(BuildStatusChange.objects.values_list("build_id", flat=True)), [new.id])
+
+class WebhookTests(TestCase):
+    url = "/api/builds/webhook/jenkins/"
+    event = {"job_name": "app", "build_number": 7, "event": "started"}
+
+    def test_disabled_webhook_is_not_found(self):
+        self.assertEqual(self.client.post(self.url, self.event, content_type="application/json").status_code, 404)
+
+    @override_settings(JENKINS_WEBHOOK={"enabled": True})
+    def test_enabled_webhook_requires_a_configured_token(self):
+        self.assertEqual(self.client.post(self.url, self.event, content_type="application/json").status_code, 403)
+
+    @override_settings(JENKINS_WEBHOOK={"enabled": True, "token": "s3cret"})
+    def test_token_checked(self):
+        from builds.models import BuildRecord
+        build = BuildRecord.objects.create(job_name="app", build_number=7)
+        self.assertEqual(self.client.post(self.url, self.event, content_type="application/json",
+                                          headers={"X-Jenkins-Token": "wrong"}).status_code, 403)
+        response = self.client.post(self.url, self.event, content_type="application/json",
+                                    headers={"X-Jenkins-Token": "s3cret"})
+        self.assertEqual(response.status_code, 200)
+        build.refresh_from_db()
+        self.assertEqual(build.status, "RUNNING")
+
+    @override_settings(JENKINS_WEBHOOK={"enabled": True, "token": "s3cret"}, BUILD_CHANGE_FEED={"settle_seconds": 0})
+    def test_late_event_keeps_the_final_status(self):
+        from django.utils import timezone
+        from builds.changefeed import changes_since, current_cursor
+        from builds.models import BuildRecord
+        from builds.webhooks import COMPLETED, STARTED, apply_event
+        build = BuildRecord.objects.create(job_name="app", build_number=7)
+        stale = BuildRecord.objects.get(id=build.id)
+        end_time = timezone.now()
+        BuildRecord.objects.filter(id=build.id).update(status="SUCCESS", end_time=end_time, error_count=2)
+        cursor = current_cursor()
+
+        # the poller saved the final status after the webhook read the row
+        with mock.patch("django.db.models.QuerySet.first", return_value=stale):
+            apply_event("app", 7, STARTED, None)
+            apply_event("app", 7, COMPLETED, "FAILURE")
+        build.refresh_from_db()
+        self.assertEqual((build.status, build.end_time, build.error_count), ("SUCCESS", end_time, 2))
+        self.assertEqual(build.jenkins_result, "FAILURE")
+        self.assertIsNotNone(build.jenkins_event_at)
+        self.assertEqual(changes_since(cursor), [])
+
+
+class AdmissionTests(TestCase):
+    def waiting(self, *builds):
+        from datetime import timedelta
+        from django.utils import timezone
+        from builds.models import BuildRecord
+        start = timezone.now()
+        return [BuildRecord.objects.create(job_name=job, team=team, enqueued_at=start + timedelta(seconds=i))
+                for i, (team, job) in enumerate(builds)]
+
+    def test_fair_order_round_robins_teams_then_jobs(self):
+        from builds.admission import fair_order
+        a1, a2, a3, b1, a4, c1 = self.waiting(
+            ("a", "x"), ("a", "x"), ("a", "y"), ("b", "z"), ("a", "x"), ("c", "w"))
+        self.assertEqual([b.id for b in fair_order([c1, a4, b1, a3, a2, a1])],
+                         [b.id for b in (a1, b1, c1, a3, a2, a4)])
+
+    @override_settings(BUILD_ADMISSION={"max_active": 3, "max_active_per_job": 1})
+    def test_admission_respects_caps_in_fair_order(self):
+        from builds.admission import admit_waiting_builds, waiting_builds
+        a1, a2, a3, b1 = self.waiting(("a", "x"), ("a", "x"), ("a", "y"), ("b", "z"))
+        with mock.patch("builds.tasks.trigger_build.send") as send:
+            with self.captureOnCommitCallbacks(execute=True):
+                admitted = admit_waiting_builds()
+        self.assertEqual(admitted, [a1.id, b1.id, a3.id])
+        self.assertEqual(sorted(call.args[0] for call in send.call_args_list), sorted(admitted))
+        self.assertEqual(list(waiting_builds().values_list("id", flat=True)), [a2.id])
+
+    def test_queue_position_matches_the_fair_order(self):
+        import random
+        from builds.admission import fair_order, queue_position, waiting_builds
+        rnd = random.Random(7)
+        self.waiting(*[(rnd.choice(["a", "b", ""]), rnd.choice(["x", "y", "z"])) for _ in range(40)])
+        order = [build.id for build in fair_order(waiting_builds())]
+        self.assertEqual([queue_position(build) for build in waiting_builds().order_by("id")],
+                         [order.index(build_id) for build_id in sorted(order)])
+
+    @override_settings(BUILD_ADMISSION={"max_active": 2, "default_build_seconds": 600})
+    def test_queue_info_estimates_waves_of_max_active(self):
+        from django.utils import timezone
+        from builds.admission import queue_info
+        from builds.models import BuildRecord
+        BuildRecord.objects.create(job_name="busy", status="RUNNING")
+        builds = self.waiting(("a", "x"), ("b", "y"), ("c", "z"), ("d", "w"))
+        now = timezone.now()
+        infos = [queue_info(build) for build in builds]
+        self.assertEqual([(info["position"], info["waiting"]) for info in infos], [(0, 4), (1, 4), (2, 4), (3, 4)])
+        # one slot is free, then two builds per average duration
+        self.assertEqual([round((info["estimated_start"] - now).total_seconds() / 600) for info in infos],
+                         [0, 1, 1, 2])
+        BuildRecord.objects.filter(id=builds[0].id).update(admitted_at=now)
+        builds[0].refresh_from_db()
+        self.assertIsNone(queue_info(builds[0]))
+        self.assertEqual(queue_info(builds[1])["position"], 0)
+
+
+# ---- Retention ----
+@override_settings(LOG_STORAGE={"backend": "segmented", "segment_size": 64})
+class RetentionTests(StorageMixin, TestCase):
+    policy = {"max_age_days": None, "max_builds_per_job": 0, "max_total_bytes": None,
+              "action": "archive", "archive_path": "builds/archive"}
+
+    def test_archive_streams_segments_as_full_log(self):
+        import tarfile
+        from builds.models import BuildRecord
+        from builds.retention import sweep
+        from builds.storage import append_to_log, get_build_path, get_full_log_path
+        data = b"".join(b"line %d \x1b[31mred\x1b[0m\n" % i for i in range(40))
+        for start in range(0, len(data), 100):
+            append_to_log("app", 1, data[start:start + 100])
+        build = BuildRecord.objects.create(job_name="app", build_number=1, status="SUCCESS",
+                                           log_path=get_full_log_path("app", 1))
+
+        self.assertEqual(sweep(dict(self.policy)), {"age": 0, "count": 1, "bytes": 0, "failed": 0})
+        build.refresh_from_db()
+        self.assertFalse(os.path.exists(get_build_path("app", 1)))
+        with tarfile.open(build.log_path) as tar:
+            names = sorted(m.name for m in tar.getmembers() if m.isfile())
+            self.assertEqual(tar.extractfile("1/full.log").read(), data)
+        self.assertIn("1/plain.log", names)
+        self.assertFalse([name for name in names if "segments" in name])
+
+    def test_draining_builds_are_kept(self):
+        from builds.models import BuildRecord
+        from builds.retention import select_expired
+        from builds.storage import append_to_log
+        append_to_log("app", 1, b"still draining\n")
+        BuildRecord.objects.create(job_name="app", build_number=1, status="STOPPED")
+        self.assertEqual(select_expired(dict(self.policy)), {})
+
+    def finished_builds(self, count):
+        from datetime import timedelta
+        from django.utils import timezone
+        from builds.models import BuildRecord
+        from builds.storage import append_to_log, finalize_log, get_full_log_path
+        start = timezone.now() - timedelta(hours=1)
+        builds = []
+        for number in range(1, count + 1):
+            data = numbered_lines(400, seed=number)
+            for offset in range(0, len(data), 1000):
+                append_to_log("app", number, data[offset:offset + 1000])
+            finalize_log("app", number)
+            builds.append(BuildRecord.objects.create(
+                job_name="app", build_number=number, status="SUCCESS",
+                log_path=get_full_log_path("app", number), end_time=start + timedelta(minutes=number)))
+        return builds
+
+    def dir_size(self, number):
+        from builds.storage import get_build_path
+        return sum(os.path.getsize(os.path.join(root, name))
+                   for root, _dirs, files in os.walk(get_build_path("app", number)) for name in files)
+
+    @override_settings(LOG_STORAGE={"backend": "dedup", "chunk_min_bytes": 64, "chunk_avg_bytes": 256,
+                                    "chunk_max_bytes": 1024})
+    def test_quota_counts_the_chunk_store(self):
+        from builds.retention import select_expired, sweep
+        from builds.storage import get_backend, get_build_size
+        builds = self.finished_builds(3)
+        store = get_backend().store
+        self.assertEqual(sum(get_build_size("app", b.build_number) - self.dir_size(b.build_number) for b in builds),
+                         store.stats()["stored_bytes"])
+
+        # the directories alone fit, the chunks do not: the oldest build goes
+        policy = dict(self.policy, max_builds_per_job=None, action="delete",
+                      max_total_bytes=get_build_size("app", 2) + get_build_size("app", 3))
+        self.assertEqual(sweep(policy), {"age": 0, "count": 0, "bytes": 1, "failed": 0})
+        self.assertEqual(store.stats()["referenced_bytes"],
+                         len(numbered_lines(400, seed=2)) + len(numbered_lines(400, seed=3)))
+
+        # sizes were measured once, the next sweep does not walk them again
+        with mock.patch("builds.retention.get_build_size") as measure:
+            self.assertEqual(select_expired(policy), {})
+        measure.assert_not_called()
+
+    @override_settings(LOG_STORAGE={"backend": "tiered", "segment_size": 4096,
+                                    "cache_path": "builds/segment-cache", "cache_max_bytes": 1 << 20})
+    def test_quota_counts_offloaded_segments(self):
+        from builds.storage import get_backend, get_build_size
+        self.finished_builds(1)
+        size = len(numbered_lines(400, seed=1))
+        self.assertEqual(get_backend().load_manifest("app", 1)["remote"], list(range(-(-size // 4096))))
+        self.assertEqual(get_build_size("app", 1) - self.dir_size(1), size)
+
+    def test_layout_migration_skips_active_builds(self):
+        from django.core.management import call_command
+        from builds.models import BuildRecord
+        from builds.storage import get_legacy_build_path, get_sharded_build_path
+        for number, status in ((1, "RUNNING"), (2, "SUCCESS")):
+            os.makedirs(get_legacy_build_path("app", number))
+            BuildRecord.objects.create(job_name="app", build_number=number, status=status,
+                                       log_path=os.path.join(get_legacy_build_path("app", number), "full.log"))
+        out, err = io.StringIO(), io.StringIO()
+        call_command("migrate_log_layout", stdout=out, stderr=err)
+        self.assertTrue(os.path.isdir(get_legacy_build_path("app", 1)))
+        self.assertTrue(os.path.isdir(get_sharded_build_path("app", 2)))
+        self.assertIn("still active", err.getvalue())
+        self.assertEqual(BuildRecord.objects.get(build_number=2).log_path,
+                         os.path.join(get_sharded_build_path("app", 2), "full.log"))
+
+
+# ---- Single-flight polling ----
+class LeaseTests(TestCase):
+    def test_takeover_resumes_after_the_checkpoint(self):
+        from datetime import timedelta
+        from django.utils import timezone
+        from builds.leases import acquire_lease, heartbeat, resume_offset
+        from builds.models import BuildLease
+        first = acquire_lease("app", 5, "node-a")
+        self.assertIsNone(acquire_lease("app", 5, "node-b"))
+        # Jenkins offset 1000 was stored as 900 bytes, then 50 more landed before the owner died
+        self.assertTrue(heartbeat(first, 1000, 900))
+        BuildLease.objects.filter(id=first.id).update(expires_at=timezone.now() - timedelta(seconds=1))
+
+        second = acquire_lease("app", 5, "node-b")
+        self.assertEqual(second.taken_over_from, "node-a")
+        self.assertEqual(resume_offset(second, 950), 1050)
+        self.assertFalse(heartbeat(first, 1100, 1000))
+
+    def test_hand_over_frees_the_lease_at_once(self):
+        from builds.leases import acquire_lease, hand_over_lease, resume_offset
+        lease = acquire_lease("app", 5, "node-a")
+        hand_over_lease(lease, 400, 400)
+        taken = acquire_lease("app", 5, "node-b")
+        self.assertEqual(resume_offset(taken, 400), 400)
+
+
+# ---- Controller client ----
+class JenkinsClientTests(SimpleTestCase):
+    def client_with_one_slot(self):
+        import io
+        import requests
+        from builds.controllers import JenkinsClient
+
+        def respond(*args, **kwargs):
+            response = requests.Response()
+            response.raw = io.BytesIO(b"")
+            return response
+
+        client = JenkinsClient("test", "http://jenkins", "admin", "token", max_connections=1, requests_per_second=0)
+        client.session.request = mock.Mock(side_effect=respond)
+        return client
+
+    def test_streamed_response_holds_its_slot_until_closed(self):
+        client = self.client_with_one_slot()
+        with client.get("job/app/1/logText/progressiveText", stream=True):
+            self.assertFalse(client.slots.acquire(blocking=False))
+        self.assertTrue(client.slots.acquire(blocking=False))
+
+    def test_plain_response_releases_its_slot(self):
+        client = self.client_with_one_slot()
+        client.get("api/json")
+        client.get("api/json")
+        self.assertEqual(client.session.request.call_args.args, ("GET", "http://jenkins/api/json"))
+
+
+class TelemetryTests(TestCase):
+    def test_collect_samples_queue_and_executors(self):
+        from datetime import timedelta
+        from django.utils import timezone
+        from builds.models import BuildRecord, ControllerSample, JenkinsController
+        from builds.telemetry import collect_once
+        now = timezone.now()
+        since = lambda seconds: int((now - timedelta(seconds=seconds)).timestamp() * 1000)
+        responses = {
+            "queue/api/json": {"items": [
+                {"id": 12, "inQueueSince": since(30), "blocked": True},
+                {"id": 13, "inQueueSince": since(90), "stuck": True},
+            ]},
+            "computer/api/json": {"totalExecutors": 4, "busyExecutors": 3,
+                                  "computer": [{"offline": False}, {"offline": True}]},
+        }
+        default = mock.Mock()
+        default.get.side_effect = lambda path, **kwargs: mock.Mock(json=mock.Mock(return_value=responses[path]))
+        broken = mock.Mock()
+        broken.get.side_effect = ConnectionError("refused")
+        JenkinsController.objects.create(name="down", url="http://down", username="u", token="t")
+        waiting = BuildRecord.objects.create(job_name="app", status="PENDING",
+                                             queue_url="http://localhost:8080/queue/item/12/")
+        ControllerSample.objects.create(at=now - timedelta(days=31))
+
+        with mock.patch("builds.telemetry.get_client", side_effect=lambda c: broken if c else default), \
+                mock.patch("builds.telemetry.timezone.now", return_value=now), \
+                self.assertLogs("jenkins_worker", "WARNING") as logs:
+            samples = collect_once()
+
+        # the broken controller is skipped, the old sample pruned
+        self.assertIn("Telemetry from down controller failed: refused", logs.output[0])
+        self.assertEqual(list(ControllerSample.objects.all()), samples)
+        sample, = samples
+        self.assertIsNone(sample.controller)
+        self.assertEqual((sample.queue_length, sample.queue_blocked, sample.queue_stuck), (2, 1, 1))
+        self.assertAlmostEqual(sample.wait_avg, 60, places=0)
+        self.assertAlmostEqual(sample.wait_max, 90, places=0)
+        self.assertEqual((sample.executors_total, sample.executors_busy, sample.nodes_offline), (4, 3, 1))
+        waiting.refresh_from_db()
+        self.assertEqual(int(waiting.queued_at.timestamp()), int((now - timedelta(seconds=30)).timestamp()))
+
+
+
+# ---- Streaming ingest ----
+class ProgressiveIngestTests(StorageMixin, TestCase):
+    def response(self, chunks, headers=None, error=None):
+        def iter_content(chunk_size):
+            yield from chunks
+            if error:
+                raise error
+        response = mock.MagicMock(headers=headers or {})
+        response.__enter__.return_value = response
+        response.iter_content.side_effect = iter_content
+        return response
+
+    def test_offsets_continue_across_chunks_and_requests(self):
+        import requests
+        from builds.models import BuildRecord
+        from builds.storage import read_log_range
+        from builds.tasks import ingest_progressive_log
+        build = BuildRecord.objects.create(job_name="app", build_number=4, status="RUNNING")
+        data = "résumé \x1b[31mERROR\x1b[0m: ünïcode\n".encode() * 4
+        first, second = data[:50], data[50:]
+        client = mock.Mock()
+        client.get.side_effect = [
+            # cuts inside "é" and inside the colour escape
+            self.response([first[:2], first[2:11], first[11:]], {"X-Text-Size": "50", "X-More-Data": "true"}),
+            self.response([second[:33], second[33:]], error=requests.ConnectionError("reset by peer")),
+            self.response([], error=requests.ConnectionError("refused")),
+        ]
+
+        headers, received = ingest_progressive_log(client, "log", build, 0)
+        self.assertEqual((received, headers["X-More-Data"]), (50, "true"))
+        offset = int(headers["X-Text-Size"])
+        # the body broke off: what arrived is kept and more data is reported
+        headers, received = ingest_progressive_log(client, "log", build, offset)
+        self.assertEqual((received, headers), (len(second), {"X-More-Data": "true"}))
+        offset += received
+        with self.assertRaises(requests.ConnectionError):
+            ingest_progressive_log(client, "log", build, offset)
+
+        self.assertEqual([call.kwargs["params"]["start"] for call in client.get.call_args_list], [0, 50, len(data)])
+        self.assertEqual(read_log_range("app", 4, 0, len(data) + 10), data)
+        build.refresh_from_db()
+        self.assertEqual(build.error_count, 4)
+
+# ---- Ingest indexes across chunk splits ----
+URL = "https://ci.example.com/job/app/1/artifact/" + "a" * 120
+CONSOLE = (
+    "Started by user admin\n"
+    "\x1b[8mha:////4KzGk+dGVzdA==\x1b[0m[Pipeline] stage\n"
+    "[Pipeline] { (Build)\n"
+    f"see \x1b]8;;{URL}\x1b\\report\x1b]8;;\x1b\\ for details\n"
+    "\x1b[1;31mERROR\x1b[0m: compilation failed\n"
+    "[Pipeline] }\n"
+    "Finished: FAILURE\n"
+).encode()
+
+
+class PlainIndexTests(LogDirMixin, SimpleTestCase):
+    def normalize(self, cuts):
+        from builds.console import normalize_chunk, OffsetMap
+        os.makedirs("split", exist_ok=True)
+        for name in os.listdir("split"):
+            os.remove(os.path.join("split", name))
+        paths = [os.path.join("split", name) for name in ("plain.json", "plain.log", "plain.map")]
+        read_range = lambda start, end: CONSOLE[start:end]
+        for start, end in zip([0] + cuts, cuts + [len(CONSOLE)]):
+            normalize_chunk(paths[0], read_range, paths[1], paths[2], start, CONSOLE[start:end])
+        with open(paths[1], "rb") as f:
+            return f.read(), OffsetMap(paths[2])
+
+    def test_escapes_stripped_wherever_the_chunks_split(self):
+        plain, offsets = self.normalize([])
+        self.assertEqual(plain, b"Started by user admin\n[Pipeline] stage\n[Pipeline] { (Build)\n"
+                                b"see report for details\nERROR: compilation failed\n[Pipeline] }\nFinished: FAILURE\n")
+        expected = [offsets.raw_to_plain(i) for i in range(len(CONSOLE) + 1)]
+        for cut in range(1, len(CONSOLE)):
+            with self.subTest(cut=cut):
+                split_plain, split_offsets = self.normalize([cut])
+                self.assertEqual(split_plain, plain)
+                self.assertEqual([split_offsets.raw_to_plain(i) for i in range(len(CONSOLE) + 1)], expected)
+
+    def test_offset_map_round_trip(self):
+        plain, offsets = self.normalize([7, 40, 90, 200])
+        error = plain.index(b"ERROR")
+        self.assertEqual(CONSOLE[offsets.plain_to_raw(error):].split(b"\x1b")[0], b"ERROR")
+        self.assertEqual(offsets.raw_to_plain(offsets.plain_to_raw(error)), error)
+        self.assertEqual(offsets.raw_to_plain(len(CONSOLE)), len(plain))
+
+
+def ingest(build_number, data, cuts):
+    """Append data to the log of build "app" #build_number in pieces ending at cuts"""
+    from builds.storage import append_to_log
+    for start, end in zip([0] + cuts, cuts + [len(data)]):
+        append_to_log("app", build_number, data[start:end])
+
+
+PIPELINE = (
+    "[Pipeline] stage\n[Pipeline] { (Checkout)\ngit fetch\n[Pipeline] }\n"
+    "[Pipeline] stage\n[Pipeline] { (Tests)\n"
+    "[Pipeline] parallel\n[Pipeline] { (Branch: unit)\n[Pipeline] stage\n[Pipeline] { (unit)\nok\n[Pipeline] }\n[Pipeline] }\n"
+    "[Pipeline] // parallel\n[Pipeline] }\n"
+).encode()
+
+
+class StageIndexTests(StorageMixin, SimpleTestCase):
+    def test_stages_indexed_wherever_the_chunks_split(self):
+        from builds.stages import list_stages
+        from builds.storage import read_stage_index
+        ingest(0, PIPELINE, [])
+        stages = list_stages(read_stage_index("app", 0), len(PIPELINE))
+        self.assertEqual([(s["path"], s["running"]) for s in stages],
+                         [("Checkout", False), ("Tests", False), ("Tests/unit", False), ("Tests/unit/unit", False)])
+        checkout = stages[0]
+        self.assertIn(b"git fetch", PIPELINE[checkout["start"]:checkout["end"]])
+        for cut in range(1, len(PIPELINE)):
+            with self.subTest(cut=cut):
+                ingest(cut, PIPELINE, [cut])
+                self.assertEqual(list_stages(read_stage_index("app", cut), len(PIPELINE)), stages)
+
+
+class ProblemIndexTests(StorageMixin, SimpleTestCase):
+    def test_problems_indexed_wherever_the_chunks_split(self):
+        from builds.storage import read_problem_index
+        ingest(0, CONSOLE, [])
+        expected = read_problem_index("app", 0)
+        self.assertEqual(expected["counts"], {"error": 1, "warning": 0})
+        self.assertEqual([(p["pattern"], p["text"], p["after"]) for p in expected["problems"]],
+                         [("error", "ERROR: compilation failed", ["[Pipeline] }", "Finished: FAILURE"])])
+        for cut in range(1, len(CONSOLE), 3):
+            with self.subTest(cut=cut):
+                ingest(cut, CONSOLE, [cut, min(cut + 40, len(CONSOLE))])
+                self.assertEqual(read_problem_index("app", cut), expected)
+
+
+    def test_tail_of_a_capped_log_is_indexed(self):
+        from builds.storage import get_plain_log_path, read_problem_index
+        data = numbered_lines(300) + CONSOLE
+        cuts = list(range(97, len(data), 97))
+        ingest(0, data, cuts)
+        expected = read_problem_index("app", 0)
+        self.assertEqual(expected["counts"], {"error": 1, "warning": 0})
+        with override_settings(LOG_SIZE_LIMIT={"max_bytes": 2000, "head_bytes": 500, "tail_bytes": 600,
+                                               "tail_segment_bytes": 200}):
+            ingest(1, data, cuts)
+        self.assertEqual(read_problem_index("app", 1), expected)
+        self.assertLessEqual(os.path.getsize(get_plain_log_path("app", 1)), 2000)
+
+    def test_patterns_follow_the_setting(self):
+        from builds.problems import classify
+        self.assertEqual(classify(b"ERROR: compilation failed"), ("error", "error"))
+        with override_settings(BUILD_PROBLEM_PATTERNS=[("flaky", "warning", r"^ERROR")]):
+            self.assertEqual(classify(b"ERROR: compilation failed"), ("flaky", "warning"))
+        self.assertEqual(classify(b"ERROR: compilation failed"), ("error", "error"))
+
+# ---- Log backends ----
+def numbered_lines(count, seed=0):
+    import random
+    rnd = random.Random(seed)
+    words = [b"compile", b"test", b"PASSED", b"download", b"module", b"install"]
+    return b"".join(b"[%d] " % i + b" ".join(rnd.choice(words) for _ in range(rnd.randint(1, 12))) + b"\n"
+                    for i in range(count))
+
+
+@override_settings(LOG_STORAGE={"backend": "dedup", "chunk_min_bytes": 64, "chunk_avg_bytes": 256,
+                                "chunk_max_bytes": 1024})
+class DedupBackendTests(StorageMixin, SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        from builds.storage import ensure_build_dir
+        ensure_build_dir("app", 1)
+        ensure_build_dir("app", 2)
+
+    def test_round_trip(self):
+        from builds.storage import get_backend
+        backend = get_backend()
+        data = numbered_lines(2000)
+        for start in range(0, len(data), 700):
+            backend.append("app", 1, data[start:start + 700])
+        self.assertEqual(backend.read_range("app", 1, 0, len(data)), data)
+        backend.finalize("app", 1)
+        self.assertGreater(backend.load_manifest("app", 1)["count"], 20)
+        self.assertEqual(b"".join(backend.iter_range("app", 1, chunk_size=4096)), data)
+        for start, end in ((0, 1), (1000, 1300), (len(data) - 5, len(data) + 10), (12345, 40000)):
+            self.assertEqual(backend.read_range("app", 1, start, end), data[start:end])
+
+        # a rerun shares the chunks, a truncate keeps the chunks before the cut
+        backend.append("app", 2, data)
+        self.assertEqual(backend.store.stats()["stored_bytes"], len(data))
+        backend.truncate("app", 2, 30000)
+        backend.append("app", 2, b"tail\n")
+        self.assertEqual(backend.read_range("app", 2, 0, 10 ** 9), data[:30000] + b"tail\n")
+
+        backend.delete("app", 1)
+        backend.delete("app", 2)
+        self.assertEqual(backend.store.stats()["chunks"], 0)
+
+
+@override_settings(LOG_STORAGE={"backend": "tiered", "segment_size": 100, "read_workers": 4,
+                                "cache_path": "builds/segment-cache", "cache_max_bytes": 250})
+class SegmentedBackendTests(StorageMixin, SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        from builds.storage import ensure_build_dir
+        ensure_build_dir("app", 1)
+        self.data = numbered_lines(60)
+        self.ranges = ((0, 1), (95, 105), (100, 200), (150, 450), (0, len(self.data)),
+                       (len(self.data) - 3, len(self.data) + 50))
+
+    def test_range_reads_across_segment_boundaries(self):
+        from builds.storage import get_backend
+        backend = get_backend("segmented")
+        for start in range(0, len(self.data), 70):
+            backend.append("app", 1, self.data[start:start + 70])
+        self.assertEqual(len(os.listdir(backend.segments_dir("app", 1))), -(-len(self.data) // 100))
+        for start, end in self.ranges:
+            self.assertEqual(backend.read_range("app", 1, start, end), self.data[start:end])
+        backend.truncate("app", 1, 250)
+        self.assertEqual(backend.read_range("app", 1, 0, 10 ** 9), self.data[:250])
+
+    def test_finalize_offloads_and_reads_back_through_the_cache(self):
+        from builds.storage import get_backend
+        backend = get_backend()
+        backend.append("app", 1, self.data)
+        backend.finalize("app", 1)
+        segment_count = -(-len(self.data) // 100)
+        self.assertEqual(backend.load_manifest("app", 1)["remote"], list(range(segment_count)))
+        self.assertEqual(os.listdir(backend.segments_dir("app", 1)), [])
+
+        with mock.patch.object(backend.store, "get_file", wraps=backend.store.get_file) as get_file:
+            for start, end in self.ranges:
+                self.assertEqual(backend.read_range("app", 1, start, end), self.data[start:end])
+            self.assertLessEqual(backend.cache.total, 250)
+            fetched = get_file.call_count
+            backend.read_range("app", 1, len(self.data) - 3, len(self.data))  # still cached
+            self.assertEqual(get_file.call_count, fetched)
+
+        backend.delete("app", 1)
+        with self.assertRaises(FileNotFoundError):
+            backend.read_range("app", 1, 0, 10)
+
+
+class SegmentCacheTests(LogDirMixin, SimpleTestCase):
+    def fill(self, cache, key, data):
+        def fetch(path):
+            with open(path, "wb") as f:
+                f.write(data)
+        cache.put(key, fetch).close()
+
+    def test_least_recently_used_is_evicted(self):
+        from builds.log_backends import SegmentCache
+        cache = SegmentCache("cache", 300)
+        for key in ("a/0", "a/1", "b/0"):
+            self.fill(cache, key, b"x" * 100)
+        cache.open("a/0").close()
+        self.fill(cache, "b/1", b"y" * 100)
+        self.assertIsNone(cache.open("a/1"))
+        self.assertEqual(list(cache.entries), ["b/0", "a/0", "b/1"])
+        self.assertEqual(cache.total, 300)
+
+        # a new process indexes what is on disk once, oldest first
+        os.utime(cache.path("b/1"), (0, 0))
+        with mock.patch("os.walk", wraps=os.walk) as walk:
+            restarted = SegmentCache("cache", 250)
+            self.assertEqual(restarted.open("a/0").read(), b"x" * 100)
+            restarted.open("b/0").close()
+            self.fill(restarted, "c/0", b"z" * 50)
+            self.assertEqual(walk.call_count, 1)
+        self.assertEqual(list(restarted.entries), ["a/0", "b/0", "c/0"])
+        self.assertIsNone(restarted.open("b/1"))
+
+
+# ---- Builds API ----
+class ListFastPathTests(TestCase):
+    def setUp(self):
+        from datetime import timedelta
+        from django.utils import timezone
+        from builds.models import BuildRecord
+        for i in range(3):
+            BuildRecord.objects.create(job_name=f"app-ü-{i}", build_number=i or None, status="SUCCESS",
+                                       end_time=timezone.now() + timedelta(microseconds=i), team="core")
+
+    def serialized(self, fields=None):
+        from rest_framework.renderers import JSONRenderer
+        from builds.models import BuildRecord
+        from builds.serializers import BuildRecordSerializer
+        queryset = BuildRecord.objects.all().order_by("-created_at")
+        return JSONRenderer().render(BuildRecordSerializer(queryset, many=True, fields=fields).data)
+
+    def test_fast_path_bytes_match_the_serializer(self):
+        for fields in (None, ["id", "status", "end_time"], ["job_name", "controller"]):
+            with self.subTest(fields=fields):
+                query = f"?fields={','.join(fields)}" if fields else ""
+                response = self.client.get(f"/api/builds/{query}", headers={"Accept": "application/json"})
+                self.assertTrue(response.streaming)
+                self.assertEqual(b"".join(response.streaming_content), self.serialized(fields))
+
+    def test_fast_path_keeps_the_response_headers(self):
+        response = self.client.get("/api/builds/", headers={"Accept": "application/json"})
+        self.assertTrue(response.streaming)
+        self.assertIn("Accept", response["Vary"])
+        self.assertIn("GET", response["Allow"])
+        self.assertEqual(response["Content-Type"], "application/json")
+
+
+class ExportTests(StorageMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        from builds.models import BuildRecord
+        from builds.retention import archive_build, get_policy
+        from builds.storage import append_to_log, get_build_path
+        self.logs = {1: numbered_lines(3000, seed=1), 2: numbered_lines(50, seed=2)}
+        self.builds = [BuildRecord.objects.create(job_name="app", build_number=n, status="SUCCESS") for n in (1, 2, 3)]
+        for n, data in self.logs.items():
+            ingest(n, data, [len(data) // 2])
+        # build 2 was swept into a retention archive, build 3 has no log
+        archived = archive_build(get_policy(), self.builds[1], get_build_path("app", 2))
+        BuildRecord.objects.filter(id=self.builds[1].id).update(log_path=archived)
+
+    def export(self, archive_format):
+        response = self.client.get(f"/api/builds/logs/export/?job=app&archive={archive_format}")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        return b"".join(response.streaming_content)
+
+    def check(self, files):
+        import json
+        self.assertEqual(files["app/1/full.log"], self.logs[1])
+        self.assertEqual(files["app/2/full.log"], self.logs[2])
+        self.assertEqual(json.loads(files["app/1/meta.json"])["build_number"], 1)
+        self.assertEqual(json.loads(files["skipped.json"])["skipped"],
+                         [{"id": self.builds[2].id, "job_name": "app", "build_number": 3}])
+
+    def test_zip(self):
+        import io
+        import zipfile
+        with zipfile.ZipFile(io.BytesIO(self.export("zip"))) as zf:
+            self.assertIsNone(zf.testzip())
+            self.check({name: zf.read(name) for name in zf.namelist()})
+
+    def test_tar_gz(self):
+        import io
+        import tarfile
+        with tarfile.open(fileobj=io.BytesIO(self.export("tar.gz")), mode="r:gz") as tar:
+            self.check({m.name: tar.extractfile(m).read() for m in tar.getmembers()})
+
+
+
+class ProblemsApiTests(StorageMixin, TestCase):
+    def test_problems_are_served_from_the_index(self):
+        from builds.models import BuildRecord
+        log = ["step %d" % i for i in range(10)]
+        log[2] = "WARNING: deprecated flag"
+        log[5] = "src/main.c:12:3: error: expected ';'"
+        log[8] = "[ERROR] BUILD FAILURE"
+        ingest(3, ("\n".join(log) + "\n").encode(), [30, 61])
+        build = BuildRecord.objects.create(job_name="app", build_number=3, status="FAILED")
+        url = f"/api/builds/{build.id}/problems/"
+
+        body = self.client.get(url).json()
+        self.assertEqual(body["counts"], {"error": 2, "warning": 1})
+        self.assertEqual((body["total"], body["truncated"]), (3, False))
+        self.assertEqual([(p["line"], p["pattern"]) for p in body["problems"]],
+                         [(3, "warning"), (6, "compiler_error"), (9, "maven_error")])
+        self.assertEqual(body["problems"][1]["before"], ["WARNING: deprecated flag", "step 3", "step 4"])
+        self.assertEqual(body["problems"][1]["after"], ["step 6", "step 7", "[ERROR] BUILD FAILURE"])
+        # still collecting after-context, served from the pending state
+        self.assertEqual(body["problems"][2]["after"], ["step 9"])
+
+        errors = self.client.get(url, {"level": "error", "offset": 1, "limit": 5}).json()
+        self.assertEqual((errors["total"], [p["line"] for p in errors["problems"]]), (2, [9]))
+        self.assertEqual(self.client.get(url, {"limit": "many"}).status_code, 400)
+        waiting = BuildRecord.objects.create(job_name="app")
+        self.assertEqual(self.client.get(f"/api/builds/{waiting.id}/problems/").status_code, 404)
+
+
+@override_settings(LOG_RENDER={"segment_bytes": 64})
+class RenderApiTests(StorageMixin, TestCase):
+    def segment(self, build, index, **headers):
+        return self.client.get(f"/api/builds/{build.id}/render/", {"segment": index, "as": "json"}, headers=headers)
+
+    def test_finished_segments_are_cached_and_the_live_one_is_not(self):
+        import json
+        from builds.models import BuildRecord
+        from builds.storage import append_to_log, get_render_dir
+        build = BuildRecord.objects.create(job_name="app", build_number=1, status="RUNNING")
+        # segment 0 is exactly full, the colour carries into segment 1
+        append_to_log("app", 1, b"\x1b[31m" + b"a" * 59 + b"b" * 10)
+
+        first = self.segment(build, 0)
+        self.assertEqual(first["Cache-Control"], "public, max-age=31536000, immutable")
+        self.assertEqual(json.loads(first.content), [["a" * 59, "ansi-fg-1"]])
+        live = self.segment(build, 1)
+        self.assertEqual(live["Cache-Control"], "no-cache")
+        self.assertEqual(json.loads(live.content), [["b" * 10, "ansi-fg-1"]])
+        self.assertEqual(self.segment(build, 1, if_none_match=live["ETag"]).status_code, 304)
+        render_dir = get_render_dir("app", 1)
+        self.assertTrue(os.path.exists(os.path.join(render_dir, "000000.json")))
+        self.assertFalse(os.path.exists(os.path.join(render_dir, "000001.json")))
+
+        # a finished segment is served from disk, not rendered again
+        with open(os.path.join(render_dir, "000000.json"), "w") as f:
+            f.write('[["cached"]]')
+        self.assertEqual(json.loads(self.segment(build, 0).content), [["cached"]])
+
+        # the live segment grows (ending in a cut escape, held back) and its ETag moves on
+        append_to_log("app", 1, b"c\x1b[0")
+        grown = self.segment(build, 1, if_none_match=live["ETag"])
+        self.assertEqual(grown.status_code, 200)
+        self.assertNotEqual(grown["ETag"], live["ETag"])
+        self.assertEqual(json.loads(grown.content), [["b" * 10 + "c", "ansi-fg-1"]])
+        self.assertFalse(os.path.exists(os.path.join(render_dir, "000001.json")))
+
+        # once the build ended the last segment is final: the cut escape is flushed as text,
+        # the segment cached and immutable
+        BuildRecord.objects.filter(id=build.id).update(status="SUCCESS")
+        final = self.segment(build, 1)
+        self.assertEqual(final["Cache-Control"], "public, max-age=31536000, immutable")
+        self.assertNotEqual(final["ETag"], grown["ETag"])
+        self.assertEqual(json.loads(final.content), [["b" * 10 + "c[0", "ansi-fg-1"]])
+        self.assertTrue(os.path.exists(os.path.join(render_dir, "000001.json")))
+        self.assertEqual(self.client.get(f"/api/builds/{build.id}/render/").json()["final"], True)
+
+# ---- Log diff ----
+class LogDiffTests(SimpleTestCase):
+    def diff(self, a, b, **kwargs):
+        from builds.logdiff import diff_lines, get_diff_config, iter_lines
+        config = dict(get_diff_config(), **kwargs.pop("config", {}))
+        opener = lambda data: (lambda: iter_lines(data[i:i + 100] for i in range(0, len(data), 100)))
+        return list(diff_lines(opener(a), opener(b), config, **kwargs))
+
+    def test_changed_and_inserted_lines(self):
+        lines = [b"line %d" % i for i in range(1, 21)]
+        a = b"\n".join(lines) + b"\n"
+        changed = list(lines)
+        changed[4] = b"\x1b[31mline five\x1b[0m"
+        changed[14:14] = [b"extra 1", b"extra 2"]
+        b = b"\n".join(changed) + b"\n"
+
+        hunks = self.diff(a, b, context=1)
+        self.assertEqual(hunks, [
+            {"a_start": 5, "a_lines": 1, "b_start": 5, "b_lines": 1, "before": ["line 4"],
+             "removed": ["line 5"], "added": ["line five"], "after": ["line 6"]},
+            {"a_start": 15, "a_lines": 0, "b_start": 15, "b_lines": 2, "before": ["line 14"],
+             "removed": [], "added": ["extra 1", "extra 2"], "after": ["line 15"]},
+        ])
+
+    def test_normalized_lines_are_equal(self):
+        a = b"start\n12:00:01 fetched deadbeef1 in 3.2s\nFinished: SUCCESS\n"
+        b = b"start\n13:14:15 fetched cafe00012 in 0.9s\nFinished: FAILURE\n"
+        hunks = self.diff(a, b, context=0)
+        self.assertEqual([(h["a_start"], h["removed"], h["added"]) for h in hunks],
+                         [(3, ["Finished: SUCCESS"], ["Finished: FAILURE"])])
+        self.assertEqual(len(self.diff(a, b, context=0, normalize=False)), 1)
+        self.assertEqual(self.diff(a, b, context=0, normalize=False)[0]["a_lines"], 2)
+
+    def test_change_longer_than_the_window_realigns(self):
+        head = [b"same %d" % i for i in range(10)]
+        tail = [b"tail %d" % i for i in range(10)]
+        a = b"\n".join(head + [b"old %d" % i for i in range(50)] + tail) + b"\n"
+        b = b"\n".join(head + [b"new %d" % i for i in range(80)] + tail) + b"\n"
+        hunks = self.diff(a, b, context=0, config={"window_lines": 8, "max_hunk_lines": 5})
+        self.assertEqual(sum(h["a_lines"] for h in hunks), 50)
+        self.assertEqual(sum(h["b_lines"] for h in hunks), 80)
+        self.assertEqual(hunks[0]["a_start"], 11)
+        self.assertTrue(all(len(h["removed"]) <= 5 and len(h["added"]) <= 5 for h in hunks))
+        last = hunks[-1]
+        self.assertEqual(last["a_start"] + last["a_lines"], 61)
+
+    def test_filter_bits_round_up_to_a_power_of_two(self):
+        from builds.logdiff import _ShingleFilter
+        shingles = _ShingleFilter(1000)
+        self.assertEqual((shingles.mask, len(shingles.bits)), (1023, 128))
+        for h in range(0, 1 << 40, 3 ** 21):
+            shingles.add(h)
+        self.assertTrue(all(h in shingles for h in range(0, 1 << 40, 3 ** 21)))
+        self.assertEqual(_ShingleFilter(1 << 10).mask, 1023)
+
+    def test_normalizers_follow_the_setting(self):
+        a, b = b"build 1 of app\n", b"build 2 of app\n"
+        self.assertEqual(len(self.diff(a, b)), 1)
+        with override_settings(LOG_DIFF_NORMALIZERS=[(r"\d+", "<n>")]):
+            self.assertEqual(self.diff(a, b), [])
+        self.assertEqual(len(self.diff(a, b)), 1)
+
+
+# ---- Test reports ----
+def test_report(**statuses):
+    """testReport json with one case per keyword, e.g. ok="PASSED" """
+    return {"suites": [{"name": "suite", "cases": [
+        {"className": "A", "name": name, "status": case_status, "duration": 0.5}
+        for name, case_status in statuses.items()]}]}
+
+
+class TestReportTests(TestCase):
+    def test_bitmaps_round_trip(self):
+        from builds.testreports import _bits, _from_bitmap, _to_bitmap
+        for indexes in ([], [0], [3, 7, 8], [0, 64, 1000, 4095]):
+            data = _to_bitmap(indexes)
+            self.assertEqual(len(data), (max(indexes, default=-1) + 8) // 8)
+            self.assertEqual(list(_bits(_from_bitmap(data))), indexes)
+
+    def test_names_are_interned_in_batches(self):
+        from builds.models import TestCaseName
+        from builds.testreports import intern_names
+        names = [f"A.test_{i}" for i in range(10)]
+        with mock.patch("builds.testreports.QUERY_BATCH", 3):
+            first = intern_names("app", names[:6])
+            both = intern_names("app", names)
+        self.assertEqual(sorted(first.values()), list(range(6)))
+        self.assertEqual({name: both[name] for name in first}, first)
+        self.assertEqual(sorted(both.values()), list(range(10)))
+        self.assertEqual(TestCaseName.objects.filter(job_name="app").count(), 10)
+
+    def test_flaky_and_trend_queries(self):
+        from builds.models import BuildRecord
+        from builds.testreports import build_test_results, failure_trends, flaky_tests, store_test_report
+        flaky = ["PASSED", "FAILED", "PASSED", "FAILED", "PASSED"]
+        for number in range(1, 6):
+            statuses = {"ok": "PASSED", "flaky": flaky[number - 1], "broken": "FAILED" if number >= 3 else "PASSED"}
+            if number == 4:
+                statuses["new"] = "SKIPPED"
+            build = BuildRecord.objects.create(job_name="app", build_number=number, status="SUCCESS")
+            store_test_report(build, test_report(**statuses))
+
+        self.assertEqual(flaky_tests("app"), {"job_name": "app", "runs": 5, "tests": [
+            {"name": "A.flaky", "flips": 4, "failures": 2, "last_failed_build": 4}]})
+        self.assertEqual(flaky_tests("app", last=2)["tests"], [])
+
+        trends = failure_trends("app")
+        self.assertEqual([(b["build_number"], b["total"], b["failed_count"], b["skipped_count"]) for b in trends["builds"]],
+                         [(1, 3, 0, 0), (2, 3, 1, 0), (3, 3, 1, 0), (4, 4, 2, 1), (5, 3, 1, 0)])
+        self.assertEqual(trends["most_failing"], [{"name": "A.broken", "failures": 3}, {"name": "A.flaky", "failures": 2}])
+        self.assertEqual([h["status"] for h in failure_trends("app", test_name="A.new")["history"]],
+                         [None, None, None, "SKIPPED", None])
+        self.assertIsNone(failure_trends("app", test_name="A.missing"))
+
+        results = build_test_results(BuildRecord.objects.get(build_number=4), "FAILED")
+        self.assertEqual([t["name"] for t in results["tests"]], ["A.broken", "A.flaky"])
+        self.assertEqual((results["total"], results["failed"], results["skipped"]), (4, 2, 1))
+
+# ---- Profiling ----
+class ProfilingTests(LogDirMixin, TestCase):
+    def test_spans_add_up_and_are_opt_in(self):
+        import time
+        from builds.profiling import Spans, poll_spans
+        spans = Spans()
+        with spans("http"):
+            time.sleep(0.01)
+        spans.add("db", 0.5)
+        spans.add("db", 0.25)
+        self.assertEqual(spans.totals["db"], 0.75)
+        self.assertGreaterEqual(spans.totals["http"], 0.01)
+        self.assertRegex(spans.summary(), r"^wall=\d+\.\d\ds db=0\.75s http=0\.0\ds other=")
+
+        self.assertFalse(poll_spans().enabled)
+        off = Spans(enabled=False)
+        with off("http"):
+            off.add("db", 1)
+        self.assertEqual((off.totals, off.summary()), ({}, ""))
+        with override_settings(PROFILING={"poll_spans": True}):
+            self.assertTrue(poll_spans().enabled)
+
+    @override_settings(PROFILING={"sampler_interval": 0.001, "dump_dir": "profiles"})
+    def test_sampler_writes_folded_stacks(self):
+        import threading
+        import time
+        from builds.profiling import sampler_status, start_sampler, stop_sampler
+
+        def spin_for_the_sampler(stop):
+            while not stop.is_set():
+                pass
+
+        stop = threading.Event()
+        worker = threading.Thread(target=spin_for_the_sampler, args=(stop,), name="spinner")
+        worker.start()
+        try:
+            self.assertTrue(start_sampler())
+            self.assertFalse(start_sampler())
+            deadline = time.monotonic() + 5
+            while sampler_status()["samples"] < 5 and time.monotonic() < deadline:
+                time.sleep(0.01)
+            path, folded = stop_sampler()
+        finally:
+            stop.set()
+            worker.join()
+        self.assertIsNone(stop_sampler())
+        spinner = [line for line in folded.splitlines() if line.startswith("spinner;")]
+        self.assertTrue(spinner)
+        self.assertIn(";spin_for_the_sampler (tests.py:", spinner[0])
+        with open(path, encoding="utf-8") as f:
+            self.assertEqual(f.read(), folded)
+
+    def test_request_timing_is_opt_in(self):
+        from builds import middleware
+        from builds.models import BuildRecord
+        build = BuildRecord.objects.create(job_name="app", status="SUCCESS")
+        patcher = mock.patch.dict(middleware.REQUEST_STATS, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.assertNotIn("Server-Timing", self.client.get(f"/api/builds/{build.id}/"))
+        self.assertEqual(middleware.request_stats(), {})
+        with override_settings(PROFILING={"request_timing": True}):
+            response = self.client.get(f"/api/builds/{build.id}/")
+            self.assertRegex(response["Server-Timing"], r'^app;dur=[\d.]+, db;dur=[\d.]+;desc="\d+ queries"$')
+            self.assertEqual(middleware.request_stats()["detail"]["count"], 1)
+
+            # a streamed body is produced after the middleware returned
+            response = self.client.get("/api/builds/", headers={"Accept": "application/json"})
+            self.assertTrue(response.streaming)
+            self.assertIn('desc="headers, body streamed"', response["Server-Timing"])
+            self.assertNotIn("list", middleware.request_stats())
@@ -1,16 +1,69 @@
+from django.http import StreamingHttpResponse, HttpResponse
 from rest_framework import viewsets, status
+from rest_framework.permissions import IsAdminUser
+from rest_framework.exceptions import ValidationError, NotFound
 from rest_framework.decorators import action
 from rest_framework.response import Response
-from .models import BuildRecord
+from .models import BuildRecord, ControllerSample, JenkinsController
 from .serializers import BuildRecordSerializer
-from .tasks import start_and_poll_build, stop_build
-from .storage import read_logs  # Helper to read logs from storage
+from .tasks import trigger_build, stop_build
+from .storage import (  # Helpers to read logs from storage
+    read_logs, get_plain_log_path, get_log_size, log_exists, tail_log,
+    read_log_range, read_plain_range, read_offset_map, read_stage_index, read_problem_index,
+    get_render_cache,
+)
+from .stages import list_stages, find_stage
+from .changefeed import wait_for_changes, current_cursor, publish
+from .webhooks import get_webhook_config, check_token, parse_event, apply_event
+from .controllers import route_job
+from .admission import get_admission_config, admit_waiting_builds, waiting_builds, queue_info
+from .listing import parse_fields, field_plan, iter_json_rows
+from .export import ARCHIVE_FORMATS, MAX_EXPORT_BUILDS, iter_archive
+from .telemetry import controller_series, build_phase_summary
+from .logdiff import get_diff_config, build_lines, diff_lines
+from .profiling import start_sampler, stop_sampler, sampler_status
+from .middleware import request_stats
+from .testreports import flaky_tests, failure_trends, build_test_results
+from django.db import transaction
+from django.utils import timezone
+from datetime import timedelta
+from itertools import islice
 import os
 
 class BuildRecordViewSet(viewsets.ModelViewSet):
     queryset = BuildRecord.objects.all().order_by('-created_at')
     serializer_class = BuildRecordSerializer
 
+    # ---- Sparse fieldsets and the fast list path ----
+    def requested_fields(self):
+        try:
+            return parse_fields(self.request.query_params.get("fields"), BuildRecordSerializer().fields)
+        except ValueError as e:
+            raise ValidationError({"fields": str(e)})
+
+    def get_serializer(self, *args, **kwargs):
+        if self.request is not None and self.request.method == "GET":
+            kwargs.setdefault("fields", self.requested_fields())
+        return super().get_serializer(*args, **kwargs)
+
+    def list(self, request, *args, **kwargs):
+        """
+        ?fields=id,status,... limits the columns.
+        Plain JSON lists skip the model instances and the serializer: .values()
+        rows are encoded directly, producing the same bytes.
+        """
+        queryset = self.filter_queryset(self.get_queryset())
+        fields = self.requested_fields()
+        renderer = getattr(request, "accepted_renderer", None)
+        if (self.paginator is None and renderer is not None and renderer.format == "json"
+                and "indent" not in (request.accepted_media_type or "")):
+            plan = field_plan(BuildRecordSerializer(fields=fields))
+            if plan is not None:
+                # returned like any Response: dispatch() finalizes it (Vary: Accept, Allow)
+                return StreamingHttpResponse(iter_json_rows(queryset, plan), content_type="application/json")
+        serializer = self.get_serializer(queryset, many=True)
+        return Response(serializer.data)
+
     # ---- Trigger Start ----
     @action(detail=False, methods=["post"])
     def start(self, request):
@@ -28,14 +81,23 @@ class BuildRecordViewSet(viewsets.ModelViewSet):
         if build_record:
             return Response({"detail": f"Build already exists with status {build_record.status}", "id": build_record.id}, status=status.HTTP_200_OK)
 
-        # Create a new BuildRecord
+        # Create a new BuildRecord on the controller the job lives on
+        admission = get_admission_config()["enabled"]
         build_record = BuildRecord.objects.create(
             job_name=job_name,
+            controller=route_job(job_name),
+            team=request.data.get("team") or "",
+            enqueued_at=timezone.now() if admission else None,
             status="PENDING",
         )
 
-        # Trigger the build via Dramatiq
-        start_and_poll_build.send(build_record.id)
+        if admission:
+            # Triggered once the admission caps allow it, bursts wait in a fair queue
+            admit_waiting_builds()
+            build_record.refresh_from_db()
+        else:
+            # Trigger the build via Dramatiq (control queue, polling continues on the poller queue)
+            trigger_build.send(build_record.id)
 
         serializer = BuildRecordSerializer(build_record)
         return Response(serializer.data, status=status.HTTP_201_CREATED)
@@ -47,10 +109,63 @@ class BuildRecordViewSet(viewsets.ModelViewSet):
         if build_record.status not in ["RUNNING", "PENDING"]:
             return Response({"detail": f"Cannot stop build in status {build_record.status}"}, status=status.HTTP_400_BAD_REQUEST)
 
+        # Still waiting for admission: nothing to stop on Jenkins.
+        # Conditional update so an admission running right now wins the race;
+        # update() sends no post_save, the transition is published here.
+        with transaction.atomic():
+            end_time = timezone.now()
+            if waiting_builds().filter(id=build_record.id).update(status="ABORTED", end_time=end_time):
+                old_status = build_record.status
+                build_record.status, build_record.end_time = "ABORTED", end_time
+                publish(build_record, old_status)
+                return Response({"detail": "Removed from the admission queue"}, status=status.HTTP_200_OK)
+
         # Trigger stop task
         stop_build.send(build_record.id)
         return Response({"detail": "Stop triggered"}, status=status.HTTP_200_OK)
 
+    # ---- Status change feed (long-poll) ----
+    @action(detail=False, methods=["get"])
+    def changes(self, request):
+        """
+        Status transitions after ?since=<cursor>.
+        Blocks up to ?timeout= seconds (default 25, max 60) while nothing changed.
+        Without since, returns the current cursor to start from.
+        """
+        since = request.query_params.get("since")
+        if since is None:
+            return Response({"cursor": current_cursor(), "changes": []})
+        try:
+            since = int(since)
+            timeout = min(float(request.query_params.get("timeout", 25)), 60)
+        except ValueError:
+            return Response({"detail": "since and timeout must be numbers"}, status=status.HTTP_400_BAD_REQUEST)
+
+        changes = wait_for_changes(since, timeout)
+        cursor = changes[-1]["id"] if changes else since
+        return Response({"cursor": cursor, "changes": changes})
+
+    # ---- Jenkins push notifications ----
+    @action(detail=False, methods=["post"], url_path="webhook/jenkins")
+    def jenkins_webhook(self, request):
+        """
+        Notification plugin / generic webhook events (start, completion, result).
+        Completion wakes the poller so it drains and stops right away.
+        """
+        if not get_webhook_config()["enabled"]:
+            raise NotFound()
+        if not check_token(request):
+            return Response({"detail": "Invalid token"}, status=status.HTTP_403_FORBIDDEN)
+        try:
+            job_name, build_number, phase, result = parse_event(request.data)
+        except (ValueError, TypeError, AttributeError) as e:
+            return Response({"detail": f"Invalid event: {e}"}, status=status.HTTP_400_BAD_REQUEST)
+
+        build_record = apply_event(job_name, build_number, phase, result)
+        if not build_record:
+            return Response({"detail": "Unknown build"}, status=status.HTTP_202_ACCEPTED)
+        return Response({"id": build_record.id, "status": build_record.status, "jenkins_result": build_record.jenkins_result})
+
     # ---- Check Status ----
     @action(detail=True, methods=["get"])
     def status(self, request, pk=None):
@@ -62,6 +177,8 @@ class BuildRecordViewSet(viewsets.ModelViewSet):
             "status": build_record.status,
             "start_time": build_record.start_time,
             "end_time": build_record.end_time,
+            # position / estimated_start while waiting for admission, else null
+            "queue": queue_info(build_record),
         })
 
     # ---- Fetch logs ----
@@ -71,15 +188,340 @@ class BuildRecordViewSet(viewsets.ModelViewSet):
         last_lines = int(request.query_params.get("last", 1000))
         full = request.query_params.get("full", "false").lower() == "true"
 
-        log_file_path = os.path.join("builds", "logs", f"{build_record.job_name}", f"{build_record.build_number}", f"full.log")
+        if build_record.log_path and build_record.log_path.endswith(".tar.gz"):
+            return Response({"detail": "Log archived", "archive": build_record.log_path}, status=status.HTTP_410_GONE)
 
-        if not os.path.exists(log_file_path):
+        # plain=true serves the precomputed copy without ANSI colours / ConsoleNotes
+        plain = request.query_params.get("plain", "false").lower() == "true"
+        plain_log_path = get_plain_log_path(build_record.job_name, build_record.build_number)
+
+        if not build_record.build_number or not log_exists(build_record.job_name, build_record.build_number):
+            return Response({"detail": "Log file not found"}, status=status.HTTP_404_NOT_FOUND)
+        if plain and not os.path.exists(plain_log_path):
             return Response({"detail": "Log file not found"}, status=status.HTTP_404_NOT_FOUND)
 
-        if full:
-            with open(log_file_path, "r") as f:
+        stage_name = request.query_params.get("stage")
+        if stage_name:
+            stages = list_stages(read_stage_index(build_record.job_name, build_record.build_number),
+                                 get_log_size(build_record.job_name, build_record.build_number))
+            stage = find_stage(stages, stage_name)
+            if not stage:
+                return Response({"detail": f"Stage {stage_name} not found"}, status=status.HTTP_404_NOT_FOUND)
+            if plain:
+                offsets = read_offset_map(build_record.job_name, build_record.build_number)
+                content = read_plain_range(build_record.job_name, build_record.build_number,
+                                           offsets.raw_to_plain(stage["start"]), offsets.raw_to_plain(stage["end"]))
+            else:
+                content = read_log_range(build_record.job_name, build_record.build_number, stage["start"], stage["end"])
+            return Response({"log": content.decode("utf-8", errors="replace"), "stage": stage})
+
+        if plain and full:
+            with open(plain_log_path, "r", encoding="utf-8", errors="replace") as f:
                 content = f.read()
+        elif plain:
+            content = read_logs(plain_log_path, last_lines=last_lines)  # read last N lines
+        elif full:
+            size = get_log_size(build_record.job_name, build_record.build_number)
+            content = read_log_range(build_record.job_name, build_record.build_number, 0, size).decode("utf-8", errors="replace")
         else:
-            content = read_logs(log_file_path, last_lines=last_lines)  # read last N lines
+            content = tail_log(build_record.job_name, build_record.build_number, last_lines=last_lines)
 
         return Response({"log": content})
+
+    # ---- Rendered log segments (ANSI colours as HTML / styled spans) ----
+    @action(detail=True, methods=["get"])
+    def render(self, request, pk=None):
+        """
+        Without ?segment: the segment layout of the log.
+        ?segment=<n>&as=html (default, sanitized fragment) or json ([text, classes, style] spans).
+        Finished segments are rendered once, cached on disk and served as immutable;
+        the growing last segment of an active build is re-rendered (ETag on the log size).
+        """
+        build_record = self.get_object()
+        if build_record.log_path and build_record.log_path.endswith(".tar.gz"):
+            return Response({"detail": "Log archived", "archive": build_record.log_path}, status=status.HTTP_410_GONE)
+        if not build_record.build_number or not log_exists(build_record.job_name, build_record.build_number):
+            return Response({"detail": "Log file not found"}, status=status.HTTP_404_NOT_FOUND)
+
+        final = build_record.status not in ("PENDING", "RUNNING", "STOPPED")
+        cache = get_render_cache(build_record.job_name, build_record.build_number, final=final)
+        if "segment" not in request.query_params:
+            return Response({
+                "segment_bytes": cache.segment_bytes,
+                "size": cache.size,
+                "count": cache.count(),
+                "final": final,
+                "skipped": [i for i in range(cache.count()) if cache.skipped(i)],
+            })
+
+        kind = request.query_params.get("as", "html")
+        if kind not in ("html", "json"):
+            return Response({"detail": "as must be html or json"}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            index = int(request.query_params["segment"])
+        except ValueError:
+            return Response({"detail": "segment must be a number"}, status=status.HTTP_400_BAD_REQUEST)
+        if not 0 <= index < cache.count():
+            return Response({"detail": "Segment out of range"}, status=status.HTTP_404_NOT_FOUND)
+        if cache.skipped(index):
+            return Response({"detail": "Segment dropped by the log size limit"}, status=status.HTTP_404_NOT_FOUND)
+
+        finished = cache.cacheable(index)
+        start, end = cache.bounds(index)
+        etag = f'"{build_record.id}-{cache.segment_bytes}-{index}-{kind}' + ('"' if finished else f'-{cache.size}"')
+        if request.headers.get("If-None-Match") == etag:
+            response = HttpResponse(status=status.HTTP_304_NOT_MODIFIED)
+        else:
+            content, _finished = cache.segment(index, kind)
+            response = HttpResponse(content, content_type="text/html; charset=utf-8" if kind == "html"
+                                    else "application/json")
+        response["ETag"] = etag
+        response["Cache-Control"] = "public, max-age=31536000, immutable" if finished else "no-cache"
+        response["X-Log-Start"] = start
+        response["X-Log-End"] = end
+        return response
+
+    # ---- Differences between the logs of two builds ----
+    @action(detail=True, methods=["get"], url_path=r"diff/(?P<other_pk>[^/.]+)")
+    def diff(self, request, pk=None, other_pk=None):
+        """
+        Hunks where the log of build <other_pk> (b) differs from this one (a), with 1-based line numbers.
+        Lines are compared without colours and with timestamps, hashes, durations, ... normalized
+        (?normalize=false compares the plain lines). ?context= lines around hunks (default 3, max 20),
+        ?max_hunks= (stops reading both logs once reached, "truncated" is set)
+        """
+        build_a = self.get_object()
+        try:
+            build_b = self.get_queryset().get(pk=other_pk)
+        except (BuildRecord.DoesNotExist, ValueError):
+            raise NotFound(f"Build {other_pk} not found")
+
+        config = get_diff_config()
+        try:
+            context = max(0, min(int(request.query_params.get("context", config["context_lines"])), 20))
+            max_hunks = max(1, min(int(request.query_params.get("max_hunks", config["max_hunks"])), config["max_hunks"]))
+        except ValueError:
+            return Response({"detail": "context and max_hunks must be numbers"}, status=status.HTTP_400_BAD_REQUEST)
+        normalize = request.query_params.get("normalize", "true").lower() != "false"
+
+        for build_record in (build_a, build_b):
+            if build_record.log_path and build_record.log_path.endswith(".tar.gz"):
+                return Response({"detail": f"Log of build {build_record.id} archived", "archive": build_record.log_path},
+                                status=status.HTTP_410_GONE)
+            if not build_record.build_number or not log_exists(build_record.job_name, build_record.build_number):
+                return Response({"detail": f"Log of build {build_record.id} not found"}, status=status.HTTP_404_NOT_FOUND)
+
+        hunks = diff_lines(build_lines(build_a.job_name, build_a.build_number),
+                           build_lines(build_b.job_name, build_b.build_number),
+                           config, context=context, normalize=normalize)
+        hunks = list(islice(hunks, max_hunks + 1))
+        side = lambda b: {"id": b.id, "job_name": b.job_name, "build_number": b.build_number, "status": b.status}
+        return Response({
+            "a": side(build_a),
+            "b": side(build_b),
+            "normalized": normalize,
+            "hunks": hunks[:max_hunks],
+            "truncated": len(hunks) > max_hunks,
+        })
+
+    # ---- Bulk log export ----
+    @action(detail=False, methods=["get"], url_path="logs/export")
+    def export_logs(self, request):
+        """
+        full.log and meta.json of many builds as one streamed archive.
+        ?ids=1,2,3 or ?job=<job_name>&from=<build_number>&to=<build_number>,
+        ?archive=zip (default) or tar.gz
+        """
+        archive_format = request.query_params.get("archive", "zip")
+        if archive_format not in ARCHIVE_FORMATS:
+            return Response({"detail": "archive must be zip or tar.gz"}, status=status.HTTP_400_BAD_REQUEST)
+
+        ids = request.query_params.get("ids")
+        job_name = request.query_params.get("job")
+        try:
+            if ids:
+                builds = BuildRecord.objects.filter(id__in=[int(i) for i in ids.split(",") if i.strip()])
+            elif job_name:
+                builds = BuildRecord.objects.filter(job_name=job_name, build_number__isnull=False)
+                if request.query_params.get("from"):
+                    builds = builds.filter(build_number__gte=int(request.query_params["from"]))
+                if request.query_params.get("to"):
+                    builds = builds.filter(build_number__lte=int(request.query_params["to"]))
+            else:
+                return Response({"detail": "ids or job is required"}, status=status.HTTP_400_BAD_REQUEST)
+        except ValueError:
+            return Response({"detail": "ids, from and to must be numbers"}, status=status.HTTP_400_BAD_REQUEST)
+
+        builds = list(builds.order_by("job_name", "build_number", "id")[:MAX_EXPORT_BUILDS + 1])
+        if len(builds) > MAX_EXPORT_BUILDS:
+            return Response({"detail": f"At most {MAX_EXPORT_BUILDS} builds per export"},
+                            status=status.HTTP_400_BAD_REQUEST)
+        if not builds:
+            return Response({"detail": "No builds found"}, status=status.HTTP_404_NOT_FOUND)
+
+        response = StreamingHttpResponse(iter_archive(builds, archive_format),
+                                         content_type=ARCHIVE_FORMATS[archive_format])
+        filename = f"build-logs-{timezone.now():%Y%m%d-%H%M%S}.{archive_format}"
+        response["Content-Disposition"] = f'attachment; filename="{filename}"'
+        return response
+
+    # ---- Pipeline stages ----
+    @action(detail=True, methods=["get"])
+    def stages(self, request, pk=None):
+        build_record = self.get_object()
+        if not build_record.build_number:
+            return Response({"detail": "Build has not started yet"}, status=status.HTTP_404_NOT_FOUND)
+
+        index = read_stage_index(build_record.job_name, build_record.build_number)
+        log_size = get_log_size(build_record.job_name, build_record.build_number)
+        return Response({"stages": list_stages(index, log_size), "log_size": log_size})
+
+    # ---- Errors / warnings found at ingest ----
+    @action(detail=True, methods=["get"])
+    def problems(self, request, pk=None):
+        """
+        Problem lines with context from the ingest index, no log read.
+        ?level=error|warning, ?offset=, ?limit= (default 200, max 1000)
+        """
+        build_record = self.get_object()
+        if not build_record.build_number:
+            return Response({"detail": "Build has not started yet"}, status=status.HTTP_404_NOT_FOUND)
+        try:
+            offset = int(request.query_params.get("offset", 0))
+            limit = min(int(request.query_params.get("limit", 200)), 1000)
+        except ValueError:
+            return Response({"detail": "offset and limit must be numbers"}, status=status.HTTP_400_BAD_REQUEST)
+
+        result = read_problem_index(build_record.job_name, build_record.build_number,
+                                    level=request.query_params.get("level"), offset=offset, limit=limit)
+        return Response(result)
+
+    # ---- Test reports (stored once per build at the end of polling) ----
+    @action(detail=True, methods=["get"])
+    def tests(self, request, pk=None):
+        """Tests of this build with ?status=FAILED (default), PASSED or SKIPPED"""
+        build_record = self.get_object()
+        status_filter = request.query_params.get("status", "FAILED").upper()
+        if status_filter not in ("FAILED", "PASSED", "SKIPPED"):
+            return Response({"detail": "status must be FAILED, PASSED or SKIPPED"}, status=status.HTTP_400_BAD_REQUEST)
+        result = build_test_results(build_record, status_filter)
+        if result is None:
+            return Response({"detail": "No test report for this build"}, status=status.HTTP_404_NOT_FOUND)
+        return Response(result)
+
+    @action(detail=False, methods=["get"], url_path="tests/flaky")
+    def flaky(self, request):
+        """
+        Tests flipping between pass and fail over the last builds of a job.
+        ?job=<job_name> (required), ?last= (default 1000), ?min_flips= (default 2), ?limit= (default 100)
+        """
+        job_name = request.query_params.get("job")
+        if not job_name:
+            return Response({"detail": "job is required"}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            last = min(int(request.query_params.get("last", 1000)), 10000)
+            min_flips = int(request.query_params.get("min_flips", 2))
+            limit = min(int(request.query_params.get("limit", 100)), 1000)
+        except ValueError:
+            return Response({"detail": "last, min_flips and limit must be numbers"}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(flaky_tests(job_name, last=last, min_flips=min_flips, limit=limit))
+
+    @action(detail=False, methods=["get"], url_path="tests/trends")
+    def test_trends(self, request):
+        """
+        Failure counts per build and the most failing tests of a job.
+        ?job=<job_name> (required), ?last= (default 100), ?test=<name> for one test's history
+        """
+        job_name = request.query_params.get("job")
+        if not job_name:
+            return Response({"detail": "job is required"}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            last = min(int(request.query_params.get("last", 100)), 10000)
+        except ValueError:
+            return Response({"detail": "last must be a number"}, status=status.HTTP_400_BAD_REQUEST)
+        result = failure_trends(job_name, last=last, test_name=request.query_params.get("test"))
+        if result is None:
+            return Response({"detail": "Unknown test"}, status=status.HTTP_404_NOT_FOUND)
+        return Response(result)
+
+    # ---- Jenkins queue / executor telemetry ----
+    def telemetry_params(self, request):
+        """(controller filter, since) from ?controller=<name>|default and ?hours="""
+        hours = float(request.query_params.get("hours", 24))
+        since = timezone.now() - timedelta(hours=min(hours, 24 * 90))
+        name = request.query_params.get("controller")
+        if not name or name == "default":
+            return None, since
+        controller = JenkinsController.objects.filter(name=name).first()
+        if controller is None:
+            raise NotFound(f"Unknown controller {name}")
+        return controller, since
+
+    @action(detail=False, methods=["get"])
+    def telemetry(self, request):
+        """
+        Queue length, queue waits and executor use of a controller over time.
+        ?controller=<name> (default: the settings controller), ?hours= (default 24), ?bucket=<seconds> (default 300)
+        """
+        try:
+            controller, since = self.telemetry_params(request)
+            bucket = max(15, int(request.query_params.get("bucket", 300)))
+        except ValueError:
+            return Response({"detail": "hours and bucket must be numbers"}, status=status.HTTP_400_BAD_REQUEST)
+        latest = (ControllerSample.objects.filter(controller=controller).order_by("-at")
+                  .values("at", "queue_length", "queue_blocked", "queue_stuck", "wait_avg", "wait_max",
+                          "executors_total", "executors_busy", "nodes_offline").first())
+        return Response({
+            "controller": controller.name if controller else "default",
+            "latest": latest,
+            "series": controller_series(controller, since, bucket),
+        })
+
+    @action(detail=False, methods=["get"], url_path="telemetry/builds")
+    def telemetry_builds(self, request):
+        """
+        Where build time goes: admission wait, trigger, Jenkins queue wait, run and poller lag
+        (p50/p90/p99/max seconds) over builds finished in the last ?hours= (default 24).
+        ?job=<job_name> and ?controller=<name>|default narrow it down.
+        """
+        try:
+            controller, since = self.telemetry_params(request)
+        except ValueError:
+            return Response({"detail": "hours must be a number"}, status=status.HTTP_400_BAD_REQUEST)
+        builds = BuildRecord.objects.filter(end_time__gte=since)
+        if request.query_params.get("controller"):
+            builds = builds.filter(controller=controller)
+        if request.query_params.get("job"):
+            builds = builds.filter(job_name=request.query_params["job"])
+        return Response(build_phase_summary(builds))
+
+    # ---- Profiling (the API process serving the request) ----
+    @action(detail=False, methods=["get", "post"], permission_classes=[IsAdminUser])
+    def profiler(self, request):
+        """
+        GET: sampler state and per-action request timings of this process.
+        POST {"action": "start", "interval": 0.01} starts the sampling profiler,
+        POST {"action": "stop"} stops it and returns the folded stacks (also written to PROFILING["dump_dir"]).
+        Worker processes are toggled with kill -USR2 <pid> instead.
+        """
+        if request.method == "GET":
+            return Response({"sampler": sampler_status(), "requests": request_stats()})
+
+        command = request.data.get("action")
+        if command == "start":
+            try:
+                interval = float(request.data["interval"]) if request.data.get("interval") else None
+            except (TypeError, ValueError):
+                return Response({"detail": "interval must be a number"}, status=status.HTTP_400_BAD_REQUEST)
+            if not start_sampler(interval):
+                return Response({"detail": "Sampler already running"}, status=status.HTTP_409_CONFLICT)
+            return Response({"sampler": sampler_status()})
+        if command == "stop":
+            result = stop_sampler()
+            if result is None:
+                return Response({"detail": "Sampler not running"}, status=status.HTTP_409_CONFLICT)
+            path, folded = result
+            response = HttpResponse(folded, content_type="text/plain; charset=utf-8")
+            response["X-Profile-Path"] = str(path)
+            return response
+        return Response({"detail": "action must be start or stop"}, status=status.HTTP_400_BAD_REQUEST)
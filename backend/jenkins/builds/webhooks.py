@@ -0,0 +1,98 @@
+import hmac
+import logging
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .models import BuildRecord
+from .changefeed import publish, publish_build_event
+
+logger = logging.getLogger("jenkins_worker")
+
+DEFAULT_WEBHOOK = {
+    "enabled": False,           # Jenkins is configured to push events to us
+    "token": None,              # shared secret, ?token= or X-Jenkins-Token header, required when enabled
+    "idle_poll_interval": 10,   # with pushes enabled pollers back off to this while a build is quiet
+}
+
+STARTED = "STARTED"
+COMPLETED = "COMPLETED"
+
+# Notification plugin phases (QUEUED, STARTED, COMPLETED, FINALIZED) and generic webhook events
+PHASES = {
+    "queued": None,
+    "started": STARTED,
+    "start": STARTED,
+    "completed": COMPLETED,
+    "finalized": COMPLETED,
+    "finished": COMPLETED,
+    "result": COMPLETED,
+}
+
+
+def get_webhook_config():
+    config = dict(DEFAULT_WEBHOOK)
+    config.update(getattr(settings, "JENKINS_WEBHOOK", {}))
+    return config
+
+
+def check_token(request):
+    """The request carries the configured token. Without one configured nothing is accepted."""
+    expected = get_webhook_config()["token"]
+    if not expected:
+        logger.warning("Jenkins webhook is enabled without a token, rejecting events")
+        return False
+    given = request.headers.get("X-Jenkins-Token") or request.query_params.get("token") or ""
+    return hmac.compare_digest(given, expected)
+
+
+def parse_event(payload):
+    """(job_name, build_number, phase, result) from a notification plugin or generic payload"""
+    if "build" in payload and isinstance(payload["build"], dict):
+        build = payload["build"]
+        job_name = payload.get("name")
+        build_number = build.get("number")
+        phase = build.get("phase", "")
+        result = build.get("status")
+    else:
+        job_name = payload.get("job_name")
+        build_number = payload.get("build_number")
+        phase = payload.get("event") or payload.get("phase") or ""
+        result = payload.get("result")
+
+    if not job_name or build_number is None:
+        raise ValueError("job name and build number are required")
+    return job_name, int(build_number), PHASES.get(str(phase).lower()), result
+
+
+def apply_event(job_name, build_number, phase, result):
+    """Update the BuildRecord and wake its poller. Returns the record or None."""
+    build_record = BuildRecord.objects.filter(job_name=job_name, build_number=build_number).first()
+    if not build_record:
+        logger.info(f"Ignoring Jenkins event for unknown build {job_name} #{build_number}")
+        return None
+
+    if phase is None:
+        return build_record
+
+    # Only the event columns: the poller may have saved the final status, end
+    # time and counts since this row was read, and a late event must not undo
+    # them. update() sends no post_save, the RUNNING transition is published here.
+    now = timezone.now()
+    with transaction.atomic():
+        records = BuildRecord.objects.filter(id=build_record.id)
+        if phase == STARTED and records.filter(status="PENDING").update(status="RUNNING", jenkins_event_at=now):
+            build_record.status = "RUNNING"
+            publish(build_record, "PENDING")
+        elif phase == COMPLETED and result:
+            # the poller drains the remaining output and sets the final status
+            records.update(jenkins_result=result, jenkins_event_at=now)
+            build_record.jenkins_result = result
+        else:
+            records.update(jenkins_event_at=now)
+        build_record.jenkins_event_at = now
+
+    publish_build_event(build_record.id)
+    logger.info(f"Jenkins event {phase} for {job_name} #{build_number} (result={result})")
+    return build_record
@@ -43,6 +43,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    "builds.middleware.RequestTimingMiddleware",
     "corsheaders.middleware.CorsMiddleware",
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -89,6 +90,145 @@ DATABASES = {
     }
 }
 
+# Build log retention, see builds/retention.py (None disables a policy)
+# Run with: python manage.py sweep_logs --loop
+LOG_RETENTION = {
+    "max_age_days": 90,
+    "max_builds_per_job": 500,
+    "max_total_bytes": None,
+    "action": "archive",
+    "archive_path": "builds/archive",
+    "sweep_interval": 3600,
+}
+
+# Build log storage, see builds/log_backends.py
+# backend: "file" (one full.log), "segmented" (fixed-size segment files) or
+# "tiered" (segments, cold ones moved to object_store and read back through an LRU disk cache) or
+# "dedup" (content-defined chunks, each unique chunk stored once in chunk_store, see manage.py dedup_report).
+# object_store: {"type": "filesystem", "root": ...} or {"type": "s3", "bucket": ..., "endpoint_url": ...}
+LOG_STORAGE = {
+    "backend": "file",
+    "segment_size": 8 * 1024 * 1024,
+    "read_workers": 4,
+    "object_store": {"type": "filesystem", "root": "builds/object-store"},
+    "cache_path": "builds/segment-cache",
+    "cache_max_bytes": 2 * 1024 * 1024 * 1024,
+    "chunk_store": "builds/chunk-store",
+    "chunk_min_bytes": 4 * 1024,
+    "chunk_avg_bytes": 16 * 1024,
+    "chunk_max_bytes": 64 * 1024,
+}
+
+# Runaway logs: above max_bytes only the first head_bytes and the last
+# tail_bytes (rolling, in tail_segment_bytes steps) are kept, see builds/logcap.py.
+# "jobs" overrides the limits per job name pattern.
+LOG_SIZE_LIMIT = {
+    "max_bytes": 512 * 1024 * 1024,
+    "head_bytes": 16 * 1024 * 1024,
+    "tail_bytes": 64 * 1024 * 1024,
+    "tail_segment_bytes": 4 * 1024 * 1024,
+    "jobs": {},
+}
+
+# Rendered log segments for the viewer (GET /api/builds/<id>/render/), see builds/render.py.
+# A build keeps the segment size it was first rendered with.
+LOG_RENDER = {
+    "segment_bytes": 256 * 1024,
+}
+
+# Log diff between two builds (GET /api/builds/<a>/diff/<b>/), see builds/logdiff.py.
+# window_lines bounds the lookahead per log; changes longer than that are
+# realigned with a filter_bits Bloom filter per log (a second read of both).
+LOG_DIFF = {
+    "window_lines": 20000,
+    "sync_lines": 3,
+    "context_lines": 3,
+    "max_hunks": 500,
+    "max_hunk_lines": 200,
+    "filter_bits": 1 << 24,
+}
+# Lines are compared after these (regex, replacement) rewrites, see DEFAULT_DIFF_NORMALIZERS
+# LOG_DIFF_NORMALIZERS = [(r"\b\d{1,2}:\d\d:\d\d\b", "<time>"), ...]
+
+# Jenkins -> API push notifications (POST /api/builds/webhook/jenkins/), see builds/webhooks.py
+# The endpoint answers 404 while disabled and needs the token once enabled.
+JENKINS_WEBHOOK = {
+    "enabled": False,
+    "token": None,
+    "idle_poll_interval": 10,
+}
+
+# Status change feed (GET /api/builds/changes/, builds/changefeed.py): changes are
+# served once every lower id is visible, after a gap in the ids only once they are
+# settle_seconds old. Pruned by manage.py sweep_logs.
+BUILD_CHANGE_FEED = {
+    "settle_seconds": 2,
+    "retention_days": 7,
+}
+
+# Lines indexed as problems at ingest: (name, level, regex), first match wins.
+# Defaults in builds/problems.py (compiler errors, test failures, ERROR, stack traces, warnings).
+# BUILD_PROBLEM_PATTERNS = [("error", "error", r"\bERROR\b"), ...]
+
+# Single-flight polling: one lease per build, heartbeated by its poller.
+# A poller that stops heartbeating for ttl seconds is replaced by a standby.
+BUILD_LEASE = {
+    "ttl": 60,
+    "heartbeat_interval": 15,
+}
+
+# Poller fleet: nodes started with "manage.py run_poller_node --name <node>"
+# register in the DB and active builds are spread over them by consistent hashing.
+POLLER_FLEET = {
+    "enabled": False,
+    "node_ttl": 30,
+    "heartbeat_interval": 10,
+    "virtual_nodes": 128,
+}
+
+# Jenkins controller used by builds without a JenkinsController (and when
+# none are registered). More controllers are added as JenkinsController rows.
+JENKINS_CONTROLLER = {
+    "url": "http://localhost:8080",
+    "username": "admin",
+    "token": "11675a28f9e88da72c7844548ac4aa14f0",
+    "max_connections": 20,
+    "requests_per_second": 20.0,
+}
+
+# Admission control in front of triggering (builds/admission.py): builds wait
+# in a fair queue (round robin over teams, then jobs) while a cap is reached.
+BUILD_ADMISSION = {
+    "enabled": True,
+    "max_active": 200,
+    "max_active_per_job": 2,
+    "max_active_per_controller": 100,
+}
+
+# Jenkins queue / executor telemetry (builds/telemetry.py), one sample per controller and tick.
+# Run with: python manage.py collect_telemetry --loop
+JENKINS_TELEMETRY = {
+    "interval": 15,
+    "retention_days": 30,
+}
+
+# Profiling hooks (builds/profiling.py). Opt in with "poll_spans" (poll loop
+# spans in the worker log) and "request_timing" (Server-Timing on the builds API).
+# The sampling profiler of a process is toggled by "kill -USR2 <pid>" or
+# POST /api/builds/profiler/, dumping folded stacks (flamegraph.pl, speedscope).
+PROFILING = {
+    "slow_request_seconds": 1.0,
+    "sampler_interval": 0.01,
+    "dump_dir": BASE_DIR / "profiles",
+}
+
+# Dramatiq worker pools, one per queue type. Start with: python worker.py <pool>
+# Pollers hold a thread for the whole build, control actors (trigger/stop) are short.
+DRAMATIQ_WORKER_POOLS = {
+    "control": {"queues": ["control"], "processes": 1, "threads": 8},
+    "pollers": {"queues": ["pollers"], "processes": 2, "threads": 32},
+}
+
 CELERY_BROKER_URL = 'redis://localhost:6379/0'
 CELERY_RESULT_BACKEND = 'redis://localhost:6379/0'
 CELERY_ACCEPT_CONTENT = ['json']
@@ -0,0 +1,22 @@
+"""
+Settings for the Dramatiq worker processes (python worker.py <pool>).
+
+Same database, storage and build settings as jenkins.settings, but only
+the ORM and the builds app: no admin, sessions, DRF, CORS, templates or
+middleware are loaded. Compare with: python manage.py bench_worker_startup
+"""
+
+from .settings import *  # noqa: F401,F403
+
+INSTALLED_APPS = [
+    'builds',
+]
+
+MIDDLEWARE = []
+
+TEMPLATES = []
+
+AUTH_PASSWORD_VALIDATORS = []
+
+# the worker never renders translated text, skip loading the catalogs
+USE_I18N = False
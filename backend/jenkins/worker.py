@@ -1,18 +1,54 @@
 import os
+import sys
+import time
+
+STARTED = time.perf_counter()
+
 import django
 
-# 1️⃣ Set Django settings module
-os.environ.setdefault("DJANGO_SETTINGS_MODULE", "jenkins.settings")  # <- replace with your project settings
+# 1️⃣ Set Django settings module: the worker profile loads the ORM and the builds app only
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "jenkins.settings_worker")  # <- replace with your project settings
 
 # 2️⃣ Initialize Django
 django.setup()
 
-# 3️⃣ Now import tasks and broker
-from builds.tasks import broker
-import dramatiq
-from dramatiq.worker import worker
+# 3️⃣ Read the pool definitions
+from django.conf import settings
+from dramatiq.cli import main as dramatiq_main, make_argument_parser
+from builds.fleet import node_queue
+from builds.profiling import startup_stats
+import builds.tasks  # noqa: F401  loaded once here, the forked worker processes share it
+
+
+def build_args(pool_name, extra_args):
+    """dramatiq CLI arguments for one pool from settings.DRAMATIQ_WORKER_POOLS"""
+    pool = settings.DRAMATIQ_WORKER_POOLS[pool_name]
+    args = [
+        "builds.broker", "builds.tasks",
+        "--processes", str(pool["processes"]),
+        "--threads", str(pool["threads"]),
+    ]
+    queues = list(pool.get("queues") or [])
+    node = os.environ.get("POLLER_NODE")
+    if node and "pollers" in queues:
+        # fleet node (manage.py run_poller_node): its own queue as well
+        queues.append(node_queue(node))
+    if queues:
+        args += ["--queues", *queues]
+    return args + extra_args
+
+
+def parse_args(pool_name, extra_args):
+    """build_args() as the Namespace dramatiq.cli.main() expects"""
+    return make_argument_parser().parse_args(build_args(pool_name, extra_args))
+
 
-# 4️⃣ Run worker
+# 4️⃣ Run worker: python worker.py <pool> [extra dramatiq args]
 if __name__ == "__main__":
-    dramatiq.set_broker(broker)
-    worker.main()
+    pools = settings.DRAMATIQ_WORKER_POOLS
+    if len(sys.argv) < 2 or sys.argv[1] not in pools:
+        sys.exit(f"usage: python worker.py {{{','.join(pools)}}} [dramatiq args]")
+    stats = startup_stats(STARTED)
+    print(f"worker {sys.argv[1]}: ready in {stats['seconds'] * 1000:.0f} ms, RSS {stats['rss_bytes'] / 2**20:.1f} MiB, "
+          f"{stats['modules']} modules, apps {','.join(stats['apps'])} ({settings.SETTINGS_MODULE})", file=sys.stderr)
+    sys.exit(dramatiq_main(parse_args(sys.argv[1], sys.argv[2:])))